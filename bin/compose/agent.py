@@ -0,0 +1,75 @@
+import json
+import os
+import shutil
+import socket
+import struct
+import sys
+
+
+class AgentClient:
+    """Send playbook jobs to the deployer agent (see dev-tutorial-deployer/agent)
+
+    The agent listens on a unix socket of the shared workspace, so it is only
+    reachable when the workspace is directly mounted from the host (Linux).
+    """
+
+    SUPPORTED = sys.platform not in ["darwin", "win32"]
+
+    def __init__(self, socket_path):
+        self.socket_path = socket_path
+
+    def connect(self):
+        """Return a connection to the agent, or None if it does not listen"""
+
+        if not self.SUPPORTED or not os.path.exists(self.socket_path):
+            return None
+
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            connection.connect(self.socket_path)
+        except OSError:
+            connection.close()
+            return None
+
+        return connection
+
+    def is_available(self):
+        connection = self.connect()
+        if connection is None:
+            return False
+
+        connection.close()
+        return True
+
+    def run(self, argv, output=None, connection=None):
+        """Run `argv` in the agent, stream its output and return its exit code"""
+
+        output = output or sys.stdout.buffer
+        tty = output.isatty() if hasattr(output, "isatty") else False
+        connection = connection or self.connect()
+        if connection is None:
+            return None
+
+        job = {
+            "argv": argv,
+            "tty": tty,
+            "columns": shutil.get_terminal_size().columns,
+        }
+
+        with connection, connection.makefile("rb") as stream:
+            connection.sendall(json.dumps(job).encode() + b"\n")
+
+            while True:
+                header = stream.read(5)
+                if len(header) < 5:
+                    print("Lost connection with the deployer agent")
+                    return 1
+
+                frame_type, size = header[:1], struct.unpack(">L", header[1:])[0]
+                payload = stream.read(size)
+
+                if b"o" == frame_type:
+                    output.write(payload)
+                    output.flush()
+                elif b"x" == frame_type:
+                    return int(payload)
@@ -18,11 +18,19 @@ class BaseCommand:
             "-v", "--verbose", action="store_true", help="make actions more verbose"
         )
 
+        parser.add_argument(
+            "-j",
+            "--jobs",
+            type=int,
+            default=None,
+            help="maximum number of tasks run at the same time (default: CPU count)",
+        )
+
         return parser
 
     @staticmethod
     def setup_context(args):
-        return ExecutionContext(args.verbose, args.dry_run)
+        return ExecutionContext(args.verbose, args.dry_run, args.jobs)
 
 
 class BaseDeployerCommand(BaseCommand):
@@ -36,8 +44,34 @@ class BaseDeployerCommand(BaseCommand):
             help="to not build the deployer from sources",
         )
 
+        parser.add_argument(
+            "--docker-backend",
+            choices=["auto", "api", "cli"],
+            default=None,
+            help=(
+                "how to reach the docker daemon: the Engine API socket or the docker CLI "
+                + "(default: $DEVTUTO_DOCKER_BACKEND or auto)"
+            ),
+        )
+
+        parser.add_argument(
+            "--agent",
+            action="store_true",
+            help=(
+                "run playbooks in a long-lived agent of the deployer (Linux only, "
+                + "default: $DEVTUTO_DEPLOYER_AGENT)"
+            ),
+        )
+
         return parser
 
     @staticmethod
     def setup_context(args):
-        return DeployerExecutionContext(args.verbose, args.dry_run, args.deployer_build)
+        return DeployerExecutionContext(
+            args.verbose,
+            args.dry_run,
+            args.deployer_build,
+            args.docker_backend,
+            args.jobs,
+            args.agent,
+        )
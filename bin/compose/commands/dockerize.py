@@ -1,10 +1,11 @@
-import sys
+import time
 import webbrowser
-from datetime import datetime
 
 from commands.abstract import Command
 from commands.common import BaseDeployerCommand
 from deployer import DeployerFactory, DeployerPlaybookCommandBuilder
+from logs import LogMultiplexer
+from sync import NodeModulesSync
 from utils import Utils
 
 
@@ -49,19 +50,34 @@ class DockerizeCommand(Command):
             help="additional ansible variables (default: %(default)s)",
             metavar="ansible_vars",
         )
+        self.parser.add_argument(
+            "--log-level",
+            choices=["debug", "info", "warn", "error"],
+            default=None,
+            help=(
+                "only output logs from this level "
+                + "(lines without level follow the previous one)"
+            ),
+        )
+        self.parser.add_argument(
+            "--log-filter",
+            default=None,
+            help="only output logs matching this regular expression",
+            metavar="regex",
+        )
+
+    def builder(self, args, playbook):
+        """Deployer run builder of a playbook of the environment"""
 
-    def run(self, args):
-        # Deployer run builder
         builder = (
             DeployerPlaybookCommandBuilder()
-            .add_playbook("build")
-            .add_playbook("run" if args.environment != "ci" else "run-ci")
+            .add_playbook(playbook)
             .add_inventory(args.environment)
         )
 
         # Specific dev arguments
         if args.environment == "dev":
-            builder.add_playbook("healthcheck").add_extra_var("healthcheck_wait", "yes")
+            builder.add_extra_var("healthcheck_wait", "yes")
 
         # Custom tags
         for tag in args.tags + args.services:
@@ -72,10 +88,19 @@ class DockerizeCommand(Command):
             var_name, value = ansible_var.split("=")
             builder.add_extra_var(var_name, f"'{value}'")
 
+        return builder
+
+    def run(self, args):
+        # The playbooks share their options, they run as a single playbook run
+        playbooks = ["build", "run" if args.environment != "ci" else "run-ci"]
+        if args.environment == "dev":
+            playbooks.append("healthcheck")
+        builders = [self.builder(args, playbook) for playbook in playbooks]
+
         # Run the deployer
-        start_time = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%IZ")
+        start_time = int(time.time())
         deployer = DeployerFactory().create(self.executer)
-        deployer.run(builder)
+        deployer.run_all(builders)
 
         if "ci" != args.environment:
             # Open the application
@@ -89,60 +114,64 @@ class DockerizeCommand(Command):
                 elif "test" == args.environment:
                     webbrowser.open("http://localhost:9876/debug.html")
 
-            # Retrieve dependencies to local node_mocules
-            (
-                self.executer.create_taskgroup()
-                .add_task(
-                    "docker cp dev-tutorial-api:/usr/src/app/api/node_modules ./dev-tutorial-api/"
-                )
-                .add_task(
-                    "docker cp dev-tutorial-app:/usr/src/app/app-ui/node_modules ./dev-tutorial-app/"
+            # Retrieve dependencies to local node_modules while following logs
+            logs = (
+                LogMultiplexer(
+                    deployer.docker, start_time, args.log_level, args.log_filter
                 )
-                .run_tasks()
+                .add("dev-tutorial-api", ApiLogTransform())
+                .add("dev-tutorial-app", AppLogTransform())
             )
+            self.executer.add_terminate_listener(logs.stop)
 
-            # Follow logs
             (
-                self.executer.create_taskgroup()
+                self.executer.create_scheduler()
+                .add_task(
+                    "api-modules",
+                    NodeModulesSync(
+                        self.executer,
+                        "dev-tutorial-api",
+                        "/usr/src/app/api",
+                        "./dev-tutorial-api",
+                    ).run,
+                )
                 .add_task(
-                    ApiLogTransform().transform(
-                        f"docker logs --follow --since {start_time} dev-tutorial-api"
-                    )
+                    "app-modules",
+                    NodeModulesSync(
+                        self.executer,
+                        "dev-tutorial-app",
+                        "/usr/src/app/app-ui",
+                        "./dev-tutorial-app",
+                    ).run,
                 )
                 .add_task(
-                    AppLogTransform().transform(
-                        f"docker logs --follow --since {start_time} dev-tutorial-app"
-                    )
+                    "logs",
+                    lambda: self.executer.call(
+                        f"docker logs --follow --since {start_time} "
+                        + "dev-tutorial-api dev-tutorial-app",
+                        logs.run,
+                    ),
+                    # Log lines are labelled by their service
+                    prefix_output=False,
                 )
-                .run_tasks()
-                .join_tasks()
+                .run()
             )
 
 
 class LogTransform:
-    def __init__(self, label, color, win_color):
+    def __init__(self, label, color):
         self.label = f"{label} "
         self.color = color
-        self.win_color = win_color
-
-    def transform(self, cmd):
-        if "win32" == sys.platform:
-            log_transform = (
-                "powershell \"{} | % {{ Write-Host -NoNewline -ForegroundColor {} '{} | '; Write-Host $_ }}\""
-            ).format(cmd, self.win_color, self.label)
-        else:
-            log_transform = "{} | sed -e 's/^/\033[0;{}m{} | \033[0m/'".format(
-                cmd, self.color, self.label
-            )
 
-        return log_transform
+    def format(self, line):
+        return f"\033[0;{self.color}m{self.label} | \033[0m{line.rstrip()}\n"
 
 
 class ApiLogTransform(LogTransform):
     def __init__(self):
-        super().__init__("backend", "33", "Yellow")
+        super().__init__("backend", "33")
 
 
 class AppLogTransform(LogTransform):
     def __init__(self):
-        super().__init__("frontend", "32", "DarkYellow")
+        super().__init__("frontend", "32")
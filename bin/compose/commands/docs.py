@@ -43,6 +43,12 @@ class DocsGenerateCommand(Command):
             ),
             dest="clean",
         )
+        self.parser.add_argument(
+            "-f",
+            "--force",
+            action="store_true",
+            help="run the generators even if their inputs have not changed",
+        )
         self.parser.add_argument(
             "-g",
             "--generators",
@@ -67,6 +73,9 @@ class DocsGenerateCommand(Command):
         if len(args.generators) > 0:
             builder.add_extra_var("generators", ",".join(args.generators))
 
+        if args.force:
+            builder.add_extra_var("docsgen_force", "yes")
+
         # Run the deployer
         deployer = DeployerFactory().create(self.executer)
         deployer.run(builder)
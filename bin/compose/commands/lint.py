@@ -39,22 +39,16 @@ class LintCommand(Command):
             help="linters to use (default: from .mega-linter.yml)",
         )
 
-    def run(self, args):
-        deployer = DeployerFactory().create(self.executer)
-
-        if args.cleanup:
-            deployer.run(
-                DeployerPlaybookCommandBuilder()
-                .add_playbook("quality_check")
-                .add_tag("cleanup")
-            )
+    def builder(self, args, *tags):
+        """Deployer run builder of the quality check tasks tagged with `tags`"""
 
-        # Deployer run builder
         builder = (
             DeployerPlaybookCommandBuilder()
             .add_playbook("quality_check")
             .add_extra_var("code_check_github_token", os.environ.get("GITHUB_TOKEN"))
         )
+        for tag in tags:
+            builder.add_tag(tag)
 
         if args.fix:
             builder.add_extra_var("code_check_apply_fixes", "yes")
@@ -67,4 +61,24 @@ class LintCommand(Command):
                 "code_check_enable_languages", ",".join(args.languages)
             )
 
-        deployer.run(builder)
+        return builder
+
+    def run(self, args):
+        # The Ansible check and the linter are independent, they run in parallel.
+        # Cleanup tasks run first, in the same playbook run as the linter
+        checks = self.builder(args, "ansible")
+        linter_tags = ["cleanup", "linter"] if args.cleanup else ["linter"]
+        linter = self.builder(args, *linter_tags)
+
+        deployer = DeployerFactory().create(self.executer)
+        (
+            self.executer.create_scheduler()
+            .add_task("deployer", lambda: deployer.setup(checks))
+            .add_task(
+                "ansible", lambda: deployer.execute(checks), depends_on=["deployer"]
+            )
+            .add_task(
+                "linter", lambda: deployer.execute(linter), depends_on=["deployer"]
+            )
+            .run()
+        )
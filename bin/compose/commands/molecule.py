@@ -23,6 +23,12 @@ class TestDeployerCommand(Command):
             action="store_true",
             help="Run all the tests",
         )
+        self.parser.add_argument(
+            "--changed",
+            action="store_true",
+            help="Only run the tests whose role, plugins or shared files changed "
+            + "since they last passed (of the given roles or all)",
+        )
         self.parser.add_argument(
             "--command", default="test", help="the molecule command"
         )
@@ -35,19 +41,25 @@ class TestDeployerCommand(Command):
     def run(self, args):
 
         # Check args
-        if len(args.roles) < 1 and not args.all:
+        if len(args.roles) < 1 and not args.all and not args.changed:
             raise InvalidCommandException(
-                "You must specify a role to test or provide --all option"
+                "You must specify a role to test or provide --all or --changed option"
             )
 
         # Run the deployer
-        command = f"../tests/unit-tests.py --command {args.command} "
+        command = ["../tests/unit-tests.py", "--command", args.command]
 
         if args.scenario is not None:
-            command += f" --scenario {args.scenario}"
+            command += ["--scenario", args.scenario]
+
+        if args.changed:
+            command.append("--changed")
+
+        # Scenarios run in parallel with --jobs
+        if args.jobs is not None:
+            command += ["--jobs", str(args.jobs)]
 
-        if len(args.roles) > 0:
-            command += " ".join(args.roles)
+        command += args.roles
 
         deployer = DeployerFactory().create(self.executer)
-        deployer.run(DeployerShellCommandBuilder(command))
+        deployer.run(DeployerShellCommandBuilder(" ".join(command)))
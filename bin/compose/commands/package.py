@@ -10,20 +10,28 @@ class PackageCommand(Command):
     def parent_command(self):
         return BaseDeployerCommand
 
-    def run(self, args):
-        # Deployer run builder
-        builder = (
+    def builder(self, playbook):
+        """Deployer run builder of a packaging step"""
+
+        return (
             DeployerPlaybookCommandBuilder()
-            .add_playbook("build")
-            .add_playbook("run")
-            .add_playbook("package")
+            .add_playbook(playbook)
             .add_inventory("prod")
             .set_login_required(True)
         )
 
-        # Run the deployer to package production images
-        deployer = DeployerFactory().create(self.executer)
-        deployer.run(builder)
+    def run(self, args):
+        # The steps share their options, they run as a single playbook run
+        builders = [self.builder(step) for step in ["build", "run", "package"]]
 
-        # Push the deployer image to
-        deployer.push()
+        # Package production images, then push the deployer image
+        deployer = DeployerFactory().create(self.executer)
+        (
+            self.executer.create_scheduler()
+            .add_task("deployer", lambda: deployer.setup(builders[0]))
+            .add_task(
+                "package", lambda: deployer.run_all(builders), depends_on=["deployer"]
+            )
+            .add_task("push", deployer.push, depends_on=["package"])
+            .run()
+        )
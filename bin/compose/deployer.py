@@ -1,20 +1,33 @@
+import copy
 import os
+import shlex
 import sys
+import threading
 from abc import ABC, abstractmethod
-from tempfile import mkstemp
 
-from docker import Docker, DockerExecBuilder, DockerRunBuilder
+from agent import AgentClient
+from docker import BuildContext, DockerExecBuilder, DockerFactory, DockerRunBuilder
 
 
 class Deployer:
 
     IMAGE = "tzimy/dev-tutorial-deployer"
     CONTAINER = "dev-tutorial-deployer"
+    AGENT_SOCKET = ".deployer/agent.sock"
+    BUILD_DIRECTORY = "./dev-tutorial-deployer"
+    FINGERPRINT_LABEL = "dev-tutorial.fingerprint"
 
     def __init__(self, executer):
         self.executer = executer
         self.init_workspaces()
-        self.docker = Docker(executer)
+        self.agent = AgentClient(os.path.join(self.host_workspace, self.AGENT_SOCKET))
+        self.docker = DockerFactory().create(executer)
+        self.state = DeployerState()
+
+        # Session: the deployer is prepared once per process
+        self.lock = threading.Lock()
+        self.ready = False
+        self.logged_in = False
 
     def init_workspaces(self):
         self.deployer_workspace = "/usr/src/dev-tutorial"
@@ -22,30 +35,96 @@ class Deployer:
             os.path.join(os.path.realpath(__file__), "../../..")
         )
 
-    def is_running(self):
-        return self.docker.is_running(self.CONTAINER)
+    def refresh_state(self, image=True, container=True):
+        """Read the deployer image and/or container state
 
-    def get_image_id(self):
-        fd, tmp_file = mkstemp()
-        self.executer.exec_context.set_next_dry_run(False)
-        self.executer.run(
-            'docker images --format "{{.ID}}" ' + self.IMAGE + " > " + tmp_file
+        With a fresh state cache (the daemon events are followed), the missing
+        objects and the ones inspected before (same ID) are read from it. Others are
+        inspected.
+        """
+
+        cache = self.docker.cached()
+        if cache is not None:
+            image = image and not self.read_cached_image(cache)
+            container = container and not self.read_cached_container(cache)
+
+        return self.inspect_state(image, container)
+
+    def read_cached_image(self, cache):
+        """Read the image from the cache, return whether it could"""
+
+        image_id = cache.image_id(self.IMAGE)
+        if image_id is None:
+            self.state.image = None
+            return True
+        return image_id == self.state.image_id()
+
+    def read_cached_container(self, cache):
+        """Read the container from the cache, return whether it could"""
+
+        container_id = cache.container_id(self.CONTAINER)
+        if container_id is None:
+            self.state.container = None
+            return True
+        inspected = self.state.container or {}
+        if container_id != inspected.get("Id"):
+            return False
+
+        self.state.container["State"]["Running"] = cache.is_running(self.CONTAINER)
+        return True
+
+    def inspect_state(self, image=True, container=True):
+        """Inspect the deployer image and/or container in one batched query
+
+        Changes made by this process reach the state cache a bit later, the objects
+        they change are inspected.
+        """
+
+        if not image and not container:
+            return self.state
+
+        images, containers = self.docker.inspect(
+            [self.IMAGE] if image else [], [self.CONTAINER] if container else []
         )
-        with open(tmp_file) as f:
-            image_id = f.readline()
-        os.close(fd)
-        os.remove(tmp_file)
-        return image_id
 
-    def is_updated(self):
-        return self.image_id != self.get_image_id()
+        if image:
+            self.state.image = images.get(self.IMAGE)
+        if container:
+            self.state.container = containers.get(self.CONTAINER)
+
+        return self.state
 
     def prepare(self):
-        self.image_id = self.get_image_id()
+        return self.refresh_state()
+
+    def is_agent_enabled(self):
+        enabled = self.executer.exec_context.agent or os.getenv(
+            "DEVTUTO_DEPLOYER_AGENT", ""
+        ).lower() in ["1", "true", "yes"]
+        return enabled and self.agent.SUPPORTED
 
     def build_image(self):
-        if self.executer.exec_context.build:
-            self.docker.build_image(self.IMAGE, "./dev-tutorial-deployer")
+        """Build the deployer image unless it was built from the same sources"""
+
+        if not self.executer.exec_context.build:
+            return
+
+        # Sources are read from the working directory, as docker build would do
+        context, labels = BuildContext(self.BUILD_DIRECTORY), {}
+        if context.exists():
+            fingerprint = context.fingerprint()
+            if self.state.image_fingerprint() == fingerprint:
+                if self.executer.exec_context.verbose():
+                    print(f"{self.IMAGE} is up to date ({fingerprint[:12]})")
+                return
+            labels[self.FINGERPRINT_LABEL] = fingerprint
+        else:
+            context = None
+
+        self.docker.build_image(
+            self.IMAGE, self.BUILD_DIRECTORY, labels=labels, context=context
+        )
+        self.inspect_state(container=False)
 
     def push(self):
         self.docker.push(self.IMAGE)
@@ -70,8 +149,23 @@ class Deployer:
     def stop(self):
         self.executer.exec_context.set_next_exit_on_error(False)
         self.docker.stop(self.CONTAINER)
+        self.inspect_state(image=False)
+        self.ready = self.logged_in = False
+
+    def remove(self):
+        """Remove the container, running or not, so that a new one is created"""
+
+        self.executer.exec_context.set_next_exit_on_error(False)
+        self.docker.remove(self.CONTAINER)
+        self.state.container = None
+        self.ready = self.logged_in = False
 
     def start(self):
+        command = "sleep infinity"
+        if self.is_agent_enabled():
+            agent_socket = f"{self.deployer_workspace}/{self.AGENT_SOCKET}"
+            command = f"python3 /etc/ansible/agent/agent.py --socket {agent_socket}"
+
         builder = DockerRunBuilder()
         builder.set_name(self.CONTAINER).set_image(self.IMAGE).set_daemon().add_env(
             "HOST_SYSTEM", sys.platform
@@ -86,12 +180,34 @@ class Deployer:
         ).add_network(
             "host"
         ).set_command(
-            "sleep infinity"
+            command
         )
 
+        # Facts are only cached between agent jobs on demand, they may be outdated
+        if self.is_agent_enabled() and os.getenv(
+            "DEVTUTO_DEPLOYER_AGENT_FACT_CACHE", ""
+        ).lower() in ["1", "true", "yes"]:
+            builder.add_env("DEPLOYER_AGENT_FACT_CACHE", "yes")
+
         self.docker.run(builder)
+        self.inspect_state(image=False)
 
     def execute(self, deployer_command_builder):
+        if self.is_agent_enabled() and deployer_command_builder.is_agent_capable():
+            # The agent listens once Ansible is loaded, use docker exec until then
+            connection = self.agent.connect()
+            if connection is not None:
+                argv = deployer_command_builder.follow_docker_exec_context(
+                    self.executer.exec_context
+                ).build_argv()
+
+                self.executer.exec_context.set_next_dry_run(False)
+                self.executer.call(
+                    f"[agent] {shlex.join(argv)}",
+                    lambda: self.agent.run(argv, connection=connection),
+                )
+                return
+
         builder = DockerExecBuilder()
         builder.set_container(self.CONTAINER).set_command(
             deployer_command_builder.follow_docker_exec_context(
@@ -99,24 +215,97 @@ class Deployer:
             ).build()
         )
 
+        # Only keep stdin attached for commands expecting user inputs
+        if not deployer_command_builder.is_interactive():
+            builder.set_interactive(False)
+
         self.executer.exec_context.set_next_dry_run(False)
         self.docker.exec(builder)
 
     def run(self, deployer_command_builder):
-        self.prepare()
+        self.setup(deployer_command_builder)
+        self.execute(deployer_command_builder)
+
+    def run_all(self, deployer_command_builders):
+        """Run several commands, merging the playbooks which can run together"""
+
+        batches = []
+        for builder in deployer_command_builders:
+            if len(batches) > 0 and batches[-1].can_merge(builder):
+                batches[-1] = batches[-1].merge(builder)
+            else:
+                batches.append(builder)
+
+        for builder in batches:
+            self.run(builder)
+
+    def setup(self, deployer_command_builder):
+        """Make sure an up-to-date deployer is running to execute the command
+
+        This is done once per session, later calls only log in when required.
+        """
+
+        with self.lock:
+            if not self.ready:
+                self.setup_container()
+                self.ready = True
+
+            if deployer_command_builder.is_login_required() and not self.logged_in:
+                self.login_registry()
+                self.logged_in = True
+
+    def setup_container(self):
+        state = self.prepare()
         self.build_image()
 
-        if self.is_updated() and self.is_running():
-            self.stop()
+        # A stopped (or not yet auto-removed) container would restart on the
+        # former image, the container is created again from the current one
+        if state.is_outdated():
+            self.remove()
 
-        if not self.is_running():
-            self.prepare()
-            self.start()
+        if not state.is_running():
+            if state.container_exists():
+                self.executer.exec_context.set_next_exit_on_error(False)
+                self.docker.start(self.CONTAINER)
+            else:
+                self.start()
 
-        if deployer_command_builder.is_login_required():
-            self.login_registry()
 
-        self.execute(deployer_command_builder)
+class DeployerState:
+    """Snapshot of the deployer image and container"""
+
+    def __init__(self, image=None, container=None):
+        self.image = image
+        self.container = container
+
+    def image_id(self):
+        return self.image["Id"] if self.image else None
+
+    def image_fingerprint(self):
+        """Fingerprint of the sources the image was built from (see BuildContext)"""
+
+        if not self.image:
+            return None
+
+        labels = (self.image.get("Config") or {}).get("Labels") or {}
+        return labels.get(Deployer.FINGERPRINT_LABEL)
+
+    def container_exists(self):
+        return self.container is not None
+
+    def container_image_id(self):
+        return self.container["Image"] if self.container else None
+
+    def is_running(self):
+        return self.container_exists() and self.container["State"]["Running"]
+
+    def is_outdated(self):
+        """Whether the container does not run the current deployer image"""
+        return (
+            self.image is not None
+            and self.container_exists()
+            and self.container_image_id() != self.image_id()
+        )
 
 
 class Win32Deployer(Deployer):
@@ -131,13 +320,27 @@ class Win32Deployer(Deployer):
 
 
 class DarwinDeployer(Deployer):
+    SIDECAR = "tcp-connect"
+
     def prepare(self):
-        super().prepare()
+        # The deployer state is also read from the cache
+        cache = self.docker.watch()
+        state = super().prepare()
+
+        # Avoid trying to run an existing sidecar when its state is known
+        if cache.is_fresh() and cache.container_exists(self.SIDECAR):
+            if not cache.is_running(self.SIDECAR):
+                self.executer.exec_context.set_next_exit_on_error(False)
+                self.docker.start(self.SIDECAR)
+            return state
+        # Without the events, the daemon tells whether it already runs
+        if not cache.is_fresh() and self.docker.is_running(self.SIDECAR):
+            return state
 
         builder = (
             DockerRunBuilder()
             .set_daemon()
-            .set_name("tcp-connect")
+            .set_name(self.SIDECAR)
             .bind_port(2375)
             .add_volume("/var/run/docker.sock", "/var/run/docker.sock")
             .set_image("alpine/socat")
@@ -150,7 +353,9 @@ class DarwinDeployer(Deployer):
         exit_code = self.docker.run(builder)
 
         if exit_code > 0:
-            self.docker.start("tcp-connect")
+            self.docker.start(self.SIDECAR)
+
+        return state
 
 
 class DeployerFactory:
@@ -168,6 +373,7 @@ class DeployerFactory:
 class DeployerCommandBuilder(ABC):
     def __init__(self):
         self.login_required = False
+        self.interactive = False
 
     @abstractmethod
     def build(self):
@@ -183,11 +389,27 @@ class DeployerCommandBuilder(ABC):
         self.login_required = required
         return self
 
+    def is_interactive(self):
+        return self.interactive
+
+    def is_agent_capable(self):
+        """Whether the command can be run by the deployer agent (see build_argv)"""
+        return False
+
+    def can_merge(self, _):
+        """Whether this command and another one can run as a single command"""
+        return False
+
+    def set_interactive(self, interactive=True):
+        self.interactive = interactive
+        return self
+
 
 class DeployerShellCommandBuilder(DeployerCommandBuilder):
     def __init__(self, command="sh"):
         super().__init__()
         self.command = command
+        self.set_interactive()
 
     def build(self):
         return self.command
@@ -236,6 +458,30 @@ class DeployerPlaybookCommandBuilder(DeployerCommandBuilder):
         self.check = check
         return self
 
+    def is_agent_capable(self):
+        return True
+
+    def can_merge(self, other):
+        return (
+            isinstance(other, DeployerPlaybookCommandBuilder)
+            and self.inventories == other.inventories
+            and self.tags == other.tags
+            and self.extra_vars == other.extra_vars
+            and self.check == other.check
+            and self.is_login_required() == other.is_login_required()
+        )
+
+    def merge(self, other):
+        """Return a command running the playbooks of both commands"""
+
+        if not self.can_merge(other):
+            raise Exception("Only playbooks with the same options can be merged.")
+
+        merged = copy.deepcopy(self)
+        merged.playbooks += other.playbooks
+        merged.verbosity = max(self.verbosity, other.verbosity)
+        return merged
+
     def follow_docker_exec_context(self, exec_context):
         return self.set_verbosity(3 if exec_context.verbose() else 0).set_check(
             exec_context.dry_run()
@@ -248,7 +494,7 @@ class DeployerPlaybookCommandBuilder(DeployerCommandBuilder):
             args += f"-i {inventory} "
 
         for var_name, value in self.extra_vars.items():
-            args += f"\"-e {var_name}={value}\" "
+            args += f'"-e {var_name}={value}" '
 
         if len(self.tags) > 0:
             taglist = ",".join(self.tags)
@@ -265,3 +511,23 @@ class DeployerPlaybookCommandBuilder(DeployerCommandBuilder):
             args += f"{playbook} "
 
         return f"ansible-playbook {args}"
+
+    def build_argv(self):
+        argv = ["ansible-playbook"]
+
+        for inventory in self.inventories:
+            argv += ["-i", inventory]
+
+        for var_name, value in self.extra_vars.items():
+            argv += ["-e", f"{var_name}={value}"]
+
+        if len(self.tags) > 0:
+            argv.append(f"--tags={','.join(self.tags)}")
+
+        if self.check:
+            argv.append("--check")
+
+        if self.verbosity > 0:
+            argv.append("-" + "v" * self.verbosity)
+
+        return argv + self.playbooks
@@ -1,34 +1,879 @@
+import asyncio
+import atexit
+import glob
+import hashlib
+import http.client
+import io
+import json
+import os
+import shlex
+import socket
+import struct
+import sys
+import tarfile
+import threading
+import time
+from urllib.parse import quote, urlencode
+
 from utils import Utils
 
 
 class Docker:
+    """Docker backend using the docker CLI"""
+
     def __init__(self, executer):
         self.executer = executer
+        self.cache = None
+
+    def build_image(self, name, directory, labels=None, context=None):
+        """Build an image from a directory, or from a minimal BuildContext of it"""
+
+        cmd = ["docker", "build", "-t", name]
+        for label, value in (labels or {}).items():
+            cmd += ["--label", f"{label}={value}"]
+
+        if context is None:
+            return self.executer.run(cmd + [directory])
+
+        return self.executer.execute(
+            cmd + ["-"], input=context.tar(), text=False
+        ).exit_code
+
+    def watch(self):
+        """Start (once) and return the state cache of the daemon"""
 
-    def build_image(self, name, directory):
-        return self.executer.run(f"docker build -t {name} {directory}")
+        if self.cache is None:
+            self.cache = DockerStateCache(self).start()
+        return self.cache
+
+    def cached(self):
+        """The state cache, if it is watched and up to date"""
+        return self.cache if self.cache is not None and self.cache.is_fresh() else None
 
     def is_running(self, container):
+        """Whether a container is running, a missing one is not"""
+
+        cache = self.cached()
+        if cache is not None:
+            return cache.is_running(container)
+
+        states = self.query(
+            ["docker", "container", "inspect", "--format", "{{json .State}}", container]
+        )
+        return bool(states) and states[0].get("Running", False)
+
+    def query(self, cmd):
+        """Run a read-only command (even on dry run) and decode its JSON lines
+
+        Return None when the command fails.
+        """
+
+        self.executer.exec_context.set_next_dry_run(False)
         self.executer.exec_context.set_next_exit_on_error(False)
-        exit_code = self.executer.run(
-            f"docker container inspect {container} >/dev/null 2>&1"
+        result = self.executer.execute(cmd, capture=True)
+        if result.exit_code != 0 and not result.stdout:
+            return None
+
+        return [json.loads(line) for line in (result.stdout or "").splitlines() if line]
+
+    def inspect(self, images=(), containers=()):
+        """Inspect images and containers at once
+
+        Return two dicts (images, containers) of the found objects by name.
+        """
+
+        objects = self.query(
+            ["docker", "inspect", "--format", "{{json .}}"]
+            + list(images)
+            + list(containers)
+        )
+
+        found_images, found_containers = {}, {}
+        for obj in objects or []:
+            if "State" in obj:
+                found_containers[obj["Name"].lstrip("/")] = obj
+            else:
+                tags = obj.get("RepoTags") or []
+                for image in images:
+                    if image in tags or f"{image}:latest" in tags:
+                        found_images[image] = obj
+
+        return found_images, found_containers
+
+    def list_state(self):
+        """List all containers and tagged images at once
+
+        Return two dicts: containers by name ({"Id", "Running"}) and image IDs by
+        tag, or None when the daemon cannot be reached.
+        """
+
+        containers = self.query(
+            ["docker", "ps", "--all", "--no-trunc", "--format", "{{json .}}"]
+        )
+        images = self.query(
+            ["docker", "images", "--no-trunc", "--format", "{{json .}}"]
+        )
+        if containers is None or images is None:
+            return None
+
+        return (
+            {
+                container["Names"].split(",")[0]: {
+                    "Id": container["ID"],
+                    "Running": container["Status"].startswith("Up"),
+                }
+                for container in containers
+            },
+            {
+                f"{image['Repository']}:{image['Tag']}": image["ID"]
+                for image in images
+                if "<none>" not in [image["Repository"], image["Tag"]]
+            },
+        )
+
+    def events(self, since):
+        """Container and image events of the daemon from `since` (a timestamp)"""
+
+        process = self.executer.open(
+            ["docker", "events", "--since", str(since), "--format", "{{json .}}"]
+            + ["--filter", "type=container", "--filter", "type=image"]
         )
-        return 0 == exit_code
+        if process is None:
+            return None
+
+        return DockerEvents(process.stdout, lambda: self.executer.close(process))
+
+    async def follow_logs(self, container, since):
+        """Yield the log lines of a container from `since` (timestamp) until it stops"""
+
+        process = self.executer.open(
+            ["docker", "logs", "--follow", "--since", str(since), container],
+            merge_stderr=True,
+        )
+        if process is None:
+            return
+
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                line = await loop.run_in_executor(None, process.stdout.readline)
+                if not line:
+                    break
+                yield line
+        finally:
+            self.executer.close(process)
 
     def exec(self, docker_exec_builder):
         self.executer.run(docker_exec_builder.build())
 
     def push(self, image, tag="latest"):
-        self.executer.run(f"docker push {image}:{tag}")
+        self.executer.run(["docker", "push", f"{image}:{tag}"])
 
     def run(self, docker_run_builder):
         return self.executer.run(docker_run_builder.build())
 
     def start(self, container):
-        self.executer.run(f"docker start {container}")
+        self.executer.run(["docker", "start", container])
+
+    def stop(self, container):
+        self.executer.run(["docker", "stop", container])
+
+    def remove(self, container):
+        self.executer.run(["docker", "rm", "--force", container])
+
+
+class DockerApi(Docker):
+    """Docker backend talking to the Engine API through the daemon socket
+
+    Every call goes through the same connection instead of spawning a shell and
+    a docker CLI process. Pushes (registry credentials) and interactive sessions
+    (terminal handling) are left to the docker CLI.
+    """
+
+    def __init__(self, executer, client):
+        super().__init__(executer)
+        self.client = client
+
+    def call(self, description, operation):
+        def safe_operation():
+            try:
+                return operation()
+            except (DockerApiError, OSError) as e:
+                print(f"\033[91m{e}\033[0m", file=sys.stderr)
+                return 1
+
+        return self.executer.call(description, safe_operation)
+
+    def request(self, description, method, path, params=None):
+        """Call an endpoint for its side effect only"""
+
+        def request():
+            self.client.request(method, path, params)
+            return 0
+
+        return self.call(description, request)
+
+    def build_image(self, name, directory, labels=None, context=None):
+        def build():
+            if context is None:
+                archive = io.BytesIO()
+                with tarfile.open(fileobj=archive, mode="w") as tar:
+                    tar.add(directory, arcname=".")
+                body = archive.getvalue()
+            else:
+                body = context.tar()
+
+            params = {"t": name, "rm": 1}
+            if labels:
+                params["labels"] = json.dumps(labels)
+
+            response = self.client.stream(
+                "POST",
+                "/build",
+                params=params,
+                body=body,
+                headers={"Content-Type": "application/x-tar"},
+            )
+            return self.print_progress(response)
+
+        return self.call(f"docker build -t {name} {directory}", build)
+
+    def is_running(self, container):
+        cache = self.cached()
+        if cache is not None:
+            return cache.is_running(container)
+
+        def inspect():
+            try:
+                attrs = self.client.request(
+                    "GET", f"/containers/{quote(container)}/json"
+                )
+            except DockerApiError as e:
+                if e.status != 404:
+                    raise
+                return 1  # A missing container is not running
+            return 0 if attrs["State"]["Running"] else 1
+
+        self.executer.exec_context.set_next_dry_run(False)
+        self.executer.exec_context.set_next_exit_on_error(False)
+        return 0 == self.call(f"docker container inspect {container}", inspect)
+
+    def inspect(self, images=(), containers=()):
+        found_images, found_containers = {}, {}
+
+        def inspect():
+            for found, kind, names in [
+                (found_images, "images", images),
+                (found_containers, "containers", containers),
+            ]:
+                for name in names:
+                    try:
+                        found[name] = self.client.request(
+                            "GET", f"/{kind}/{quote(name)}/json"
+                        )
+                    except DockerApiError as e:
+                        if e.status != 404:
+                            raise
+            return 0
+
+        self.executer.exec_context.set_next_dry_run(False)
+        self.executer.exec_context.set_next_exit_on_error(False)
+        self.call(
+            "docker inspect " + " ".join(list(images) + list(containers)), inspect
+        )
+
+        return found_images, found_containers
+
+    def list_state(self):
+        try:
+            containers = self.client.request("GET", "/containers/json", {"all": 1})
+            images = self.client.request("GET", "/images/json")
+        except (DockerApiError, OSError):
+            return None
+
+        return (
+            {
+                container["Names"][0].lstrip("/"): {
+                    "Id": container["Id"],
+                    "Running": "running" == container["State"],
+                }
+                for container in containers
+            },
+            {
+                tag: image["Id"]
+                for image in images
+                for tag in image.get("RepoTags") or []
+                if "<none>" not in tag
+            },
+        )
+
+    def events(self, since):
+        # A dedicated connection, the stream never ends
+        client = DockerClient(self.client.socket_path)
+        try:
+            response = client.stream(
+                "GET",
+                "/events",
+                params={
+                    "since": since,
+                    "filters": json.dumps({"type": ["container", "image"]}),
+                },
+            )
+        except (DockerApiError, OSError):
+            return None
+
+        return DockerEvents(response, client.close)
+
+    async def follow_logs(self, container, since):
+        # The client is synchronous, the inspection runs aside of the event loop
+        loop = asyncio.get_running_loop()
+        try:
+            inspection = await loop.run_in_executor(
+                None, self.client.request, "GET", f"/containers/{quote(container)}/json"
+            )
+        except DockerApiError:
+            return
+        tty = inspection["Config"]["Tty"]
+
+        params = {"follow": 1, "stdout": 1, "stderr": 1, "since": since}
+        response = await AsyncDockerResponse.open(
+            self.client.socket_path,
+            f"/containers/{quote(container)}/logs?{urlencode(params)}",
+        )
+        try:
+            lines = response.lines() if tty else response.multiplexed_lines()
+            async for line in lines:
+                yield line
+        finally:
+            response.close()
+
+    def exec(self, docker_exec_builder):
+        if docker_exec_builder.interactive:
+            return super().exec(docker_exec_builder)
+
+        def execute():
+            exec_id = self.client.request(
+                "POST",
+                f"/containers/{quote(docker_exec_builder.container)}/exec",
+                body=docker_exec_builder.build_config(),
+            )["Id"]
+
+            response = self.client.stream(
+                "POST",
+                f"/exec/{exec_id}/start",
+                body={"Detach": False, "Tty": docker_exec_builder.tty},
+            )
+            self.print_output(response, docker_exec_builder.tty)
+
+            return self.client.request("GET", f"/exec/{exec_id}/json")["ExitCode"]
+
+        self.call(docker_exec_builder.build(), execute)
+
+    def run(self, docker_run_builder):
+        if docker_run_builder.interactive or not docker_run_builder.daemon:
+            return super().run(docker_run_builder)
+
+        def run():
+            name, config = docker_run_builder.build_config()
+            params = {"name": name} if name else None
+
+            try:
+                container = self.client.request(
+                    "POST", "/containers/create", params=params, body=config
+                )
+            except DockerApiError as e:
+                if e.status != 404:
+                    raise
+
+                # Pull the missing image as `docker run` does
+                image, _, tag = config["Image"].partition(":")
+                self.print_progress(
+                    self.client.stream(
+                        "POST",
+                        "/images/create",
+                        params={"fromImage": image, "tag": tag or "latest"},
+                    )
+                )
+                container = self.client.request(
+                    "POST", "/containers/create", params=params, body=config
+                )
+
+            self.client.request("POST", f"/containers/{container['Id']}/start")
+            return 0
+
+        return self.call(docker_run_builder.build(), run)
+
+    def start(self, container):
+        self.request(
+            f"docker start {container}", "POST", f"/containers/{quote(container)}/start"
+        )
 
     def stop(self, container):
-        self.executer.run(f"docker stop {container}")
+        self.request(
+            f"docker stop {container}", "POST", f"/containers/{quote(container)}/stop"
+        )
+
+    def remove(self, container):
+        self.request(
+            f"docker rm --force {container}",
+            "DELETE",
+            f"/containers/{quote(container)}",
+            {"force": "true"},
+        )
+
+    @staticmethod
+    def print_progress(response):
+        """Print a JSON progress stream (build, pull) and return an exit code"""
+
+        exit_code = 0
+        for line in response:
+            if not line.strip():
+                continue
+            message = json.loads(line)
+            if "error" in message:
+                print(message["error"], file=sys.stderr)
+                exit_code = 1
+            elif "stream" in message:
+                sys.stdout.write(message["stream"])
+            elif "status" in message:
+                print(" ".join(filter(None, [message.get("id"), message["status"]])))
+        sys.stdout.flush()
+
+        return exit_code
+
+    @staticmethod
+    def print_output(response, tty):
+        """Forward a container output stream to the standard outputs"""
+
+        if tty:
+            for chunk in iter(lambda: response.read1(4096), b""):
+                sys.stdout.buffer.write(chunk)
+                sys.stdout.flush()
+            return
+
+        # Without TTY, frames are multiplexed: 8 bytes header (stream, 0, 0, 0, size)
+        outputs = {1: sys.stdout, 2: sys.stderr}
+        while True:
+            header = response.read(8)
+            if len(header) < 8:
+                break
+            stream, size = struct.unpack(">BxxxL", header)
+            output = outputs.get(stream, sys.stdout)
+            output.buffer.write(response.read(size))
+            output.flush()
+
+
+class DockerApiError(Exception):
+    def __init__(self, status, message):
+        super().__init__(f"Docker API error {status}: {message}")
+        self.status = status
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path):
+        super().__init__("localhost")
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.socket_path)
+
+
+class DockerClient:
+    """Minimal Docker Engine API client keeping a single connection open"""
+
+    API_VERSION = "v1.40"
+
+    def __init__(self, socket_path):
+        self.socket_path = socket_path
+        self.connection = UnixHTTPConnection(socket_path)
+        # Requests may come from several threads (e.g. log inspections)
+        self.lock = threading.Lock()
+
+    def close(self):
+        # Shutdown first to interrupt a read of another thread
+        if self.connection.sock is not None:
+            try:
+                self.connection.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        self.connection.close()
+
+    def send(self, method, path, params=None, body=None, headers=None):
+        url = f"/{self.API_VERSION}{path}"
+        if params:
+            url += "?" + urlencode(params)
+
+        headers = dict(headers or {})
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode()
+            headers["Content-Type"] = "application/json"
+
+        self.connection.request(method, url, body=body, headers=headers)
+        response = self.connection.getresponse()
+
+        if response.status >= 400:
+            content = response.read()
+            try:
+                message = json.loads(content)["message"]
+            except (ValueError, KeyError):
+                message = content.decode(errors="replace")
+            raise DockerApiError(response.status, message)
+
+        return response
+
+    def request(self, method, path, params=None, body=None, headers=None):
+        """Send a request and return the decoded JSON response (if any)"""
+
+        with self.lock:
+            content = self.send(method, path, params, body, headers).read()
+        return json.loads(content) if content else {}
+
+    def stream(self, method, path, params=None, body=None, headers=None):
+        """Send a request and return the response to be read progressively
+
+        The response must be consumed before sending another request. Hijacked
+        streams (exec, attach) close the connection, which will be reopened by
+        the next request.
+        """
+
+        return self.send(method, path, params, body, headers)
+
+
+class AsyncDockerResponse:
+    """Engine API response read from an asyncio unix connection (long streams)"""
+
+    def __init__(self, reader, writer, chunked):
+        self.reader = reader
+        self.writer = writer
+        self.chunked = chunked
+
+    @classmethod
+    async def open(cls, socket_path, path):
+        reader, writer = await asyncio.open_unix_connection(socket_path)
+        writer.write(
+            f"GET /{DockerClient.API_VERSION}{path} HTTP/1.1\r\n".encode()
+            + b"Host: localhost\r\n\r\n"
+        )
+
+        status = int((await reader.readline()).split()[1])
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode().strip()
+            if not line:
+                break
+            name, _, value = line.partition(":")
+            headers[name.lower()] = value.strip().lower()
+
+        response = cls(reader, writer, "chunked" == headers.get("transfer-encoding"))
+        if status >= 400:
+            content = b"".join([chunk async for chunk in response.chunks()])
+            response.close()
+            raise DockerApiError(status, content.decode(errors="replace"))
+
+        return response
+
+    async def chunks(self):
+        if not self.chunked:
+            while True:
+                chunk = await self.reader.read(65536)
+                if not chunk:
+                    return
+                yield chunk
+
+        while True:
+            size = int((await self.reader.readline()).strip() or b"0", 16)
+            if size == 0:
+                return
+            chunk = await self.reader.readexactly(size)
+            await self.reader.readline()
+            yield chunk
+
+    async def lines(self, chunks=None):
+        pending = b""
+        async for chunk in chunks or self.chunks():
+            pending += chunk
+            *lines, pending = pending.split(b"\n")
+            for line in lines:
+                yield line.decode(errors="replace") + "\n"
+
+        if pending:
+            yield pending.decode(errors="replace") + "\n"
+
+    async def multiplexed_lines(self):
+        """Lines of the multiplexed stdout/stderr frames (see DockerApi.print_output)"""
+
+        async def payloads():
+            pending = b""
+            async for chunk in self.chunks():
+                pending += chunk
+                while len(pending) >= 8:
+                    end = 8 + struct.unpack(">xxxxL", pending[:8])[0]
+                    if len(pending) < end:
+                        break
+                    yield pending[8:end]
+                    pending = pending[end:]
+
+        async for line in self.lines(payloads()):
+            yield line
+
+    def close(self):
+        self.writer.close()
+
+
+class DockerEvents:
+    """Daemon events stream (JSON lines), which can be closed from another thread"""
+
+    def __init__(self, lines, close):
+        self.lines = lines
+        self.close = close
+
+    def __iter__(self):
+        for line in self.lines:
+            if line.strip():
+                yield json.loads(line)
+
+
+class DockerStateCache:
+    """Containers and images of the daemon, answered from memory
+
+    The state is listed once, then kept current by the daemon events stream
+    followed in a background thread. Listeners subscribe to the same events (e.g.
+    to detect container restarts). Events are applied asynchronously, so a change
+    made by the current process may be seen a few milliseconds later.
+    """
+
+    def __init__(self, docker):
+        self.docker = docker
+        self.containers = {}
+        self.images = {}
+        self.listeners = []
+        self.events = None
+        self.thread = None
+        self.fresh = False
+        self.lock = threading.Lock()
+
+    def start(self):
+        # Replay the events happening during the listing
+        since = int(time.time())
+
+        state = self.docker.list_state()
+        if state is None:
+            return self
+
+        self.events = self.docker.events(since)
+        if self.events is None:
+            return self
+
+        self.containers, self.images = state
+        self.fresh = True
+        self.thread = threading.Thread(target=self.follow, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+        return self
+
+    def follow(self):
+        try:
+            for event in self.events:
+                self.apply(event)
+        except (OSError, ValueError):
+            pass
+        finally:
+            self.fresh = False
+
+    def close(self):
+        self.fresh = False
+        if self.events is not None:
+            self.events.close()
+
+    def is_fresh(self):
+        return self.fresh
+
+    def apply(self, event):
+        actor = event.get("Actor") or {}
+        attributes = actor.get("Attributes") or {}
+        action = event.get("Action", "")
+
+        with self.lock:
+            if "container" == event.get("Type"):
+                name = attributes.get("name")
+                if "create" == action:
+                    self.containers[name] = {"Id": actor.get("ID"), "Running": False}
+                elif action in ["start", "die"]:
+                    container = self.containers.setdefault(
+                        name, {"Id": actor.get("ID")}
+                    )
+                    container["Running"] = "start" == action
+                elif "destroy" == action:
+                    self.containers.pop(name, None)
+                elif "rename" == action:
+                    old_name = attributes.get("oldName", "").lstrip("/")
+                    self.containers[name] = self.containers.pop(old_name, None) or {
+                        "Id": actor.get("ID"),
+                        "Running": False,
+                    }
+            elif "image" == event.get("Type"):
+                if "tag" == action:
+                    self.images[self.tag(attributes.get("name"))] = actor.get("ID")
+                elif "untag" == action:
+                    # Only the removed tag, others may still point to the image
+                    tag = self.tag(attributes.get("name") or "")
+                    if self.images.get(tag) == actor.get("ID"):
+                        del self.images[tag]
+                elif "delete" == action:
+                    for tag, image_id in list(self.images.items()):
+                        if image_id == actor.get("ID"):
+                            del self.images[tag]
+
+            listeners = list(self.listeners)
+
+        for listener in listeners:
+            listener(event)
+
+    def subscribe(self, listener):
+        """Call `listener(event)` on events until the returned function is called"""
+
+        with self.lock:
+            self.listeners.append(listener)
+
+        def unsubscribe():
+            with self.lock:
+                self.listeners.remove(listener)
+
+        return unsubscribe
+
+    @staticmethod
+    def tag(image):
+        return image if ":" in image.rsplit("/", 1)[-1] else f"{image}:latest"
+
+    def container_exists(self, name):
+        with self.lock:
+            return name in self.containers
+
+    def container_id(self, name):
+        with self.lock:
+            return self.containers.get(name, {}).get("Id")
+
+    def is_running(self, name):
+        with self.lock:
+            return self.containers.get(name, {}).get("Running", False)
+
+    def image_id(self, name):
+        with self.lock:
+            return self.images.get(self.tag(name))
+
+
+class DockerFactory:
+
+    SOCKET = "/var/run/docker.sock"
+    clients = {}
+
+    def create(self, executer):
+        backend = getattr(executer.exec_context, "docker_backend", None) or os.getenv(
+            "DEVTUTO_DOCKER_BACKEND", "auto"
+        )
+
+        if "auto" == backend:
+            backend = "api" if self.is_api_available() else "cli"
+
+        if "api" == backend:
+            return DockerApi(executer, self.client(self.SOCKET))
+
+        return Docker(executer)
+
+    def is_api_available(self):
+        # A remote daemon (DOCKER_HOST) or a Windows named pipe is left to the CLI
+        return (
+            "win32" != sys.platform
+            and os.getenv("DOCKER_HOST") is None
+            and os.path.exists(self.SOCKET)
+        )
+
+    @classmethod
+    def client(cls, socket_path):
+        """One client (and so one connection) for the whole session"""
+
+        if socket_path not in cls.clients:
+            cls.clients[socket_path] = DockerClient(socket_path)
+        return cls.clients[socket_path]
+
+
+class BuildContext:
+    """Files of a directory actually consumed by its Dockerfile
+
+    The Dockerfile and the local sources of its COPY/ADD instructions make both
+    the build fingerprint and the build context sent to the daemon.
+    """
+
+    def __init__(self, directory, dockerfile="Dockerfile"):
+        self.directory = directory
+        self.dockerfile = dockerfile
+        self.files = None
+
+    def exists(self):
+        return os.path.isfile(os.path.join(self.directory, self.dockerfile))
+
+    def sources(self):
+        """Source patterns of the COPY/ADD instructions (multi-stage ones excluded)"""
+
+        with open(os.path.join(self.directory, self.dockerfile)) as f:
+            # Join continuation lines
+            content = f.read().replace("\\\n", " ")
+
+        sources = []
+        for line in content.splitlines():
+            instruction = line.split(maxsplit=1)
+            if len(instruction) < 2 or instruction[0].upper() not in ["COPY", "ADD"]:
+                continue
+
+            words = shlex.split(instruction[1], comments=True)
+            if any(word.startswith("--from") for word in words):
+                continue
+
+            args = [word for word in words if not word.startswith("--")]
+            sources += [
+                src for src in args[:-1] if not src.startswith(("http://", "https://"))
+            ]
+
+        return sources
+
+    def list_files(self):
+        """Relative paths of the consumed files, sorted"""
+
+        if self.files is not None:
+            return self.files
+
+        files = {os.path.join(self.directory, self.dockerfile)}
+        for pattern in self.sources():
+            for path in glob.glob(os.path.join(self.directory, pattern)):
+                if os.path.isdir(path):
+                    for root, _, names in os.walk(path):
+                        files.update(os.path.join(root, name) for name in names)
+                else:
+                    files.add(path)
+
+        self.files = sorted(
+            os.path.relpath(path, self.directory).replace(os.sep, "/") for path in files
+        )
+        return self.files
+
+    def fingerprint(self):
+        digest = hashlib.sha256()
+        for path in self.list_files():
+            digest.update(path.encode() + b"\0")
+            with open(os.path.join(self.directory, path), "rb") as f:
+                digest.update(hashlib.sha256(f.read()).digest())
+
+        return digest.hexdigest()
+
+    def tar(self):
+        archive = io.BytesIO()
+        with tarfile.open(fileobj=archive, mode="w") as tar:
+            for path in self.list_files():
+                tar.add(os.path.join(self.directory, path), arcname=path)
+
+        return archive.getvalue()
 
 
 class DockerExecBuilder:
@@ -72,6 +917,21 @@ class DockerExecBuilder:
         # Build the command
         return f"docker exec {options} {self.container} {self.command}"
 
+    def build_config(self):
+        """Build the Engine API exec configuration"""
+
+        if not self.container or not self.command:
+            raise Exception("Missing container and/or command to execute")
+
+        # The command is split as the host shell does with the CLI
+        return {
+            "Cmd": shlex.split(os.path.expandvars(self.command)),
+            "AttachStdin": self.interactive,
+            "AttachStdout": True,
+            "AttachStderr": True,
+            "Tty": self.tty,
+        }
+
 
 class DockerRunBuilder:
     def __init__(self):
@@ -169,3 +1029,35 @@ class DockerRunBuilder:
 
         # Build the command
         return f"docker run {args} {self.image} {self.command}"
+
+    def build_config(self):
+        """Build the Engine API container name and configuration"""
+
+        if not self.image:
+            raise Exception("Missing image to run")
+
+        host_config = {
+            "AutoRemove": self.autoremove,
+            "Binds": [f"{key}:{value}" for key, value in self.volumes.items()],
+            "PortBindings": {
+                f"{target}/tcp": [{"HostPort": str(port)}]
+                for port, target in self.ports.items()
+            },
+        }
+
+        if len(self.networks) > 0:
+            host_config["NetworkMode"] = self.networks[0]
+
+        config = {
+            "Image": self.image,
+            "Env": [f"{key}={value}" for key, value in self.env.items()],
+            "ExposedPorts": {f"{target}/tcp": {} for target in self.ports.values()},
+            "Tty": self.tty,
+            "OpenStdin": self.interactive,
+            "HostConfig": host_config,
+        }
+
+        if self.command:
+            config["Cmd"] = shlex.split(self.command)
+
+        return getattr(self, "name", None), config
@@ -1,32 +1,46 @@
-import multiprocessing
 import os
+import shlex
+import subprocess  # nosec
 import sys
-from signal import SIGINT, signal
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from signal import SIGINT, getsignal, signal
 
 
 class ExecutionContext:
-    def __init__(self, verbose=False, dry_run=False):
+    def __init__(self, verbose=False, dry_run=False, jobs=None):
         self.default_verbose = verbose
         self.default_dry_run = dry_run
         self.default_exit_on_error = True
+        self.jobs = jobs
+
+        # Next command overrides are kept per thread (see TaskScheduler)
+        self.next = threading.local()
         self.cleanup()
 
     def cleanup(self):
-        self.next_verbose = None
-        self.next_dry_run = None
-        self.next_exit_on_error = None
+        self.next.verbose = None
+        self.next.dry_run = None
+        self.next.exit_on_error = None
+
+    def override(self, name):
+        return getattr(self.next, name, None)
 
     def verbose(self):
-        return self.default_verbose if self.next_verbose is None else self.next_verbose
+        next_verbose = self.override("verbose")
+        return self.default_verbose if next_verbose is None else next_verbose
 
     def dry_run(self):
-        return self.default_dry_run if self.next_dry_run is None else self.next_dry_run
+        next_dry_run = self.override("dry_run")
+        return self.default_dry_run if next_dry_run is None else next_dry_run
 
     def exit_on_error(self):
+        next_exit_on_error = self.override("exit_on_error")
         return (
             self.default_exit_on_error
-            if self.next_exit_on_error is None
-            else self.next_exit_on_error
+            if next_exit_on_error is None
+            else next_exit_on_error
         )
 
     def set_verbose(self, verbose):
@@ -36,34 +50,229 @@ class ExecutionContext:
         self.default_dry_run = dry_run
 
     def set_next_verbose(self, next_verbose):
-        self.next_verbose = next_verbose
+        self.next.verbose = next_verbose
 
     def set_next_dry_run(self, next_dry_run):
-        self.next_dry_run = next_dry_run
+        self.next.dry_run = next_dry_run
 
     def set_next_exit_on_error(self, exit_on_error):
-        self.next_exit_on_error = exit_on_error
+        self.next.exit_on_error = exit_on_error
 
 
 class DeployerExecutionContext(ExecutionContext):
-    def __init__(self, verbose=False, dry_run=False, build=True):
-        super().__init__(verbose, dry_run)
+    def __init__(
+        self,
+        verbose=False,
+        dry_run=False,
+        build=True,
+        docker_backend=None,
+        jobs=None,
+        agent=False,
+    ):
+        super().__init__(verbose, dry_run, jobs)
         self.build = build
+        self.docker_backend = docker_backend
+        self.agent = agent
+
+
+class ExecutionResult:
+    """Outcome of a command: exit code, captured outputs and timings (seconds)"""
+
+    def __init__(self, cmd):
+        self.cmd = cmd
+        self.exit_code = 0
+        self.stdout = None
+        self.stderr = None
+        self.wall_time = 0.0
+        self.cpu_time = 0.0
+
+    def description(self):
+        return self.cmd if isinstance(self.cmd, str) else shlex.join(self.cmd)
 
 
 class Executer:
     def __init__(self, exec_context):
         self.exec_context = exec_context
+        self.processes = set()
+        self.writers = dict()
+        self.terminate_listeners = []
+        self.lock = threading.Lock()
+        self.terminated = False
+
+        # Prefix of the outputs of the current thread task (see TaskOutput)
+        self.output = threading.local()
+
+    def output_prefix(self):
+        return getattr(self.output, "prefix", None)
+
+    def set_output_prefix(self, prefix):
+        self.output.prefix = prefix
 
     def run(self, cmd):
-        if self.exec_context.verbose() or self.exec_context.dry_run():
-            print(cmd)
+        return self.execute(cmd).exit_code
+
+    def execute(self, cmd, capture=False, input=None, text=True):
+        """Run a command following the execution context
+
+        `cmd` is run in a shell when it is a string (be aware of possible injection),
+        and directly when it is an argument list. Outputs are streamed to the
+        terminal unless `capture` is set.
+        """
+
+        result = ExecutionResult(cmd)
+
+        def spawn():
+            self.spawn(result, capture, input, text)
+            return result.exit_code
+
+        self.call(result.description(), spawn)
+
+        return result
+
+    def spawn(self, result, capture=False, input=None, text=True):
+        """Run the command of `result` and fill it
+
+        CPU time is measured on the terminated child processes, so it is approximate
+        when several commands run at the same time. Within a task whose outputs are
+        prefixed, both outputs are read and written to `sys.stdout` line by line.
+        """
+
+        prefixed = not capture and self.output_prefix() is not None
+        output = subprocess.PIPE if capture or prefixed else None
+        start_time, start_times = time.monotonic(), os.times()
+
+        with self.lock:
+            if self.terminated:
+                result.exit_code = 128 + SIGINT
+                return result
+
+            process = subprocess.Popen(  # nosec
+                result.cmd,
+                shell=isinstance(result.cmd, str),
+                stdin=subprocess.PIPE if input is not None else None,
+                stdout=output,
+                stderr=subprocess.STDOUT if prefixed else output,
+                universal_newlines=text,
+            )
+            self.processes.add(process)
+
+        try:
+            if prefixed:
+                self.forward(process, input)
+            else:
+                result.stdout, result.stderr = process.communicate(input)
+        finally:
+            with self.lock:
+                self.processes.discard(process)
+
+        end_times = os.times()
+        result.wall_time = time.monotonic() - start_time
+        result.cpu_time = (end_times.children_user - start_times.children_user) + (
+            end_times.children_system - start_times.children_system
+        )
 
-        # Execute the command in a shell (be aware of possible injection in `cmd` var)
-        exit_code = (
-            os.system(cmd) >> 8 if not self.exec_context.dry_run() else 0  # nosec
+        # A command killed by a signal exits like in a shell (128 + signal)
+        result.exit_code = (
+            process.returncode if process.returncode >= 0 else 128 - process.returncode
         )
 
+        if self.exec_context.verbose():
+            print(
+                f"Exited with {result.exit_code} in {result.wall_time:.3f}s "
+                + f"(cpu {result.cpu_time:.3f}s)"
+            )
+
+        return result
+
+    def forward(self, process, input=None):
+        """Write the output of a process to `sys.stdout` until it exits"""
+
+        if input is not None:
+            lines = [process.communicate(input)[0]]
+        else:
+            lines = process.stdout
+
+        for line in lines:
+            sys.stdout.write(
+                line if isinstance(line, str) else line.decode(errors="replace")
+            )
+            sys.stdout.flush()
+
+        process.wait()
+
+    def open(self, cmd, merge_stderr=False, input=None, text=True):
+        """Start a long-running command (e.g. an event stream) and return its process
+
+        Its output is read from `process.stdout`, until `close(process)`, while
+        `input` is written to its standard input. The command runs whatever the
+        execution context, so it must not change anything.
+        """
+
+        with self.lock:
+            if self.terminated:
+                return None
+
+            process = subprocess.Popen(  # nosec
+                cmd,
+                shell=isinstance(cmd, str),
+                stdin=subprocess.PIPE if input is not None else None,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT if merge_stderr else None,
+                universal_newlines=text,
+            )
+            self.processes.add(process)
+
+        if input is not None:
+            # Written aside, the output must be read at the same time
+            def write():
+                try:
+                    with process.stdin:
+                        process.stdin.write(input)
+                except OSError:  # Exited before reading everything
+                    pass
+
+            writer = threading.Thread(target=write, daemon=True)
+            writer.start()
+            self.writers[process] = writer
+
+        return process
+
+    def close(self, process):
+        process.terminate()
+        process.wait()
+        with self.lock:
+            self.processes.discard(process)
+            writer = self.writers.pop(process, None)
+
+        if writer is not None:
+            writer.join()
+
+    def terminate(self):
+        """Terminate the running commands and refuse to start new ones"""
+
+        with self.lock:
+            self.terminated = True
+            for process in self.processes:
+                process.terminate()
+            listeners = list(self.terminate_listeners)
+
+        for listener in listeners:
+            listener()
+
+    def add_terminate_listener(self, listener):
+        """Call `listener()` on termination, to stop work not run as a command"""
+
+        with self.lock:
+            self.terminate_listeners.append(listener)
+
+    def call(self, description, function):
+        """Run `function` following the execution context, as a command would be"""
+
+        if self.exec_context.verbose() or self.exec_context.dry_run():
+            print(description)
+
+        exit_code = function() if not self.exec_context.dry_run() else 0
+
         if self.exec_context.exit_on_error() and exit_code > 0:
             print(f"Exiting caused by a command error with exit code {exit_code}")
             sys.exit(exit_code)
@@ -72,31 +281,216 @@ class Executer:
 
         return exit_code
 
-    def create_taskgroup(self):
-        return TaskGroup(self)
+    def create_scheduler(self, workers=None):
+        return TaskScheduler(self, workers or self.exec_context.jobs)
 
 
-class TaskGroup:
-    def __init__(self, executer):
+class Task:
+
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+
+    def __init__(self, name, target, depends_on, prefix_output=True):
+        self.name = name
+        self.target = target
+        self.depends_on = list(depends_on)
+        self.prefix_output = prefix_output
+        self.state = self.PENDING
+        self.exit_code = None
+
+
+class TaskOutput:
+    """Standard output of the tasks, whose lines are prefixed by the task name
+
+    Installed as `sys.stdout` while tasks run, so that the outputs of parallel tasks
+    interleave by whole lines and can be told apart. Other threads write as is.
+    """
+
+    def __init__(self, stream, executer):
+        self.stream = stream
         self.executer = executer
-        self.tasks = list()
+        self.lock = threading.Lock()
+        self.partial_lines = dict()
 
-    def add_task(self, cmd):
-        self.tasks.append(Task(self.executer, cmd))
-        return self
+    def write(self, text):
+        prefix = self.executer.output_prefix()
+        with self.lock:
+            if prefix is None:
+                return self.stream.write(text)
 
-    def run_tasks(self):
-        signal(SIGINT, lambda sign, frame: [t.task.terminate() for t in self.tasks])
-        [t.task.start() for t in self.tasks]
+            # The end of a line is kept until it is complete
+            thread = threading.get_ident()
+            lines = (self.partial_lines.pop(thread, "") + text).split("\n")
+            if lines[-1] != "":
+                self.partial_lines[thread] = lines[-1]
+            for line in lines[:-1]:
+                self.stream.write(f"[{prefix}] {line}\n")
+
+        return len(text)
+
+    def end_task(self):
+        """Write the incomplete line of the current task, if any"""
+
+        with self.lock:
+            has_partial_line = threading.get_ident() in self.partial_lines
+        if has_partial_line:
+            self.write("\n")
+        self.flush()
+
+    def flush(self):
+        self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+class TaskScheduler:
+    """Run a graph of tasks in threads, each one as soon as its dependencies succeed
+
+    A task target is a command (see `Executer.execute`) or a callable returning an
+    exit code. When a task fails (or raises), the tasks depending on it are
+    cancelled while the other ones keep running. An interruption (SIGINT) terminates
+    the running commands and cancels the pending tasks. Unless disabled per task,
+    each line a task outputs is prefixed by its name (see `TaskOutput`).
+    """
+
+    def __init__(self, executer, workers=None):
+        self.executer = executer
+        self.workers = workers or os.cpu_count() or 1
+        self.tasks = dict()
+        self.interrupted = False
+
+    def add_task(self, name, target, depends_on=(), prefix_output=True):
+        if name in self.tasks:
+            raise Exception(f"Task {name} is already scheduled")
+
+        self.tasks[name] = Task(name, target, depends_on, prefix_output)
         return self
 
-    def join_tasks(self):
-        [t.task.join() for t in self.tasks]
+    def check(self):
+        """Make sure dependencies exist and do not loop"""
 
+        visited = set()
 
-class Task:
-    def __init__(self, executer, cmd):
-        self.task = multiprocessing.Process(
-            target=executer.run,
-            args=(cmd,),
+        def visit(task, path):
+            if task.name in path:
+                raise Exception(f"Circular task dependency: {' -> '.join(path)}")
+            if task.name in visited:
+                return
+            for dependency in task.depends_on:
+                if dependency not in self.tasks:
+                    raise Exception(f"Task {task.name} depends on unknown {dependency}")
+                visit(self.tasks[dependency], path + [task.name])
+            visited.add(task.name)
+
+        for task in self.tasks.values():
+            visit(task, [])
+
+    def perform(self, task, output):
+        if task.prefix_output:
+            self.executer.set_output_prefix(task.name)
+        try:
+            if callable(task.target):
+                return task.target() or 0
+
+            self.executer.exec_context.set_next_exit_on_error(False)
+            return self.executer.execute(task.target).exit_code
+        except SystemExit as e:
+            return e.code if isinstance(e.code, int) else 1
+        except Exception as e:
+            # Failed as a command would, its dependents are cancelled
+            print(f"Task {task.name} raised {type(e).__name__}: {e}")
+            return 1
+        finally:
+            output.end_task()
+            self.executer.set_output_prefix(None)
+
+    def is_ready(self, task):
+        return task.state == Task.PENDING and all(
+            self.tasks[dependency].state == Task.DONE for dependency in task.depends_on
         )
+
+    def cancel(self, tasks):
+        for task in tasks:
+            if task.state == Task.PENDING:
+                task.state = Task.CANCELLED
+
+    def dependents(self, name):
+        return [task for task in self.tasks.values() if name in task.depends_on]
+
+    def interrupt(self, *_):
+        self.interrupted = True
+        self.cancel(self.tasks.values())
+        self.executer.terminate()
+
+    def run_tasks(self):
+        self.check()
+        self.interrupted = False
+        running = dict()
+
+        handler = None
+        if threading.current_thread() is threading.main_thread():
+            handler = getsignal(SIGINT)
+            signal(SIGINT, self.interrupt)
+
+        output = TaskOutput(sys.stdout, self.executer)
+        sys.stdout = output
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                while True:
+                    for task in filter(self.is_ready, self.tasks.values()):
+                        task.state = Task.RUNNING
+                        running[pool.submit(self.perform, task, output)] = task
+
+                    if len(running) == 0:
+                        break
+
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        task = running.pop(future)
+                        task.exit_code = future.result()
+                        task.state = Task.DONE if task.exit_code == 0 else Task.FAILED
+
+                        # Cancel the whole chain of dependent tasks
+                        pending = self.dependents(task.name) if task.exit_code else []
+                        while len(pending) > 0:
+                            dependent = pending.pop()
+                            if dependent.state == Task.PENDING:
+                                dependent.state = Task.CANCELLED
+                                pending += self.dependents(dependent.name)
+        finally:
+            sys.stdout = output.stream
+            if handler is not None:
+                signal(SIGINT, handler)
+
+        return self.exit_code()
+
+    def exit_code(self):
+        if self.interrupted:
+            return 128 + SIGINT
+
+        failures = [t for t in self.tasks.values() if t.state == Task.FAILED]
+        return failures[0].exit_code if len(failures) > 0 else 0
+
+    def run(self):
+        """Run all the tasks, and then exit on failure following the context"""
+
+        exit_code = self.run_tasks()
+
+        for task in self.tasks.values():
+            if Task.FAILED == task.state:
+                print(f"Task {task.name} failed with exit code {task.exit_code}")
+            elif Task.CANCELLED == task.state:
+                print(f"Task {task.name} cancelled")
+
+        if self.executer.exec_context.exit_on_error() and exit_code > 0:
+            print(f"Exiting caused by a task error with exit code {exit_code}")
+            sys.exit(exit_code)
+
+        self.executer.exec_context.cleanup()
+
+        return exit_code
@@ -0,0 +1,154 @@
+import asyncio
+import ctypes
+import re
+import sys
+import time
+
+
+class LogMultiplexer:
+    """Follow the logs of several containers in a single event loop
+
+    Lines are read from the Docker backend, filtered, formatted by a transform
+    (see `LogTransform.format`) and queued in a bounded buffer, then written to
+    the output by batches. The log of a container is followed again when it
+    restarts, while the daemon state is watched (see `DockerStateCache`). Starting
+    to watch it lists the daemon state, which is done in the default executor so
+    as not to block the loop.
+    """
+
+    # Levels by rank, as found in NestJS and Angular CLI outputs
+    LEVELS = {
+        "VERBOSE": 0,
+        "DEBUG": 0,
+        "LOG": 1,
+        "INFO": 1,
+        "WARN": 2,
+        "WARNING": 2,
+        "ERROR": 3,
+        "FATAL": 3,
+    }
+    LEVEL_PATTERN = re.compile(r"\b(" + "|".join(LEVELS) + r")\b")
+    BATCH_SIZE = 256
+
+    def __init__(
+        self, docker, since, level=None, pattern=None, buffer_size=1024, output=None
+    ):
+        self.docker = docker
+        self.since = since
+        self.level = self.LEVELS[level.upper()] if level else None
+        self.pattern = re.compile(pattern) if pattern else None
+        self.buffer_size = buffer_size
+        self.output = output or sys.stdout
+        self.containers = []
+        self.loop = None
+        self.task = None
+
+    def add(self, container, transform):
+        self.containers.append((container, transform))
+        return self
+
+    def line_level(self, line, previous=None):
+        """Rank of the level of a line
+
+        Lines without level (e.g. stack traces) have the level of the previous line.
+        """
+
+        match = self.LEVEL_PATTERN.search(line)
+        return self.LEVELS[match.group(1)] if match else previous
+
+    def accept(self, line, level=None):
+        if self.pattern is not None and not self.pattern.search(line):
+            return False
+
+        # Lines before the first level are kept
+        return self.level is None or level is None or level >= self.level
+
+    def run(self):
+        """Follow the logs until every container is removed (or stopped if unwatched)"""
+
+        enable_ansi_colors()
+        try:
+            asyncio.run(self.follow_all())
+        except asyncio.CancelledError:
+            pass
+        return 0
+
+    def stop(self):
+        """Stop following logs, from any thread"""
+
+        if self.loop is not None and self.task is not None:
+            self.loop.call_soon_threadsafe(self.task.cancel)
+
+    async def follow_all(self):
+        self.loop = asyncio.get_running_loop()
+        self.task = asyncio.current_task()
+
+        cache = await self.loop.run_in_executor(None, self.docker.watch)
+        queue = asyncio.Queue(self.buffer_size)
+        writer = asyncio.ensure_future(self.write(queue))
+        try:
+            await asyncio.gather(
+                *[self.follow(queue, cache, c, t) for c, t in self.containers]
+            )
+            await queue.put(None)
+            await writer
+        finally:
+            writer.cancel()
+
+    async def follow(self, queue, cache, container, transform):
+        changed = asyncio.Event()
+
+        def on_event(event):
+            actor = event.get("Actor") or {}
+            if container == (actor.get("Attributes") or {}).get("name"):
+                self.loop.call_soon_threadsafe(changed.set)
+
+        unsubscribe = cache.subscribe(on_event)
+        since = self.since
+        level = None  # Of the last line of the container
+        try:
+            while True:
+                async for line in self.docker.follow_logs(container, since):
+                    level = self.line_level(line, level)
+                    if self.accept(line, level):
+                        await queue.put(transform.format(line))
+                since = int(time.time())
+
+                # Wait for a restart, as long as the container exists
+                while True:
+                    changed.clear()
+                    if not cache.is_fresh() or not cache.container_exists(container):
+                        return
+                    if cache.is_running(container):
+                        break
+                    try:
+                        await asyncio.wait_for(changed.wait(), 1)
+                    except asyncio.TimeoutError:
+                        pass
+        finally:
+            unsubscribe()
+
+    async def write(self, queue):
+        while True:
+            batch = [await queue.get()]
+            while not queue.empty() and len(batch) < self.BATCH_SIZE:
+                batch.append(queue.get_nowait())
+
+            self.output.write("".join(line for line in batch if line is not None))
+            self.output.flush()
+
+            if None in batch:
+                return
+
+
+def enable_ansi_colors():
+    """Windows consoles only interpret ANSI colors once asked to"""
+
+    if "win32" != sys.platform or not hasattr(ctypes, "windll"):
+        return
+
+    kernel32 = ctypes.windll.kernel32
+    handle = kernel32.GetStdHandle(-11)  # STD_OUTPUT_HANDLE
+    mode = ctypes.c_ulong()
+    if kernel32.GetConsoleMode(handle, ctypes.byref(mode)):
+        kernel32.SetConsoleMode(handle, mode.value | 0x0004)  # VIRTUAL_TERMINAL
@@ -0,0 +1,242 @@
+import hashlib
+import json
+import os
+import tarfile
+import time
+
+
+class NodeModulesSync:
+    """Copy the node_modules of a container to the local project, incrementally
+
+    The copy is skipped while the dependency files (package.json, yarn.lock) are
+    unchanged since the last one. Otherwise, the manifests (path and hash) of both
+    sides are compared and only the added or changed files are transferred, as one
+    archive streamed from the container. Local hashes are kept with the file sizes
+    and modification times, to only hash the files changed since the last copy.
+    """
+
+    STATE_FILE = ".compose-sync.json"
+    DEPENDENCY_FILES = ["package.json", "yarn.lock"]
+    # Members are checked beforehand (see is_safe), keep the default permissions
+    EXTRACT_OPTIONS = {"filter": "tar"} if hasattr(tarfile, "tar_filter") else {}
+    # No output without node_modules (e.g. dependencies still being installed)
+    MANIFEST_SCRIPT = (
+        '[ -d "$1" ] || exit 0; '
+        + 'cd "$1" && find . -type f -exec sha1sum {} + '
+        + "&& find . -type l -exec sh -c "
+        + """'for l; do printf "L\\t%s\\t%s\\n" "$(readlink "$l")" "$l"; done' """
+        + "sh {} +"
+    )
+
+    def __init__(self, executer, container, remote_project, local_project):
+        self.executer = executer
+        self.container = container
+        self.remote_directory = f"{remote_project}/node_modules"
+        self.local_project = local_project
+        self.local_directory = os.path.join(local_project, "node_modules")
+        self.state_path = os.path.join(self.local_directory, self.STATE_FILE)
+
+    def run(self):
+        return self.executer.call(
+            f"sync {self.container}:{self.remote_directory} {self.local_directory}",
+            self.sync,
+        )
+
+    def sync(self):
+        start_time = time.monotonic()
+        state = self.load_state()
+        dependencies = self.dependencies_digest()
+
+        if state.get("dependencies") == dependencies:
+            print(f"{self.local_directory} is up to date")
+            return 0
+
+        remote = self.remote_manifest()
+        if remote is None:
+            return 1
+        if len(remote) == 0:
+            print(f"No {self.remote_directory} in {self.container} yet")
+            return 0
+
+        local = self.local_manifest(state.get("files", {}))
+        changed = sorted(
+            path for path, digest in remote.items() if local.get(path) != digest
+        )
+
+        transferred = self.transfer(changed) if len(changed) > 0 else 0
+        if transferred is None:
+            return 1
+
+        removed = [path for path in local if path not in remote]
+        for path in removed:
+            os.remove(os.path.join(self.local_directory, path))
+
+        self.save_state(dependencies, remote)
+        print(
+            f"{self.local_directory}: {len(changed)} files updated, "
+            + f"{len(removed)} removed, {transferred / 1e6:.1f} MB transferred "
+            + f"in {time.monotonic() - start_time:.1f}s"
+        )
+        return 0
+
+    def dependencies_digest(self):
+        digest = hashlib.sha256()
+        for name in self.DEPENDENCY_FILES:
+            path = os.path.join(self.local_project, name)
+            if os.path.exists(path):
+                with open(path, "rb") as f:
+                    digest.update(f.read())
+
+        return digest.hexdigest()
+
+    def remote_manifest(self):
+        """Digest of every file of the container node_modules by path
+
+        Files are digested with SHA-1, symbolic links (e.g. .bin) by their target.
+        """
+
+        self.executer.exec_context.set_next_exit_on_error(False)
+        result = self.executer.execute(
+            ["docker", "exec", self.container, "sh", "-c", self.MANIFEST_SCRIPT]
+            + ["sh", self.remote_directory],
+            capture=True,
+        )
+        if result.exit_code != 0:
+            return None
+
+        manifest = {}
+        for line in (result.stdout or "").splitlines():
+            if line.startswith("L\t"):
+                _, target, path = line.split("\t", 2)
+                manifest[os.path.normpath(path)] = f"-> {target}"
+            elif line:
+                digest, path = line.split("  ", 1)
+                manifest[os.path.normpath(path)] = digest
+
+        return manifest
+
+    def local_manifest(self, previous):
+        """Same as `remote_manifest` for the local files, unchanged ones (size and
+        modification time) being taken from the `previous` synchronization"""
+
+        manifest = {}
+        for root, directories, names in os.walk(self.local_directory):
+            links = [name for name in directories if os.path.islink(f"{root}/{name}")]
+            for name in names + links:
+                full_path = os.path.join(root, name)
+                path = os.path.relpath(full_path, self.local_directory)
+                if self.STATE_FILE == path:
+                    continue
+
+                if os.path.islink(full_path):
+                    manifest[path] = f"-> {os.readlink(full_path)}"
+                    continue
+
+                stat = os.stat(full_path)
+                known = previous.get(path)
+                if known is not None and known[:2] == [stat.st_size, stat.st_mtime_ns]:
+                    manifest[path] = known[2]
+                    continue
+
+                with open(full_path, "rb") as f:
+                    manifest[path] = hashlib.sha1(f.read()).hexdigest()  # nosec
+
+        return manifest
+
+    def transfer(self, paths):
+        """Stream the files as a tar archive and return the transferred bytes"""
+
+        process = self.executer.open(
+            ["docker", "exec", "-i", self.container]
+            + ["tar", "-cf", "-", "-C", self.remote_directory, "-T", "-"],
+            input="\n".join(paths).encode() + b"\n",
+            text=False,
+        )
+        if process is None:
+            return None
+
+        stream = CountingReader(process.stdout)
+        try:
+            with tarfile.open(fileobj=stream, mode="r|") as archive:
+                for member in archive:
+                    if not self.is_safe(member):
+                        print(f"Unexpected archive member {member.name}")
+                        return None
+
+                    # Replace files and links instead of writing to their targets
+                    # (a hard link shares its content with another file)
+                    path = os.path.join(self.local_directory, member.name)
+                    if not member.isdir() and (
+                        os.path.islink(path) or os.path.isfile(path)
+                    ):
+                        os.remove(path)
+
+                    archive.extract(
+                        member, self.local_directory, **self.EXTRACT_OPTIONS
+                    )
+
+            # A complete archive does not mean tar succeeded (e.g. unreadable file)
+            while stream.read(65536):
+                pass
+            exit_code = process.wait()
+        except tarfile.TarError as e:
+            print(f"Failed to synchronize {self.local_directory}: {e}")
+            return None
+        finally:
+            self.executer.close(process)
+
+        if exit_code != 0:
+            print(f"Failed to archive {self.remote_directory} (exit code {exit_code})")
+            return None
+
+        return stream.count
+
+    @staticmethod
+    def is_safe(member):
+        """Whether the member stays in the extraction directory"""
+
+        paths = [member.name]
+        if member.issym():
+            paths.append(os.path.join(os.path.dirname(member.name), member.linkname))
+        elif member.islnk():
+            # Hard links target a file archived before, relative to the archive
+            paths.append(member.linkname)
+        elif not member.isfile() and not member.isdir():
+            return False
+
+        return all(
+            not os.path.isabs(path) and not os.path.normpath(path).startswith("..")
+            for path in paths
+        )
+
+    def load_state(self):
+        try:
+            with open(self.state_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save_state(self, dependencies, remote):
+        files = {}
+        for path, digest in remote.items():
+            full_path = os.path.join(self.local_directory, path)
+            if os.path.isfile(full_path) and not os.path.islink(full_path):
+                stat = os.stat(full_path)
+                files[path] = [stat.st_size, stat.st_mtime_ns, digest]
+
+        os.makedirs(self.local_directory, exist_ok=True)
+        with open(self.state_path, "w") as f:
+            json.dump({"dependencies": dependencies, "files": files}, f)
+
+
+class CountingReader:
+    """File-like reader counting the bytes read"""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.count = 0
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.count += len(data)
+        return data
@@ -1,8 +1,17 @@
+import io
+import shlex
+import subprocess  # nosec
 import sys
 
 import pytest
 
 
+@pytest.fixture(autouse=True)
+def docker_backend(monkeypatch):
+    """Use the docker CLI backend (mocked system calls) unless a test says otherwise"""
+    monkeypatch.setenv("DEVTUTO_DOCKER_BACKEND", "cli")
+
+
 @pytest.fixture()
 def is_tty(mocker, is_tty=False):
     return mocker.patch("utils.Utils.is_tty", return_value=is_tty)
@@ -23,32 +32,54 @@ def system(mocker, is_tty, sys_platform):
 
     class MockedSystem:
         def __init__(self):
-            self.open = mocker.patch("builtins.open", mocker.mock_open(read_data="0"))
-            self.os_system = mocker.patch("os.system", side_effect=self.os_system_call)
-            self.os_remove = mocker.patch("os.remove")
+            self.popen = mocker.patch("subprocess.Popen", side_effect=self.subprocess)
             self.sys_platform = sys_platform
             self.is_tty = is_tty
             self.calls = []
-            self.os_system_listeners = []
-            self.add_os_system_listener(self.register_system_calls)
+            self.processes = []
+            self.outputs = {}
+            self.subprocess_listeners = []
+            self.add_subprocess_listener(self.register_system_calls)
 
         def register_system_calls(self, call, exit_code):
             self.calls.append(call)
             return exit_code
 
-        def os_system_call(self, *args, **kwargs):
-            """os.system mock callback"""
+        def subprocess(self, args, **kwargs):
+            """subprocess.Popen mock callback"""
 
-            call = args[0]
+            call = args if isinstance(args, str) else shlex.join(args)
             exit_code = 0
 
-            for listener in self.os_system_listeners:
+            for listener in self.subprocess_listeners:
                 exit_code = listener(call, exit_code)
 
-            return exit_code << 8
+            stdout = stderr = None
+            if kwargs.get("stdout") == subprocess.PIPE:
+                stdout = next(
+                    (out for cmd, out in self.outputs.items() if call.startswith(cmd)),
+                    "",
+                )
+                stderr = ""
+                if not kwargs.get("universal_newlines"):
+                    stdout = stdout if isinstance(stdout, bytes) else stdout.encode()
+                    stderr = stderr.encode()
+
+            process = mocker.MagicMock(returncode=exit_code)
+            process.communicate.return_value = (stdout, stderr)
+            process.wait.return_value = exit_code
+            process.stdout = (
+                io.StringIO(stdout) if isinstance(stdout, str) else io.BytesIO(stdout)
+            )
+            self.processes.append(process)
+            return process
+
+        def add_subprocess_listener(self, listener):
+            self.subprocess_listeners.append(listener)
 
-        def add_os_system_listener(self, listener):
-            self.os_system_listeners.append(listener)
+        def set_output(self, startswith, output):
+            """Output of the commands starting with `startswith`"""
+            self.outputs[startswith] = output
 
     return MockedSystem()
 
@@ -24,7 +24,7 @@ def test_help(cmd, helper):
 def test_deploy(system, cmd):
     main(cmd)
 
-    assert system.os_system.called
+    assert system.popen.called
 
 
 @pytest.mark.parametrize(
@@ -36,7 +36,7 @@ def test_deploy(system, cmd):
 def test_deployer(system, cmd):
     main(cmd)
 
-    assert system.os_system.called
+    assert system.popen.called
 
 
 def test_deployer_missing_exec_command(helper):
@@ -65,11 +65,23 @@ def test_deployer_missing_exec_command(helper):
     ],
 )
 @mock.patch("webbrowser.open")
-def test_dockerize(webbrowser_open, system, platform, cmd):
+def test_dockerize(webbrowser_open, system, platform, cmd, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
     with mock.patch.object(sys, "platform", platform):
         main(cmd)
 
-    assert system.os_system.called
+    assert system.popen.called
+
+
+@mock.patch("webbrowser.open")
+def test_dockerize_single_playbook_run(webbrowser_open, system, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    main(["dockerize", "dev", "--tags", "cleanup"])
+
+    runs = [c for c in system.calls if "build.yml" in c]
+    assert len(runs) == 1
+    assert "--tags=cleanup" in runs[0]
+    assert "build.yml run.yml healthcheck.yml" in runs[0]
 
 
 def test_docs_missing_subcommand(helper):
@@ -83,10 +95,6 @@ def test_docs_missing_subcommand(helper):
     [
         (["docs", "generate"], True),
         (["docs", "generate"], False),
-        (["docs", "generate", "-f"], True),
-        (["docs", "generate", "-f"], False),
-        (["docs", "generate", "--force"], True),
-        (["docs", "generate", "--force"], False),
         (["docs", "start"], True),
         (["docs", "start"], False),
         (["docs", "stop"], True),
@@ -96,7 +104,24 @@ def test_docs_missing_subcommand(helper):
 def test_docs(system, cmd, is_tty):
     main(cmd)
 
-    assert system.os_system.called
+    assert system.popen.called
+
+
+@pytest.mark.parametrize("option", ["-f", "--force"])
+def test_docs_generate_force(system, option):
+    main(["docs", "generate", option])
+
+    runs = [c for c in system.calls if "docsgen.yml" in c]
+    assert len(runs) == 1
+    assert "-e docsgen_force=yes" in runs[0]
+
+
+def test_docs_generate_not_forced(system):
+    main(["docs", "generate"])
+
+    runs = [c for c in system.calls if "docsgen.yml" in c]
+    assert len(runs) == 1
+    assert "docsgen_force" not in runs[0]
 
 
 @pytest.mark.parametrize(
@@ -112,13 +137,38 @@ def test_docs(system, cmd, is_tty):
 def test_lint(system, cmd):
     main(cmd)
 
-    assert system.os_system.called
+    assert system.popen.called
+
+
+def test_lint_independent_runs(system):
+    main(["lint", "--cleanup"])
+
+    runs = sorted(c for c in system.calls if "quality_check.yml" in c)
+    assert len(runs) == 2
+    assert "--tags=ansible" in runs[0]
+    assert "--tags=cleanup,linter" in runs[1]
 
 
 def test_package(system):
     main(["package"])
 
-    assert system.os_system.called
+    assert system.popen.called
+
+
+def test_package_single_playbook_run(system):
+    main(["package"])
+
+    runs = [c for c in system.calls if "package.yml" in c]
+    assert len(runs) == 1
+    assert "build.yml run.yml package.yml" in runs[0]
+
+
+def test_package_push_after_packaging(system):
+    main(["package"])
+
+    package = next(i for i, c in enumerate(system.calls) if "package.yml" in c)
+    push = next(i for i, c in enumerate(system.calls) if "docker push" in c)
+    assert package < push
 
 
 def test_package_autologin(system, monkeypatch):
@@ -127,14 +177,14 @@ def test_package_autologin(system, monkeypatch):
 
     main(["package"])
 
-    assert system.os_system.called
+    assert system.popen.called
 
 
 @pytest.mark.parametrize("cmd", [["prune"], ["prune", "-f"], ["prune", "--force"]])
 def test_prune(system, cmd, helper):
     main(cmd)
 
-    assert system.os_system.called
+    assert system.popen.called
     helper.assert_syscall("docker system prune")
 
 
@@ -151,9 +201,24 @@ def test_deployer_unittest_missing_role(helper):
         ["test-deployer", "build-api", "--scenario", "default"],
         ["test-deployer", "--all"],
         ["test-deployer", "--all", "--scenario", "default"],
+        ["test-deployer", "--all", "--jobs", "4"],
+        ["test-deployer", "--changed"],
     ],
 )
 def test_deployer_unittest(system, cmd):
     main(cmd)
 
-    assert system.os_system.called
+    assert system.popen.called
+
+
+def test_deployer_unittest_jobs(system):
+    main(["test-deployer", "build-api", "--jobs", "4"])
+
+    command = system.popen.call_args[0][0]
+    assert "--jobs 4 build-api" in command
+
+
+def test_deployer_unittest_changed(system):
+    main(["test-deployer", "--changed"])
+
+    assert "unit-tests.py --command test --changed" in system.popen.call_args[0][0]
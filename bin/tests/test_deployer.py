@@ -1,7 +1,34 @@
+import io
+import json
+import socket
+import struct
+import threading
+
 import pytest
-from deployer import Deployer, DeployerShellCommandBuilder
+from agent import AgentClient
+from docker import BuildContext, DockerStateCache
+from deployer import (
+    DarwinDeployer,
+    Deployer,
+    DeployerPlaybookCommandBuilder,
+    DeployerShellCommandBuilder,
+)
 from executer import DeployerExecutionContext, Executer
 
+IMAGE = {"Id": "sha256:new", "RepoTags": ["tzimy/dev-tutorial-deployer:latest"]}
+
+
+def container(image_id="sha256:new", running=True):
+    return {
+        "Name": "/dev-tutorial-deployer",
+        "Image": image_id,
+        "State": {"Running": running},
+    }
+
+
+def inspect_output(*objects):
+    return "\n".join(json.dumps(obj) for obj in objects)
+
 
 @pytest.fixture()
 def deployer():
@@ -9,22 +36,16 @@ def deployer():
     return Deployer(executer)
 
 
-def deployer_not_running(cmd, exit_code):
-    if cmd.startswith("docker container inspect"):
-        return 1
-    return exit_code
-
-
 def test_stop(deployer, helper):
     # WHEN
     deployer.stop()
 
     # THEN
-    helper.assert_syscall("docker stop")
+    helper.assert_any_syscall("docker stop")
 
 
 def test_run(deployer, helper):
-    helper.system.add_os_system_listener(deployer_not_running)
+    helper.system.set_output("docker inspect", inspect_output(IMAGE))
 
     deployer.run(DeployerShellCommandBuilder())
 
@@ -34,7 +55,298 @@ def test_run(deployer, helper):
 
 
 def test_run_already_running(deployer, helper):
+    helper.system.set_output("docker inspect", inspect_output(IMAGE, container()))
+
     deployer.run(DeployerShellCommandBuilder())
 
     helper.assert_any_syscall("docker build")
     helper.assert_syscall("docker exec")
+    assert not any(call.startswith("docker run") for call in helper.system.calls)
+    assert not any(call.startswith("docker stop") for call in helper.system.calls)
+
+
+def test_run_outdated(deployer, helper):
+    helper.system.set_output(
+        "docker inspect", inspect_output(IMAGE, container("sha256:old"))
+    )
+
+    deployer.run(DeployerShellCommandBuilder())
+
+    helper.assert_any_syscall("docker rm --force dev-tutorial-deployer")
+    helper.assert_any_syscall("docker run")
+    helper.assert_syscall("docker exec")
+    assert not any(call.startswith("docker start") for call in helper.system.calls)
+
+
+def test_run_outdated_stopped(deployer, helper):
+    helper.system.set_output(
+        "docker inspect", inspect_output(IMAGE, container("sha256:old", running=False))
+    )
+
+    deployer.run(DeployerShellCommandBuilder())
+
+    helper.assert_any_syscall("docker rm --force dev-tutorial-deployer")
+    helper.assert_any_syscall("docker run")
+    assert not any(call.startswith("docker start") for call in helper.system.calls)
+
+
+def test_run_stopped(deployer, helper):
+    helper.system.set_output(
+        "docker inspect", inspect_output(IMAGE, container(running=False))
+    )
+
+    deployer.run(DeployerShellCommandBuilder())
+
+    helper.assert_any_syscall("docker start dev-tutorial-deployer")
+    assert not any(call.startswith("docker run") for call in helper.system.calls)
+
+
+def test_run_inspects_in_one_query(deployer, helper):
+    helper.system.set_output("docker inspect", inspect_output(IMAGE, container()))
+
+    deployer.run(DeployerShellCommandBuilder())
+
+    inspections = [c for c in helper.system.calls if c.startswith("docker inspect")]
+    assert len(inspections) == 2  # the snapshot, then the image after the build
+    assert inspections[0].endswith(" dev-tutorial-deployer")
+    assert inspections[1].endswith(" tzimy/dev-tutorial-deployer")
+
+
+@pytest.fixture()
+def agent(tmp_path, deployer, monkeypatch):
+    """Fake deployer agent answering every job with an output and an exit code"""
+
+    class FakeAgent:
+        def __init__(self):
+            self.jobs = []
+            self.exit_code = 0
+            self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.server.bind(str(tmp_path / "agent.sock"))
+            self.server.listen()
+            threading.Thread(target=self.serve, daemon=True).start()
+
+        def serve(self):
+            while True:
+                connection, _ = self.server.accept()
+                with connection, connection.makefile("rb") as stream:
+                    job = stream.readline()
+                    if not job:
+                        continue
+                    self.jobs.append(json.loads(job))
+                    connection.sendall(b"o" + struct.pack(">L", 3) + b"ok\n")
+                    exit_code = str(self.exit_code).encode()
+                    connection.sendall(b"x" + struct.pack(">L", len(exit_code)))
+                    connection.sendall(exit_code)
+
+    monkeypatch.setenv("DEVTUTO_DEPLOYER_AGENT", "1")
+    monkeypatch.setattr(AgentClient, "SUPPORTED", True)
+    deployer.agent = AgentClient(str(tmp_path / "agent.sock"))
+    return FakeAgent()
+
+
+def playbook():
+    return (
+        DeployerPlaybookCommandBuilder()
+        .add_inventory("dev")
+        .add_extra_var("name", "value")
+        .add_tag("build")
+        .add_playbook("dockerize")
+    )
+
+
+def test_build_argv():
+    assert playbook().set_verbosity(2).build_argv() == [
+        "ansible-playbook",
+        *("-i", "../hosts.yml", "-i", "../inventories/dev.yml"),
+        *("-e", "name=value", "--tags=build", "-vv", "dockerize.yml"),
+    ]
+
+
+def test_run_with_agent(deployer, agent, helper):
+    helper.system.set_output("docker inspect", inspect_output(IMAGE, container()))
+
+    deployer.run(playbook())
+
+    assert not any(call.startswith("docker exec") for call in helper.system.calls)
+    assert agent.jobs[0]["argv"] == playbook().build_argv()
+
+
+def test_run_with_agent_error(deployer, agent, helper):
+    helper.system.set_output("docker inspect", inspect_output(IMAGE, container()))
+    agent.exit_code = 2
+
+    with pytest.raises(SystemExit) as e:
+        deployer.run(playbook())
+
+    assert e.value.code == 2
+
+
+def test_run_without_agent_listening(deployer, helper, tmp_path, monkeypatch):
+    helper.system.set_output("docker inspect", inspect_output(IMAGE, container()))
+    monkeypatch.setenv("DEVTUTO_DEPLOYER_AGENT", "1")
+    deployer.agent = AgentClient(str(tmp_path / "agent.sock"))
+
+    deployer.run(playbook())
+
+    helper.assert_syscall("docker exec")
+
+
+def test_start_with_agent(deployer, agent, helper):
+    deployer.start()
+
+    helper.assert_any_syscall("docker run")
+    assert any("agent.py --socket" in call for call in helper.system.calls)
+
+
+def test_start_with_agent_fact_cache(deployer, agent, helper, monkeypatch):
+    def runs():
+        return [c for c in helper.system.calls if c.startswith("docker run")]
+
+    deployer.start()
+    assert "DEPLOYER_AGENT_FACT_CACHE" not in runs()[-1]
+
+    monkeypatch.setenv("DEVTUTO_DEPLOYER_AGENT_FACT_CACHE", "yes")
+    deployer.start()
+    assert "-e DEPLOYER_AGENT_FACT_CACHE=yes" in runs()[-1]
+
+
+def test_agent_client_streams_output(agent):
+    output = io.BytesIO()
+
+    exit_code = AgentClient(agent.server.getsockname()).run(["true"], output)
+
+    assert exit_code == 0
+    assert output.getvalue() == b"ok\n"
+
+
+def test_run_prepares_once(deployer, helper):
+    helper.system.set_output("docker inspect", inspect_output(IMAGE, container()))
+
+    deployer.run(DeployerShellCommandBuilder())
+    deployer.run(DeployerShellCommandBuilder().set_login_required(True))
+    deployer.run(DeployerShellCommandBuilder().set_login_required(True))
+
+    builds = [c for c in helper.system.calls if c.startswith("docker build")]
+    logins = [c for c in helper.system.calls if "docker login" in c]
+    execs = [c for c in helper.system.calls if c.startswith("docker exec")]
+    assert len(builds) == 1
+    assert len(logins) == 1
+    assert len(execs) == 4  # 3 commands and the login
+
+
+def test_run_all_merges_playbooks(deployer, helper):
+    helper.system.set_output("docker inspect", inspect_output(IMAGE, container()))
+
+    deployer.run_all(
+        [
+            DeployerPlaybookCommandBuilder().add_playbook("build"),
+            DeployerPlaybookCommandBuilder().add_playbook("run"),
+            DeployerPlaybookCommandBuilder().add_playbook("lint").add_tag("cleanup"),
+        ]
+    )
+
+    execs = [c for c in helper.system.calls if c.startswith("docker exec")]
+    assert len(execs) == 2
+    assert "build.yml run.yml" in execs[0]
+    assert "--tags=cleanup" in execs[1]
+
+
+def test_merge_requires_same_options():
+    builder = DeployerPlaybookCommandBuilder().add_playbook("build")
+
+    assert builder.can_merge(DeployerPlaybookCommandBuilder().add_playbook("run"))
+    assert not builder.can_merge(playbook())
+    assert not builder.can_merge(DeployerShellCommandBuilder())
+    with pytest.raises(Exception):
+        builder.merge(playbook())
+
+
+@pytest.fixture()
+def build_directory(tmp_path, monkeypatch):
+    (tmp_path / "dev-tutorial-deployer").mkdir()
+    (tmp_path / "dev-tutorial-deployer" / "Dockerfile").write_text("FROM alpine")
+    monkeypatch.chdir(tmp_path)
+    return BuildContext(Deployer.BUILD_DIRECTORY)
+
+
+def test_build_labels_fingerprint(deployer, helper, build_directory):
+    helper.system.set_output("docker inspect", inspect_output(IMAGE, container()))
+
+    deployer.run(DeployerShellCommandBuilder())
+
+    helper.assert_any_syscall(
+        "docker build -t tzimy/dev-tutorial-deployer --label "
+        + f"dev-tutorial.fingerprint={build_directory.fingerprint()} -"
+    )
+
+
+def test_build_skipped_when_up_to_date(deployer, helper, build_directory):
+    image = dict(
+        IMAGE,
+        Config={"Labels": {Deployer.FINGERPRINT_LABEL: build_directory.fingerprint()}},
+    )
+    helper.system.set_output("docker inspect", inspect_output(image, container()))
+
+    deployer.run(DeployerShellCommandBuilder())
+
+    assert not any(call.startswith("docker build") for call in helper.system.calls)
+    inspections = [c for c in helper.system.calls if c.startswith("docker inspect")]
+    assert len(inspections) == 1
+    helper.assert_syscall("docker exec")
+
+
+def test_refresh_state_from_cache(deployer, helper, monkeypatch):
+    helper.system.set_output(
+        "docker inspect", inspect_output(IMAGE, dict(container(), Id="c1"))
+    )
+    deployer.refresh_state()
+    cache = DockerStateCache(deployer.docker)
+    cache.images = {"tzimy/dev-tutorial-deployer:latest": "sha256:new"}
+    cache.containers = {"dev-tutorial-deployer": {"Id": "c1", "Running": False}}
+    cache.fresh = True
+    monkeypatch.setattr(deployer.docker, "cached", lambda: cache)
+    helper.system.calls.clear()
+
+    state = deployer.refresh_state()
+
+    assert helper.system.calls == []
+    assert state.image_id() == "sha256:new"
+    assert state.container_exists() and not state.is_running()
+
+    cache.containers = {}
+    assert not deployer.refresh_state().container_exists()
+    assert helper.system.calls == []
+
+
+@pytest.mark.parametrize(
+    "sidecar,expected",
+    [
+        ({"Id": "a", "Running": True}, []),
+        ({"Id": "a", "Running": False}, ["docker start tcp-connect"]),
+        (None, ["docker run"]),
+    ],
+)
+def test_darwin_sidecar_from_cache(helper, monkeypatch, sidecar, expected):
+    deployer = DarwinDeployer(Executer(DeployerExecutionContext()))
+    cache = DockerStateCache(deployer.docker)
+    cache.containers = {"tcp-connect": sidecar} if sidecar else {}
+    cache.fresh = True
+    monkeypatch.setattr(deployer.docker, "watch", lambda: cache)
+
+    deployer.prepare()
+
+    calls = [c for c in helper.system.calls if not c.startswith("docker inspect")]
+    assert len(calls) == len(expected)
+    for call, startswith in zip(calls, expected):
+        assert call.startswith(startswith)
+
+
+def test_darwin_running_sidecar_without_cache(helper, monkeypatch):
+    deployer = DarwinDeployer(Executer(DeployerExecutionContext()))
+    cache = DockerStateCache(deployer.docker)
+    monkeypatch.setattr(deployer.docker, "watch", lambda: cache)
+    helper.system.set_output("docker container inspect", '{"Running": true}')
+
+    deployer.prepare()
+
+    assert not any(c.startswith("docker run") for c in helper.system.calls)
@@ -0,0 +1,485 @@
+import io
+import json
+import struct
+import tarfile
+
+import pytest
+from docker import (
+    BuildContext,
+    Docker,
+    DockerApi,
+    DockerApiError,
+    DockerEvents,
+    DockerExecBuilder,
+    DockerFactory,
+    DockerRunBuilder,
+    DockerStateCache,
+)
+from executer import DeployerExecutionContext, Executer
+
+
+class FakeResponse(io.BytesIO):
+    def __iter__(self):
+        return iter(self.readlines())
+
+
+class FakeClient:
+    """Record Engine API calls and answer them from a routing table"""
+
+    def __init__(self, routes=None):
+        self.routes = routes or {}
+        self.calls = []
+
+    def answer(self, method, path, params, body):
+        self.calls.append((method, path, params, body))
+        answer = self.routes.get((method, path), {})
+        if isinstance(answer, list):
+            answer = answer.pop(0)
+        if isinstance(answer, Exception):
+            raise answer
+        return answer
+
+    def request(self, method, path, params=None, body=None, headers=None):
+        return self.answer(method, path, params, body)
+
+    def stream(self, method, path, params=None, body=None, headers=None):
+        return FakeResponse(self.answer(method, path, params, body) or b"")
+
+
+@pytest.fixture()
+def executer():
+    return Executer(DeployerExecutionContext())
+
+
+def test_factory_backend_option(executer):
+    executer.exec_context.docker_backend = "api"
+    assert isinstance(DockerFactory().create(executer), DockerApi)
+
+    executer.exec_context.docker_backend = "cli"
+    assert type(DockerFactory().create(executer)) is Docker
+
+
+def test_factory_backend_environment(executer, monkeypatch):
+    monkeypatch.setenv("DEVTUTO_DOCKER_BACKEND", "api")
+    assert isinstance(DockerFactory().create(executer), DockerApi)
+
+
+def test_factory_shares_the_client(executer):
+    executer.exec_context.docker_backend = "api"
+    first = DockerFactory().create(executer)
+    second = DockerFactory().create(executer)
+
+    assert first.client is second.client
+
+
+def test_run_builder_config():
+    name, config = (
+        DockerRunBuilder()
+        .set_name("tcp-connect")
+        .set_image("alpine/socat")
+        .set_daemon()
+        .bind_port(2375)
+        .add_env("HOST_SYSTEM", "linux")
+        .add_volume("/var/run/docker.sock", "/var/run/docker.sock")
+        .add_network("host")
+        .set_command("tcp-listen:2375,fork unix-connect:/var/run/docker.sock")
+        .build_config()
+    )
+
+    assert name == "tcp-connect"
+    assert config["Cmd"] == [
+        "tcp-listen:2375,fork",
+        "unix-connect:/var/run/docker.sock",
+    ]
+    assert config["Env"] == ["HOST_SYSTEM=linux"]
+    assert config["HostConfig"]["AutoRemove"]
+    assert config["HostConfig"]["Binds"] == [
+        "/var/run/docker.sock:/var/run/docker.sock"
+    ]
+    assert config["HostConfig"]["PortBindings"] == {"2375/tcp": [{"HostPort": "2375"}]}
+    assert config["HostConfig"]["NetworkMode"] == "host"
+
+
+def test_exec_builder_config(monkeypatch):
+    monkeypatch.setenv("DOCKER_USERNAME", "jimmy")
+    config = (
+        DockerExecBuilder()
+        .set_container("dev-tutorial-deployer")
+        .set_command('docker login --username $DOCKER_USERNAME "-e a=b"')
+        .set_interactive(False)
+        .build_config()
+    )
+
+    assert config["Cmd"] == ["docker", "login", "--username", "jimmy", "-e a=b"]
+    assert not config["AttachStdin"]
+
+
+def test_run(executer):
+    client = FakeClient({("POST", "/containers/create"): {"Id": "abc"}})
+    docker = DockerApi(executer, client)
+
+    builder = DockerRunBuilder().set_name("c").set_image("i").set_daemon()
+    assert docker.run(builder) == 0
+    assert [call[:2] for call in client.calls] == [
+        ("POST", "/containers/create"),
+        ("POST", "/containers/abc/start"),
+    ]
+
+
+def test_run_pulls_missing_image(executer):
+    client = FakeClient(
+        {
+            ("POST", "/containers/create"): [
+                DockerApiError(404, "No such image"),
+                {"Id": "abc"},
+            ],
+            ("POST", "/images/create"): b'{"status": "Pulling"}\n',
+        }
+    )
+    docker = DockerApi(executer, client)
+
+    builder = DockerRunBuilder().set_name("c").set_image("alpine/socat").set_daemon()
+    assert docker.run(builder) == 0
+    assert (
+        "POST",
+        "/images/create",
+        {"fromImage": "alpine/socat", "tag": "latest"},
+    ) in [call[:3] for call in client.calls]
+
+
+def test_run_conflict(executer):
+    client = FakeClient({("POST", "/containers/create"): DockerApiError(409, "in use")})
+    docker = DockerApi(executer, client)
+
+    executer.exec_context.set_next_exit_on_error(False)
+    builder = DockerRunBuilder().set_name("c").set_image("i").set_daemon()
+    assert docker.run(builder) == 1
+
+
+def test_is_running(executer, capfd):
+    client = FakeClient(
+        {
+            ("GET", "/containers/running/json"): {"State": {"Running": True}},
+            ("GET", "/containers/stopped/json"): {"State": {"Running": False}},
+            ("GET", "/containers/missing/json"): DockerApiError(404, "Not found"),
+        }
+    )
+    docker = DockerApi(executer, client)
+
+    assert docker.is_running("running")
+    assert not docker.is_running("stopped")
+    assert not docker.is_running("missing")
+    assert "Not found" not in capfd.readouterr().err
+
+
+def test_cli_is_running(system):
+    system.set_output(
+        "docker container inspect --format '{{json .State}}' api", '{"Running": true}'
+    )
+    docker = Docker(Executer(DeployerExecutionContext()))
+
+    assert docker.is_running("api")
+    assert not docker.is_running("missing")
+
+
+def test_exec(executer, capfd):
+    frame = b"hello\n"
+    client = FakeClient(
+        {
+            ("POST", "/containers/c/exec"): {"Id": "e1"},
+            ("POST", "/exec/e1/start"): struct.pack(">BxxxL", 1, len(frame)) + frame,
+            ("GET", "/exec/e1/json"): {"ExitCode": 0},
+        }
+    )
+    docker = DockerApi(executer, client)
+
+    builder = (
+        DockerExecBuilder()
+        .set_container("c")
+        .set_command("ansible-playbook build.yml")
+        .set_interactive(False)
+        .set_tty(False)
+    )
+    docker.exec(builder)
+
+    assert capfd.readouterr().out == "hello\n"
+
+
+def test_exec_error_exits(executer):
+    client = FakeClient(
+        {
+            ("POST", "/containers/c/exec"): {"Id": "e1"},
+            ("GET", "/exec/e1/json"): {"ExitCode": 2},
+        }
+    )
+    docker = DockerApi(executer, client)
+
+    builder = DockerExecBuilder().set_container("c").set_command("false")
+    builder.set_interactive(False)
+
+    with pytest.raises(SystemExit) as e:
+        docker.exec(builder)
+    assert e.value.code == 2
+
+
+def test_interactive_exec_uses_cli(executer, helper):
+    client = FakeClient()
+    docker = DockerApi(executer, client)
+
+    builder = DockerExecBuilder().set_container("c").set_command("sh")
+    docker.exec(builder.set_interactive())
+
+    assert client.calls == []
+    helper.assert_syscall("docker exec")
+
+
+def test_build_image(executer, tmp_path, capsys):
+    (tmp_path / "Dockerfile").write_text("FROM alpine")
+    stream = "\n".join(
+        json.dumps(message) for message in [{"stream": "Step 1/1\n"}, {"aux": {}}]
+    )
+    client = FakeClient({("POST", "/build"): stream.encode()})
+    docker = DockerApi(executer, client)
+
+    assert docker.build_image("image", str(tmp_path)) == 0
+    assert "Step 1/1" in capsys.readouterr().out
+
+
+def test_build_image_with_context(executer, tmp_path):
+    (tmp_path / "Dockerfile").write_text("FROM alpine")
+    client = FakeClient()
+    docker = DockerApi(executer, client)
+
+    docker.build_image(
+        "image", str(tmp_path), labels={"a": "b"}, context=BuildContext(tmp_path)
+    )
+
+    _, _, params, body = client.calls[0]
+    assert params["labels"] == '{"a": "b"}'
+    assert tarfile.open(fileobj=io.BytesIO(body)).getnames() == ["Dockerfile"]
+
+
+@pytest.fixture()
+def build_directory(tmp_path):
+    (tmp_path / "Dockerfile").write_text(
+        "FROM alpine AS base\n"
+        + "COPY requirements.txt \\\n  /tmp/\n"
+        + "ADD --chown=1000 config/ /etc/config/\n"
+        + "COPY --from=base /bin/sh /bin/sh\n"
+        + "RUN echo 'COPY unused /'\n"
+    )
+    (tmp_path / "requirements.txt").write_text("docker")
+    (tmp_path / "config").mkdir()
+    (tmp_path / "config" / "app.yml").write_text("a: b")
+    (tmp_path / "unused").write_text("unused")
+    return tmp_path
+
+
+def test_build_context_files(build_directory):
+    context = BuildContext(build_directory)
+
+    assert context.sources() == ["requirements.txt", "config/"]
+    assert context.list_files() == ["Dockerfile", "config/app.yml", "requirements.txt"]
+    assert tarfile.open(fileobj=io.BytesIO(context.tar())).getnames() == [
+        "Dockerfile",
+        "config/app.yml",
+        "requirements.txt",
+    ]
+
+
+def test_build_context_fingerprint(build_directory):
+    fingerprint = BuildContext(build_directory).fingerprint()
+
+    (build_directory / "unused").write_text("changed")
+    assert BuildContext(build_directory).fingerprint() == fingerprint
+
+    (build_directory / "config" / "app.yml").write_text("a: c")
+    assert BuildContext(build_directory).fingerprint() != fingerprint
+
+
+def test_remove(executer):
+    client = FakeClient()
+
+    DockerApi(executer, client).remove("c")
+
+    assert client.calls == [("DELETE", "/containers/c", {"force": "true"}, None)]
+
+
+def test_dry_run(executer):
+    client = FakeClient()
+    docker = DockerApi(executer, client)
+
+    executer.exec_context.set_dry_run(True)
+    docker.stop("c")
+
+    assert client.calls == []
+
+
+def event(kind, action, name, actor_id="abc", **attributes):
+    return json.dumps(
+        {
+            "Type": kind,
+            "Action": action,
+            "Actor": {"ID": actor_id, "Attributes": dict(attributes, name=name)},
+        }
+    )
+
+
+class FakeDocker:
+    def __init__(self, events, state=None):
+        self.events_lines = events
+        self.state = state or ({"api": {"Id": "a", "Running": True}}, {})
+        self.closed = False
+
+    def list_state(self):
+        return self.state
+
+    def events(self, since):
+        return DockerEvents(iter(self.events_lines), self.close)
+
+    def close(self):
+        self.closed = True
+
+
+def follow(events, state=None):
+    cache = DockerStateCache(FakeDocker(events, state)).start()
+    cache.thread.join()
+    return cache
+
+
+def test_state_cache_containers():
+    received = []
+    docker = FakeDocker(
+        [
+            event("container", "die", "api"),
+            event("container", "create", "app"),
+            event("container", "start", "app"),
+            event("container", "rename", "web", oldName="/app"),
+            event("container", "destroy", "api"),
+        ]
+    )
+    cache = DockerStateCache(docker)
+    cache.subscribe(received.append)
+    cache.start().thread.join()
+
+    assert not cache.container_exists("api")
+    assert not cache.container_exists("app")
+    assert cache.is_running("web")
+    assert len(received) == 5
+
+
+def test_state_cache_images():
+    cache = follow(
+        [
+            event("image", "tag", "tzimy/deployer", actor_id="sha256:1"),
+            event("image", "tag", "tzimy/api:1.0", actor_id="sha256:2"),
+            event("image", "delete", "", actor_id="sha256:2"),
+        ]
+    )
+
+    assert cache.image_id("tzimy/deployer") == "sha256:1"
+    assert cache.image_id("tzimy/api:1.0") is None
+
+
+def test_state_cache_untag_keeps_other_tags():
+    cache = follow(
+        [
+            event("image", "tag", "tzimy/api:1.0", actor_id="sha256:1"),
+            event("image", "tag", "tzimy/api:latest", actor_id="sha256:1"),
+            event("image", "untag", "tzimy/api:1.0", actor_id="sha256:1"),
+        ]
+    )
+
+    assert cache.image_id("tzimy/api:1.0") is None
+    assert cache.image_id("tzimy/api") == "sha256:1"
+
+
+def test_state_cache_unsubscribe():
+    received = []
+    cache = DockerStateCache(FakeDocker([]))
+    unsubscribe = cache.subscribe(received.append)
+    unsubscribe()
+
+    cache.apply(json.loads(event("container", "start", "api")))
+
+    assert received == []
+
+
+def test_state_cache_stale_after_stream_end():
+    cache = follow([event("container", "start", "api")])
+
+    assert not cache.is_fresh()
+    assert cache.is_running("api")
+
+
+def test_state_cache_unreachable_daemon():
+    docker = FakeDocker([])
+    docker.list_state = lambda: None
+
+    assert not DockerStateCache(docker).start().is_fresh()
+
+
+def test_is_running_from_cache(executer):
+    client = FakeClient()
+    docker = DockerApi(executer, client)
+    docker.cache = DockerStateCache(FakeDocker([]))
+    docker.cache.containers = {"api": {"Id": "a", "Running": True}}
+    docker.cache.fresh = True
+
+    assert docker.is_running("api")
+    assert not docker.is_running("app")
+    assert client.calls == []
+
+
+def test_list_state(executer):
+    client = FakeClient(
+        {
+            # Lists of answers, one per call
+            ("GET", "/containers/json"): [
+                [
+                    {"Names": ["/api"], "Id": "a", "State": "running"},
+                    {"Names": ["/app"], "Id": "b", "State": "exited"},
+                ]
+            ],
+            ("GET", "/images/json"): [
+                [
+                    {"Id": "sha256:1", "RepoTags": ["tzimy/api:latest"]},
+                    {"Id": "sha256:2", "RepoTags": ["<none>:<none>"]},
+                ]
+            ],
+        }
+    )
+
+    containers, images = DockerApi(executer, client).list_state()
+
+    assert containers == {
+        "api": {"Id": "a", "Running": True},
+        "app": {"Id": "b", "Running": False},
+    }
+    assert images == {"tzimy/api:latest": "sha256:1"}
+
+
+def test_list_state_cli(executer, helper):
+    helper.system.set_output(
+        "docker ps",
+        json.dumps({"Names": "api", "ID": "a", "Status": "Up 2 minutes"}),
+    )
+    helper.system.set_output(
+        "docker images",
+        json.dumps({"Repository": "tzimy/api", "Tag": "latest", "ID": "sha256:1"}),
+    )
+
+    containers, images = Docker(executer).list_state()
+
+    assert containers == {"api": {"Id": "a", "Running": True}}
+    assert images == {"tzimy/api:latest": "sha256:1"}
+
+
+def test_events_cli(executer, helper):
+    helper.system.set_output("docker events", event("container", "start", "api"))
+
+    events = Docker(executer).events(0)
+
+    assert [e["Action"] for e in events] == ["start"]
+    events.close()
+    helper.assert_syscall("docker events --since 0")
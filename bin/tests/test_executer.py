@@ -0,0 +1,230 @@
+import os
+import signal
+import sys
+import threading
+import time
+
+import pytest
+from executer import ExecutionContext, Executer, Task, TaskOutput
+
+
+@pytest.fixture()
+def executer():
+    return Executer(ExecutionContext())
+
+
+def test_execute_argv_capture(executer):
+    result = executer.execute([sys.executable, "-c", "print('hello')"], capture=True)
+
+    assert result.exit_code == 0
+    assert result.stdout == "hello\n"
+    assert result.wall_time > 0
+    assert result.cpu_time >= 0
+
+
+def test_execute_shell(executer):
+    result = executer.execute("echo $((1 + 1))", capture=True)
+
+    assert result.stdout.strip() == "2"
+
+
+def test_execute_input_binary(executer):
+    cmd = [sys.executable, "-c", "import sys; sys.stdout.write(sys.stdin.read())"]
+    result = executer.execute(cmd, capture=True, input=b"\x00data", text=False)
+
+    assert result.stdout == b"\x00data"
+
+
+def test_run_exit_on_error(executer):
+    with pytest.raises(SystemExit) as e:
+        executer.run([sys.executable, "-c", "exit(3)"])
+
+    assert e.value.code == 3
+
+
+def test_next_overrides(executer, capsys):
+    executer.exec_context.set_next_exit_on_error(False)
+    executer.exec_context.set_next_verbose(True)
+    assert executer.run([sys.executable, "-c", "exit(3)"]) == 3
+    assert "Exited with 3" in capsys.readouterr().out
+
+    # Overrides only apply to the next command
+    with pytest.raises(SystemExit):
+        executer.run([sys.executable, "-c", "exit(3)"])
+
+
+def test_dry_run(executer, capsys):
+    executer.exec_context.set_dry_run(True)
+    result = executer.execute(["false"])
+
+    assert result.exit_code == 0
+    assert result.wall_time == 0  # Not run
+    assert capsys.readouterr().out == "false\n"
+
+    executer.exec_context.set_next_dry_run(False)
+    result = executer.execute(["true"])
+    assert result.exit_code == 0
+    assert result.wall_time > 0
+
+
+def test_scheduler_dependencies(executer):
+    order = []
+
+    def task(name):
+        return lambda: order.append(name)
+
+    exit_code = (
+        executer.create_scheduler(workers=4)
+        .add_task("c", task("c"), depends_on=["a", "b"])
+        .add_task("a", task("a"))
+        .add_task("b", task("b"), depends_on=["a"])
+        .run()
+    )
+
+    assert exit_code == 0
+    assert order == ["a", "b", "c"]
+
+
+def test_scheduler_concurrency(executer):
+    barrier = threading.Barrier(2, timeout=5)
+
+    def task():
+        barrier.wait()
+
+    scheduler = executer.create_scheduler(workers=2)
+    scheduler.add_task("a", task).add_task("b", task)
+
+    # Both tasks must run at the same time to pass the barrier
+    assert scheduler.run_tasks() == 0
+
+
+def test_scheduler_workers_limit(executer):
+    lock = threading.Lock()
+    running = []
+    peak = []
+
+    def task():
+        with lock:
+            running.append(1)
+            peak.append(len(running))
+        time.sleep(0.05)
+        with lock:
+            running.pop()
+
+    scheduler = executer.create_scheduler(workers=2)
+    for i in range(6):
+        scheduler.add_task(str(i), task)
+    scheduler.run_tasks()
+
+    assert max(peak) == 2
+
+
+def test_scheduler_failure(executer):
+    scheduler = (
+        executer.create_scheduler()
+        .add_task("fail", [sys.executable, "-c", "exit(4)"])
+        .add_task("dependent", lambda: 0, depends_on=["fail"])
+        .add_task("transitive", lambda: 0, depends_on=["dependent"])
+        .add_task("independent", lambda: 0)
+    )
+
+    with pytest.raises(SystemExit) as e:
+        scheduler.run()
+
+    assert e.value.code == 4
+    assert scheduler.tasks["dependent"].state == Task.CANCELLED
+    assert scheduler.tasks["transitive"].state == Task.CANCELLED
+    assert scheduler.tasks["independent"].state == Task.DONE
+
+
+def test_scheduler_callable_exit(executer):
+    def failing_deployer():
+        executer.run([sys.executable, "-c", "exit(5)"])
+
+    executer.exec_context.set_next_exit_on_error(False)
+    assert executer.create_scheduler().add_task("a", failing_deployer).run() == 5
+
+
+def test_scheduler_exception(executer, capsys):
+    def raising():
+        raise ValueError("unexpected")
+
+    scheduler = (
+        executer.create_scheduler()
+        .add_task("raising", raising)
+        .add_task("dependent", lambda: 0, depends_on=["raising"])
+        .add_task("independent", lambda: 0)
+    )
+
+    assert scheduler.run_tasks() == 1
+    assert scheduler.tasks["raising"].state == Task.FAILED
+    assert scheduler.tasks["dependent"].state == Task.CANCELLED
+    assert scheduler.tasks["independent"].state == Task.DONE
+    assert "Task raising raised ValueError: unexpected" in capsys.readouterr().out
+
+
+def test_scheduler_prefixed_outputs(executer, capsys):
+    def printing():
+        print("from", end=" ")
+        print("python")
+        print("incomplete", end="")
+
+    scheduler = (
+        executer.create_scheduler()
+        .add_task("command", [sys.executable, "-c", "print('a'); print('b')"])
+        .add_task("callable", printing)
+        .add_task("raw", lambda: print("as is"), prefix_output=False)
+    )
+
+    assert scheduler.run_tasks() == 0
+    lines = capsys.readouterr().out.splitlines()
+    assert sorted(lines) == sorted(
+        [
+            "[command] a",
+            "[command] b",
+            "[callable] from python",
+            "[callable] incomplete",
+            "as is",
+        ]
+    )
+    assert not isinstance(sys.stdout, TaskOutput)
+
+
+def test_scheduler_checks_graph(executer):
+    with pytest.raises(Exception, match="unknown"):
+        executer.create_scheduler().add_task("a", "true", depends_on=["b"]).run()
+
+    with pytest.raises(Exception, match="Circular"):
+        (
+            executer.create_scheduler()
+            .add_task("a", "true", depends_on=["b"])
+            .add_task("b", "true", depends_on=["a"])
+            .run()
+        )
+
+
+def test_scheduler_interrupt(executer):
+    scheduler = executer.create_scheduler(workers=1)
+    scheduler.add_task("long", [sys.executable, "-c", "import time; time.sleep(30)"])
+    scheduler.add_task("next", "true", depends_on=["long"])
+
+    threading.Timer(0.5, lambda: os.kill(os.getpid(), signal.SIGINT)).start()
+    start_time = time.monotonic()
+
+    assert scheduler.run_tasks() == 130
+    assert time.monotonic() - start_time < 10
+    assert scheduler.tasks["next"].state == Task.CANCELLED
+
+
+def test_next_overrides_are_per_thread(executer):
+    executer.exec_context.set_next_verbose(True)
+
+    other_thread = []
+    thread = threading.Thread(
+        target=lambda: other_thread.append(executer.exec_context.verbose())
+    )
+    thread.start()
+    thread.join()
+
+    assert other_thread == [False]
+    assert executer.exec_context.verbose()
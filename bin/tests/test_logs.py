@@ -0,0 +1,142 @@
+import asyncio
+import io
+import struct
+import threading
+
+import pytest
+from commands.dockerize import ApiLogTransform
+from docker import AsyncDockerResponse, DockerStateCache
+from logs import LogMultiplexer
+
+
+class FakeDocker:
+    """Serve log sessions (lists of lines) in order, one per follow_logs call"""
+
+    def __init__(self, sessions, running_after=()):
+        self.sessions = sessions
+        self.cache = DockerStateCache(self)
+        self.running_after = list(running_after)
+        self.calls = []
+        self.watch_threads = []
+
+    def watch(self):
+        self.watch_threads.append(threading.current_thread())
+        return self.cache
+
+    async def follow_logs(self, container, since):
+        self.calls.append((container, since))
+        for line in self.sessions.pop(0) if self.sessions else []:
+            yield line
+
+        # The container is restarted or removed once its log ends
+        if self.running_after:
+            self.cache.containers[container]["Running"] = self.running_after.pop(0)
+        else:
+            self.cache.containers.pop(container, None)
+
+
+class Transform:
+    def format(self, line):
+        return f"> {line}"
+
+
+def follow(docker, **kwargs):
+    output = io.StringIO()
+    LogMultiplexer(docker, 10, output=output, **kwargs).add("api", Transform()).run()
+    return output.getvalue()
+
+
+def test_follow():
+    assert follow(FakeDocker([["a\n", "b\n"]])) == "> a\n> b\n"
+
+
+def test_follow_watches_aside_of_the_loop():
+    docker = FakeDocker([["a\n"]])
+    LogMultiplexer(docker, 10, output=io.StringIO()).add("api", Transform()).add(
+        "app", Transform()
+    ).run()
+
+    # Once for every container, from an executor thread
+    assert len(docker.watch_threads) == 1
+    assert docker.watch_threads[0] is not threading.current_thread()
+
+
+def test_follow_filters():
+    docker = FakeDocker([["DEBUG a\n", "ERROR b\n", "  at trace\n", "WARN c\n"]])
+
+    assert follow(docker, level="warn") == "> ERROR b\n>   at trace\n> WARN c\n"
+
+
+def test_follow_filters_unlevelled_lines_by_the_previous_level():
+    docker = FakeDocker(
+        [["start\n", "DEBUG a\n", "  at x\n", "ERROR b\n", "  at trace\n"]]
+    )
+
+    assert follow(docker, level="warn") == "> start\n> ERROR b\n>   at trace\n"
+
+
+def test_follow_pattern():
+    docker = FakeDocker([["GET /api\n", "POST /api\n"]])
+
+    assert follow(docker, pattern="^GET") == "> GET /api\n"
+
+
+def test_follow_restarted_container():
+    docker = FakeDocker([["a\n"], ["b\n"]], running_after=[True])
+    docker.cache.containers = {"api": {"Id": "a", "Running": True}}
+    docker.cache.fresh = True
+
+    assert follow(docker) == "> a\n> b\n"
+    assert len(docker.calls) == 2
+    assert docker.calls[1][1] > 10  # only the new lines
+
+
+def test_follow_bounded_buffer():
+    lines = [f"{i}\n" for i in range(100)]
+    output = io.StringIO()
+    logs = LogMultiplexer(FakeDocker([lines]), 0, buffer_size=2, output=output)
+
+    logs.add("api", Transform()).run()
+
+    assert output.getvalue() == "".join(f"> {line}" for line in lines)
+
+
+def test_api_transform():
+    assert ApiLogTransform().format("a\n") == "\033[0;33mbackend  | \033[0ma\n"
+
+
+@pytest.fixture()
+def logs_server(tmp_path):
+    """Serve a chunked multiplexed log stream on a unix socket"""
+
+    def frame(stream, payload):
+        return struct.pack(">BxxxL", stream, len(payload)) + payload
+
+    body = frame(1, b"first\nsec") + frame(2, b"ond\n") + frame(1, b"last")
+    chunks = [body[:5], body[5:]]
+
+    async def handle(reader, writer):
+        while (await reader.readline()).strip():
+            pass
+        writer.write(b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n")
+        for chunk in chunks:
+            writer.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+        writer.close()
+
+    return str(tmp_path / "docker.sock"), handle
+
+
+def test_async_response_multiplexed_lines(logs_server):
+    socket_path, handle = logs_server
+
+    async def read():
+        server = await asyncio.start_unix_server(handle, socket_path)
+        async with server:
+            response = await AsyncDockerResponse.open(socket_path, "/logs")
+            lines = [line async for line in response.multiplexed_lines()]
+            response.close()
+            return lines
+
+    assert asyncio.run(read()) == ["first\n", "second\n", "last\n"]
@@ -0,0 +1,155 @@
+import io
+import subprocess  # nosec
+import tarfile
+
+import pytest
+from executer import ExecutionContext, Executer
+from sync import NodeModulesSync
+
+
+def archive(files):
+    content = io.BytesIO()
+    with tarfile.open(fileobj=content, mode="w") as tar:
+        for name, data in files.items():
+            info = tarfile.TarInfo(name)
+            if isinstance(data, str):
+                info.type, info.linkname = tarfile.SYMTYPE, data
+                tar.addfile(info)
+            elif isinstance(data, tuple):  # Hard link to another member
+                info.type, info.linkname = tarfile.LNKTYPE, data[0]
+                tar.addfile(info)
+            else:
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+    return content.getvalue()
+
+
+@pytest.fixture()
+def project(tmp_path):
+    (tmp_path / "yarn.lock").write_text("lodash@4")
+    (tmp_path / "node_modules" / "old").mkdir(parents=True)
+    (tmp_path / "node_modules" / "old" / "index.js").write_text("old")
+    (tmp_path / "node_modules" / "same.js").write_text("same")
+    return tmp_path
+
+
+@pytest.fixture()
+def sync(project, system):
+    return NodeModulesSync(
+        Executer(ExecutionContext()), "dev-tutorial-api", "/usr/src/app/api", project
+    )
+
+
+MANIFEST = (
+    "4c0f8b4eb0d45f67bd56abdcb2c56a6b2e3f1d8e  ./lodash/index.js\n"
+    + "48b8b8ba7e2f1c15b5a0e4e3e3fd4e7b5d5a3ee1  ./same.js\n"
+    + "L\t../lodash/bin.js\t./.bin/lodash\n"
+)
+
+
+def test_sync(sync, project, helper, capsys):
+    same_digest = "48b8b8ba7e2f1c15b5a0e4e3e3fd4e7b5d5a3ee1"
+    sync.local_manifest = lambda previous: {"same.js": same_digest, "old/index.js": ""}
+    helper.system.set_output("docker exec dev-tutorial-api sh", MANIFEST)
+    helper.system.set_output(
+        "docker exec -i",
+        archive(
+            {
+                ".bin/lodash": "../lodash/bin.js",
+                "lodash/index.js": b"module.exports = {}",
+            }
+        ),
+    )
+
+    assert sync.sync() == 0
+
+    helper.assert_syscall("docker exec -i dev-tutorial-api tar -cf -")
+    stdin = helper.system.processes[-1].stdin
+    written = b"".join(call.args[0] for call in stdin.write.call_args_list)
+    assert written == b".bin/lodash\nlodash/index.js\n"
+    assert (project / "node_modules" / "lodash" / "index.js").exists()
+    assert (project / "node_modules" / ".bin" / "lodash").is_symlink()
+    assert not (project / "node_modules" / "old" / "index.js").exists()
+    assert "2 files updated, 1 removed" in capsys.readouterr().out
+
+
+def test_sync_skipped_when_dependencies_unchanged(sync, project, helper):
+    helper.system.set_output("docker exec dev-tutorial-api sh", MANIFEST)
+    sync.save_state(sync.dependencies_digest(), {})
+
+    assert sync.sync() == 0
+    assert helper.system.calls == []
+
+    (project / "yarn.lock").write_text("lodash@5")
+    sync.sync()
+    helper.assert_any_syscall("docker exec dev-tutorial-api sh")
+
+
+def test_local_manifest_reuses_previous_digests(sync):
+    manifest = sync.local_manifest({})
+    assert set(manifest) == {"same.js", "old/index.js"}
+
+    sync.save_state("", manifest)
+    previous = sync.load_state()["files"]
+    previous["same.js"][2] = "cached"
+
+    assert sync.local_manifest(previous)["same.js"] == "cached"
+
+
+@pytest.mark.parametrize(
+    "files", [{"../escape.js": b""}, {"lodash/link": "../../../etc/passwd"}]
+)
+def test_sync_rejects_unsafe_archive(sync, helper, files):
+    helper.system.set_output("docker exec dev-tutorial-api sh", MANIFEST)
+    helper.system.set_output("docker exec -i", archive(files))
+
+    assert sync.sync() == 1
+
+
+def test_manifest_script_without_node_modules(tmp_path):
+    script = ["sh", "-c", NodeModulesSync.MANIFEST_SCRIPT, "sh"]
+
+    missing = subprocess.run(script + [str(tmp_path / "node_modules")], stdout=-1)
+    assert missing.returncode == 0 and missing.stdout == b""
+
+    (tmp_path / "index.js").write_text("")
+    found = subprocess.run(script + [str(tmp_path)], stdout=-1)
+    assert found.stdout.endswith(b"  ./index.js\n")
+
+
+def test_sync_without_node_modules(sync, helper, capsys):
+    helper.system.set_output("docker exec dev-tutorial-api sh", "")
+
+    assert sync.sync() == 0
+    assert "No /usr/src/app/api/node_modules in dev-tutorial-api yet" in (
+        capsys.readouterr().out
+    )
+
+
+def test_sync_archive_failure(sync, project, helper):
+    helper.system.set_output("docker exec dev-tutorial-api sh", MANIFEST)
+    helper.system.set_output("docker exec -i", archive({"lodash/index.js": b"{}"}))
+    helper.system.add_subprocess_listener(
+        lambda call, exit_code: 2 if call.startswith("docker exec -i") else exit_code
+    )
+
+    assert sync.sync() == 1
+    assert not (project / "node_modules" / sync.STATE_FILE).exists()
+
+
+def test_sync_hard_links(sync, project, helper):
+    modules = project / "node_modules"
+    (modules / "lodash").mkdir()
+    (modules / "lodash" / "index.js").hardlink_to(modules / "same.js")
+    helper.system.set_output("docker exec dev-tutorial-api sh", MANIFEST)
+    helper.system.set_output(
+        "docker exec -i",
+        archive({"lodash/index.js": b"{}", ".bin/lodash": ("lodash/index.js",)}),
+    )
+
+    assert sync.sync() == 0
+
+    assert (modules / ".bin" / "lodash").samefile(modules / "lodash" / "index.js")
+    # Replaced, not written through the former link
+    assert (modules / "lodash" / "index.js").read_text() == "{}"
+    assert (modules / "same.js").read_text() == "same"
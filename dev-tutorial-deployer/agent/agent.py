@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright: (c) 2021, Jimmy Tournemaine
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+"""Deployer agent
+
+Long-lived process of the deployer container running `ansible-playbook` jobs sent
+over a unix socket. Ansible is imported (and its plugins loaded) once by the agent,
+then every job runs in a process forked from it. Once the configuration file or a
+configured plugin changes, jobs run in a new `ansible-playbook` process until the
+agent is idle and executes itself again. With DEPLOYER_AGENT_FACT_CACHE=yes, facts
+are kept in a cache between jobs.
+
+Protocol: the client sends one JSON line describing the job
+({"argv": [...], "cwd": "...", "tty": bool, "columns": int}), then the agent sends
+frames made of a type (1 byte), a payload size (4 bytes, big endian) and a payload:
+`o` for an output chunk and `x` for the exit code (ASCII) ending the job.
+"""
+
+import argparse
+import fcntl
+import json
+import logging
+import os
+import pty
+import signal
+import socketserver
+import struct
+import sys
+import termios
+
+FACT_CACHE = "/tmp/ansible-facts"  # nosec
+
+# Facts may be cached between jobs (the cache plugin reads them at import)
+if os.getenv("DEPLOYER_AGENT_FACT_CACHE", "").lower() in ["1", "true", "yes"]:
+    os.environ.setdefault("ANSIBLE_GATHERING", "smart")
+    os.environ.setdefault("ANSIBLE_CACHE_PLUGIN", "jsonfile")
+    os.environ.setdefault("ANSIBLE_CACHE_PLUGIN_CONNECTION", FACT_CACHE)
+    os.environ.setdefault("ANSIBLE_CACHE_PLUGIN_TIMEOUT", "3600")
+
+# Imported once, shared by every forked job
+import ansible.utils.color  # noqa: E402
+from ansible import constants as C  # noqa: E402
+from ansible.cli.playbook import PlaybookCLI  # noqa: E402
+from ansible.errors import (  # noqa: E402
+    AnsibleError,
+    AnsibleOptionsError,
+    AnsibleParserError,
+)
+from ansible.plugins.loader import (  # noqa: E402
+    action_loader,
+    filter_loader,
+    module_loader,
+)
+from ansible.utils.display import Display  # noqa: E402
+
+display = Display()
+
+
+def warm_up():
+    """Load plugins once, forked jobs will find them loaded"""
+
+    for loader in [action_loader, filter_loader]:
+        list(loader.all(class_only=True))
+    module_loader.find_plugin("command")
+
+
+def loaded_files():
+    """Modification times of the configuration file and of the configured plugins
+
+    Ansible own plugins only change with its package, they are not checked.
+    """
+
+    paths = [C.DEFAULT_MODULE_PATH, C.DEFAULT_MODULE_UTILS_PATH] + [
+        getattr(C, name) for name in dir(C) if name.endswith("_PLUGIN_PATH")
+    ]
+    files = [C.CONFIG_FILE] if C.CONFIG_FILE else []
+    for directory in sorted({path for path_list in paths for path in path_list}):
+        for root, directories, names in os.walk(directory):
+            # Compiled files are written by the jobs themselves
+            directories[:] = [d for d in directories if d != "__pycache__"]
+            files += [os.path.join(root, name) for name in names]
+
+    mtimes = {}
+    for path in files:
+        try:
+            mtimes[path] = os.stat(path).st_mtime_ns
+        except OSError:  # Removed meanwhile
+            continue
+
+    return mtimes
+
+
+def run_playbook(argv):
+    """Same as the ansible-playbook script but in the current process"""
+
+    try:
+        return PlaybookCLI(argv).run()
+    except AnsibleOptionsError as e:
+        display.error(str(e), wrap_text=False)
+        return 5
+    except AnsibleParserError as e:
+        display.error(str(e), wrap_text=False)
+        return 4
+    except AnsibleError as e:
+        display.error(str(e), wrap_text=False)
+        return 1
+    except KeyboardInterrupt:
+        display.error("User interrupted execution")
+        return 99
+
+
+def send(wfile, frame_type, payload):
+    wfile.write(frame_type + struct.pack(">L", len(payload)) + payload)
+    wfile.flush()
+
+
+class JobHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        job = json.loads(self.rfile.readline())
+        logging.info(f"Running {' '.join(job['argv'])}")
+
+        # A pseudo terminal keeps Ansible colors and widths as with `docker exec -t`
+        if job.get("tty"):
+            reader, writer = pty.openpty()
+            size = struct.pack("HHHH", 0, job.get("columns") or 80, 0, 0)
+            fcntl.ioctl(writer, termios.TIOCSWINSZ, size)
+        else:
+            reader, writer = os.pipe()
+
+        pid = os.fork()
+        if pid == 0:
+            os.close(reader)
+            devnull = os.open(os.devnull, os.O_RDONLY)
+            os.dup2(devnull, 0)
+            os.dup2(writer, 1)
+            os.dup2(writer, 2)
+            os.chdir(job.get("cwd", os.getcwd()))
+
+            ansible.utils.color.ANSIBLE_COLOR = C.ANSIBLE_FORCE_COLOR or (
+                bool(job.get("tty")) and not C.ANSIBLE_NOCOLOR
+            )
+            display.columns = job.get("columns") or display.columns
+
+            # The loaded configuration or plugins are outdated, start afresh
+            if self.server.outdated:
+                os.execvp("ansible-playbook", ["ansible-playbook"] + job["argv"][1:])
+
+            sys.argv = job["argv"]
+            exit_code = run_playbook(job["argv"])
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(exit_code)
+
+        os.close(writer)
+        while True:
+            try:
+                chunk = os.read(reader, 65536)
+            except OSError:  # EIO once the pseudo terminal is closed
+                chunk = b""
+            if not chunk:
+                break
+            try:
+                send(self.wfile, b"o", chunk)
+            except OSError:  # Client gone, stop the job
+                os.kill(pid, signal.SIGTERM)
+                break
+        os.close(reader)
+
+        _, status = os.waitpid(pid, 0)
+        exit_code = os.waitstatus_to_exitcode(status)
+        exit_code = exit_code if exit_code >= 0 else 128 - exit_code
+        logging.info(f"Exited with {exit_code}")
+
+        try:
+            send(self.wfile, b"x", str(exit_code).encode())
+        except OSError:
+            pass
+
+
+class AgentServer(socketserver.ForkingMixIn, socketserver.UnixStreamServer):
+    def __init__(self, socket_path, handler, loaded):
+        super().__init__(socket_path, handler)
+        self.loaded = loaded
+        self.outdated = False
+
+    def process_request(self, request, client_address):
+        # Checked before forking the handler, which inherits the outcome
+        self.outdated = self.outdated or loaded_files() != self.loaded
+        super().process_request(request, client_address)
+
+    def service_actions(self):
+        super().service_actions()
+
+        # Reload once the running jobs are over
+        if self.outdated and not self.active_children:
+            logging.info("Configuration or plugins changed, reloading")
+            self.server_close()
+            os.execv(sys.executable, [sys.executable] + sys.argv)
+
+
+def serve(socket_path):
+    # Only the owner of the workspace may send jobs
+    socket_dir = os.path.dirname(socket_path)
+    workspace = os.stat(os.path.dirname(socket_dir))
+    os.makedirs(socket_dir, mode=0o700, exist_ok=True)
+    os.chown(socket_dir, workspace.st_uid, workspace.st_gid)
+    if os.path.exists(socket_path):
+        os.remove(socket_path)  # left by a previous container or agent
+
+    # Listed first, a change while loading the plugins is seen by the next job
+    loaded = loaded_files()
+    warm_up()
+
+    previous_umask = os.umask(0o177)
+    with AgentServer(socket_path, JobHandler, loaded) as server:
+        os.umask(previous_umask)
+        os.chown(socket_path, workspace.st_uid, workspace.st_gid)
+
+        signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+        logging.info(f"Listening on {socket_path}")
+        try:
+            server.serve_forever()
+        finally:
+            os.remove(socket_path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run playbooks from a warm Ansible")
+    parser.add_argument("--socket", required=True, help="the unix socket to listen on")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    serve(args.socket)
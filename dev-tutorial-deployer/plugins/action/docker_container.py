@@ -6,13 +6,23 @@
 
 from __future__ import absolute_import, division, print_function
 
-import docker
+import ansible.module_utils
+from ansible import constants as C
 from ansible.errors import AnsibleError
 from ansible.plugins.action import ActionBase
 from ansible.utils.display import Display
 
 __metaclass__ = type
 
+# Custom module_utils (see ansible.cfg) are only packaged with modules, the
+# controller plugins import them from the same directories
+ansible.module_utils.__path__ += [
+    path
+    for path in C.DEFAULT_MODULE_UTILS_PATH
+    if path not in ansible.module_utils.__path__
+]
+
+from ansible.module_utils.docker_cache import DockerMetadataCache  # noqa: E402
 
 ANSIBLE_METADATA = dict(
     metadata_version="1.1",
@@ -39,32 +49,34 @@ class ActionModule(ActionBase):
         super(ActionModule, self).run(tmp, task_vars)
         module_args = self._task.args.copy()
 
-        client = docker.from_env()
+        cache = DockerMetadataCache.for_run()
         container_name = module_args["name"]
         state = module_args.get("state")
         image_name = module_args.get("image")
 
         if state != "absent":
             # Get image info
-            try:
-                image = client.images.get(image_name)
-            except docker.errors.ImageNotFound:
+            image = cache.image(image_name)
+            if image is None:
                 raise AnsibleError(f"No such image {image_name}")
 
             # Get container info
-            try:
-                container = client.containers.get(container_name)
-                if image.id != container.image.id:
-                    module_args["recreate"] = True
-                    display.warning(
-                        "New image available. Container will be recreated from the new image."
-                    )
-            except docker.errors.NotFound:
+            container = cache.container(container_name)
+            if container is None:
                 display.vvvv(f"No such container {container_name}")
+            elif image["Id"] != container["ImageID"]:
+                module_args["recreate"] = True
+                display.warning(
+                    "New image available. Container will be recreated from the new image."
+                )
 
-        return self._execute_module(
+        module_res = self._execute_module(
             module_name="docker_container",
             module_args=module_args,
             task_vars=task_vars,
             tmp=tmp,
         )
+        if module_res.get("changed") and not self._play_context.check_mode:
+            cache.invalidate(DockerMetadataCache.CONTAINERS)
+
+        return module_res
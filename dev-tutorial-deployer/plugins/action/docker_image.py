@@ -7,16 +7,31 @@
 from __future__ import absolute_import, division, print_function
 
 import os
+import time
+from contextlib import contextmanager
 from datetime import datetime, timezone
 
-import docker
+import ansible.module_utils
+from ansible import constants as C
 from ansible.errors import AnsibleError
+from ansible.module_utils.parsing.convert_bool import boolean
 from ansible.plugins.action import ActionBase
 from ansible.utils.display import Display
-from dateutil.parser import parse
 
 __metaclass__ = type
 
+# Custom module_utils (see ansible.cfg) are only packaged with modules, the
+# controller plugins import them from the same directories
+ansible.module_utils.__path__ += [
+    path
+    for path in C.DEFAULT_MODULE_UTILS_PATH
+    if path not in ansible.module_utils.__path__
+]
+
+from ansible.module_utils import buildkit, docker_build  # noqa: E402
+from ansible.module_utils.docker_build import FINGERPRINT_LABEL  # noqa: E402
+from ansible.module_utils.docker_cache import DockerMetadataCache, client  # noqa: E402
+from ansible.module_utils.fingerprint_index import FingerprintIndex  # noqa: E402
 
 ANSIBLE_METADATA = dict(
     metadata_version="1.1",
@@ -29,7 +44,14 @@ DOCUMENTATION = dict(
     short_description="Manage docker images",
     description=(
         "Add an extra `changes` attribute to the module. "
-        + "If any file of `changes` has been modified since the last image build, then the build is forced."
+        + "If any file of `changes` has been modified since the last image build, then the build is forced. "
+        + "With `changes_mode: hash`, files are compared by content instead of modification time: "
+        + "their digest is set as a label of the image (as docker_image_batch does), "
+        + "the image is built again (with the layer cache) when the label differs. "
+        + "Files excluded by the .dockerignore of the build path are not checked. "
+        + "With `buildkit: yes`, images are built by the docker CLI with BuildKit "
+        + "(e.g. for cache mounts). "
+        + "In check mode, images are neither built, pushed nor indexed."
     ),
     version_added="2.9",
     author="Jimmy Tournemaine (@JimmyTournemaine)",
@@ -38,41 +60,144 @@ DOCUMENTATION = dict(
 display = Display()
 
 
-def walk_through(path):
-    """Walk throught a directory to get mtime for all files recursively"""
+class ActionModule(ActionBase):
+    def image_timestamp(self, cache, image_name):
+        """Get the image creation time"""
 
-    for root, subdirs, files in os.walk(path):
-        for filepath in files:
-            yield datetime.fromtimestamp(
-                os.path.getmtime(os.path.join(root, filepath)), timezone.utc
-            )
+        image = cache.image(image_name)
+        created = image["Created"] if image is not None else 0
 
+        return datetime.fromtimestamp(created, timezone.utc)
 
-class ActionModule(ActionBase):
-    def image_timestamp(self, image_name):
-        """Get the image creation time"""
+    def newer_file(self, index, path, created_at):
+        """Get a file modified after `created_at`, in a file or a directory"""
 
-        client = docker.from_env()
+        if not os.path.exists(path):
+            raise AnsibleError("File does not exist")
 
-        try:
-            image = client.images.get(image_name)
-            time = parse(str(image.attrs["Created"]))
-        except docker.errors.ImageNotFound:
-            time = datetime.fromtimestamp(0, timezone.utc)
+        with self.timed(index, path):
+            return index.newer_file(path, created_at.timestamp())
 
-        return time
+    @contextmanager
+    def timed(self, index, path):
+        """Display the time spent scanning a path (-vvv)"""
 
-    def mtime(self, path):
-        """Get the modification time of a file or recursively into a directory"""
+        start_time = time.monotonic()
+        start_stats = dict(index.stats)
+        yield
+        counts = ", ".join(
+            f"{value - start_stats[name]} {name}" for name, value in index.stats.items()
+        )
+        display.vvv(f"{path}: {counts} in {time.monotonic() - start_time:.3f}s")
 
-        if os.path.isfile(path):
-            modified_at = datetime.fromtimestamp(os.path.getmtime(path), timezone.utc)
-        elif os.path.isdir(path):
-            modified_at = max(walk_through(path))
+    def build_with_buildkit(self, cache, module_args):
+        """Same as the core module for a build, but with BuildKit"""
+
+        image_name = module_args["name"]
+        image = cache.image(image_name)
+        force_source = boolean(module_args.get("force_source", False))
+        push = boolean(module_args.get("push", False))
+
+        # Check mode only reports the build and the push
+        if self._play_context.check_mode:
+            return dict(changed=image is None or force_source or push)
+
+        if image is not None and not force_source:
+            module_res = dict(changed=False, image=dict(Id=image["Id"]))
         else:
-            raise AnsibleError("File does not exist")
+            build = module_args["build"]
+            exit_code, output = buildkit.build(
+                build["path"],
+                image_name,
+                build.get("dockerfile", "Dockerfile"),
+                build_args=build.get("args"),
+                pull=boolean(build.get("pull", False)),
+                nocache=boolean(build.get("nocache", False)),
+            )
+            if exit_code != 0:
+                return dict(
+                    failed=True, msg=f"Failed to build {image_name}", stdout=output
+                )
+
+            image_id = client().api.inspect_image(image_name)["Id"]
+            module_res = dict(changed=True, image=dict(Id=image_id), stdout=output)
+
+        if push:
+            exit_code, output = buildkit.push(image_name)
+            if exit_code != 0:
+                return dict(
+                    failed=True, msg=f"Failed to push {image_name}", stdout=output
+                )
+            module_res["changed"] = True
+
+        return module_res
+
+    def execute(self, cache, module_args, task_vars, tmp):
+        """Run the core module, or build with BuildKit"""
+
+        if self.buildkit and "build" == module_args.get("source"):
+            return self.build_with_buildkit(cache, module_args)
+
+        return self._execute_module(
+            module_name="docker_image",
+            module_args=module_args,
+            task_vars=task_vars,
+            tmp=tmp,
+        )
+
+    def run_hash_mode(self, cache, module_args, changes, task_vars, tmp):
+        """Build when the digest of `changes` differs from the image label one"""
+
+        image_name = module_args["name"]
+        build = module_args["build"]
+        base_path = build["path"]
+        for path in changes:
+            if not os.path.exists(os.path.join(base_path, path)):
+                raise AnsibleError(f"{path} does not exist")
 
-        return modified_at
+        index = FingerprintIndex.for_image(image_name)
+        index.use_dockerignore(base_path)
+        with self.timed(index, base_path):
+            digest = index.digest(base_path, changes)
+        if not self._play_context.check_mode:
+            index.save()
+
+        image = cache.image(image_name)
+        image_digest = image["Labels"].get(FINGERPRINT_LABEL) if image else None
+        display.v(f"Changes digest {digest}, image digest {image_digest}")
+
+        built = False
+        if digest != image_digest or boolean(module_args.get("force_source", False)):
+            # Check mode only reports the build
+            if self._play_context.check_mode:
+                return dict(changed=True, msg=f"{image_name} would be built")
+
+            display.warning("Build inputs differ from the image ones. Building.")
+            error = docker_build.build(
+                base_path,
+                image_name,
+                build.get("dockerfile", "Dockerfile"),
+                labels={FINGERPRINT_LABEL: digest},
+                build_args=build.get("args"),
+                pull=boolean(build.get("pull", False)),
+                nocache=boolean(build.get("nocache", False)),
+                use_buildkit=self.buildkit,
+            )
+            if error is not None:
+                return dict(failed=True, msg=f"Failed to build {image_name}: {error}")
+            built = True
+            module_args["force_source"] = False
+
+        # The image exists now, the core module handles the rest (e.g. push)
+        module_res = self._execute_module(
+            module_name="docker_image",
+            module_args=module_args,
+            task_vars=task_vars,
+            tmp=tmp,
+        )
+        module_res["changed"] = module_res.get("changed", False) or built
+
+        return module_res
 
     def run(self, tmp=None, task_vars=None):
 
@@ -84,34 +209,57 @@ class ActionModule(ActionBase):
             module_args.get("build", dict()).get("dockerfile", "Dockerfile")
         ]
         module_args.pop("changes", None)
+        changes_mode = module_args.pop("changes_mode", "mtime")
+        if changes_mode not in ["mtime", "hash"]:
+            raise AnsibleError(f"Unsupported changes_mode {changes_mode}")
+        self.buildkit = boolean(module_args.pop("buildkit", False))
 
         super(ActionModule, self).run(tmp, task_vars)
 
+        cache = DockerMetadataCache.for_run()
+        module_res = self.run_module(
+            cache, module_args, changes, changes_mode, task_vars, tmp
+        )
+
+        # Builds, pulls and removals change the images of the daemon
+        if not self._play_context.check_mode and (
+            module_res.get("changed") or module_res.get("failed")
+        ):
+            cache.invalidate(DockerMetadataCache.IMAGES)
+
+        return module_res
+
+    def run_module(self, cache, module_args, changes, changes_mode, task_vars, tmp):
+        """Force the build on changes (or build in hash mode), then run the module"""
+
         image_name = module_args["name"]
         is_build = "build" == module_args.get("source", None)
 
+        if is_build and "hash" == changes_mode:
+            return self.run_hash_mode(cache, module_args, changes, task_vars, tmp)
+
         if is_build:
-            image_created_at = self.image_timestamp(image_name)
+            image_created_at = self.image_timestamp(cache, image_name)
             display.v(f"Image were created at {image_created_at}")
 
             # Prepare to force the build on changes
             base_path = module_args["build"]["path"]
+            index = FingerprintIndex.for_image(image_name)
+            index.use_dockerignore(base_path)
             for path in changes:
-                modified_at = self.mtime(os.path.join(base_path, path))
-                if modified_at > image_created_at:
+                newer_file = self.newer_file(
+                    index, os.path.join(base_path, path), image_created_at
+                )
+                if newer_file is not None:
+                    display.vv(f"{newer_file} is newer than the image")
                     display.warning(
                         f"{path} has been modified since last build. Build will be forced."
                     )
                     module_args["force_source"] = True
                     module_args["build"]["nocache"] = True
                     break
+            if not self._play_context.check_mode:
+                index.save()
 
         # Run the module
-        module_res = self._execute_module(
-            module_name="docker_image",
-            module_args=module_args,
-            task_vars=task_vars,
-            tmp=tmp,
-        )
-
-        return module_res
+        return self.execute(cache, module_args, task_vars, tmp)
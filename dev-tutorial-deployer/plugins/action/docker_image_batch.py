@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright: (c) 2021, Jimmy Tournemaine
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+from __future__ import absolute_import, division, print_function
+
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import ansible.module_utils
+from ansible import constants as C
+from ansible.errors import AnsibleError
+from ansible.module_utils.parsing.convert_bool import boolean
+from ansible.plugins.action import ActionBase
+from ansible.utils.display import Display
+
+__metaclass__ = type
+
+# Custom module_utils (see ansible.cfg) are only packaged with modules, the
+# controller plugins import them from the same directories
+ansible.module_utils.__path__ += [
+    path
+    for path in C.DEFAULT_MODULE_UTILS_PATH
+    if path not in ansible.module_utils.__path__
+]
+
+from ansible.module_utils import docker_build  # noqa: E402
+from ansible.module_utils.docker_build import FINGERPRINT_LABEL  # noqa: E402
+from ansible.module_utils.docker_cache import DockerMetadataCache  # noqa: E402
+from ansible.module_utils.fingerprint_index import FingerprintIndex  # noqa: E402
+
+ANSIBLE_METADATA = dict(
+    metadata_version="1.1",
+    status=["preview"],
+    supported_by="community",
+)
+
+DOCUMENTATION = dict(
+    module="docker_image_batch",
+    short_description="Build several docker images",
+    description=(
+        "Build the images of `images` (a list of `name` and `path`, or of paths named after "
+        + "their directory), at most `parallelism` at once. "
+        + "Items may set a `dockerfile` and `changes`, the files (relative to `path`) digested "
+        + "with the Dockerfile instead of the whole build context. "
+        + "The digest is set as a label of the image, "
+        + "images whose label matches the current digest are not built again. "
+        + "In check mode, the images to build are reported but not built."
+    ),
+    version_added="2.9",
+    author="Jimmy Tournemaine (@JimmyTournemaine)",
+)
+
+display = Display()
+
+
+class ActionModule(ActionBase):
+    def fingerprint(self, image):
+        index = FingerprintIndex.for_image(image["name"])
+        index.use_dockerignore(image["path"])
+        changes = image.get("changes")
+        paths = ["."] if changes is None else changes + [image["dockerfile"]]
+        digest = index.digest(image["path"], paths)
+        if not self._play_context.check_mode:
+            index.save()
+
+        return digest
+
+    def process(self, image, existing, pull):
+        start_time = time.monotonic()
+        digest = self.fingerprint(image)
+        built = existing is None or digest != existing["Labels"].get(FINGERPRINT_LABEL)
+        error = None
+        # Check mode only reports the images to build
+        if built and not self._play_context.check_mode:
+            error = docker_build.build(
+                image["path"],
+                image["name"],
+                image["dockerfile"],
+                labels={FINGERPRINT_LABEL: digest},
+                pull=pull,
+                use_buildkit=boolean(image.get("buildkit", False)),
+            )
+
+        return {
+            "name": image["name"],
+            "built": built,
+            "failed": error is not None,
+            "msg": error,
+            "duration": round(time.monotonic() - start_time, 3),
+        }
+
+    def run(self, tmp=None, task_vars=None):
+        result = super(ActionModule, self).run(tmp, task_vars)
+
+        images = [
+            dict(
+                {"name": os.path.basename(i.rstrip("/")), "path": i}
+                if isinstance(i, str)
+                else i
+            )
+            for i in self._task.args.get("images", [])
+        ]
+        parallelism = int(self._task.args.get("parallelism", 2))
+        pull = boolean(self._task.args.get("pull", False))
+        if parallelism < 1:
+            raise AnsibleError("parallelism must be at least 1")
+        for image in images:
+            if "name" not in image or "path" not in image:
+                raise AnsibleError("images items must have a name and a path")
+            image.setdefault("dockerfile", "Dockerfile")
+
+        # Looked up before the threads, which share the cache client
+        cache = DockerMetadataCache.for_run()
+        existing = [cache.image(image["name"]) for image in images]
+        with ThreadPoolExecutor(parallelism) as pool:
+            reports = list(
+                pool.map(lambda i, e: self.process(i, e, pull), images, existing)
+            )
+
+        for report in reports:
+            status = "built" if report["built"] else "up to date"
+            if report["built"] and self._play_context.check_mode:
+                status = "to build"
+            display.v(f"{report['name']}: {status} in {report['duration']}s")
+
+        result["images"] = reports
+        result["changed"] = any(report["built"] for report in reports)
+        if result["changed"] and not self._play_context.check_mode:
+            cache.invalidate(DockerMetadataCache.IMAGES)
+
+        failures = [report for report in reports if report["failed"]]
+        if len(failures) > 0:
+            result["failed"] = True
+            result["msg"] = "; ".join(f"{r['name']}: {r['msg']}" for r in failures)
+
+        return result
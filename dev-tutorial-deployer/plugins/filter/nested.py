@@ -9,21 +9,50 @@ from __future__ import absolute_import, division, print_function
 __metaclass__ = type
 
 
+def walk(node):
+    """Iterate over the dicts of a document, depth-first and in document order
+
+    An explicit stack is used instead of recursion, for deep documents.
+    """
+
+    stack = [node] if isinstance(node, (dict, list)) else []
+    while stack:
+        node = stack.pop()
+        if isinstance(node, dict):
+            yield node
+            node = node.values()
+
+        # Scalars are not stacked, most of the nodes are
+        for child in reversed(node):
+            if isinstance(child, (dict, list)):
+                stack.append(child)
+
+
 def nested(node, kv):
-    if isinstance(node, list):
-        for i in node:
-            for x in nested(i, kv):
-                yield x
-    elif isinstance(node, dict):
-        if kv in node:
-            yield node[kv]
-        for j in node.values():
-            for x in nested(j, kv):
-                yield x
+    """Values of the `kv` key at any depth of a document"""
+
+    return (mapping[kv] for mapping in walk(node) if kv in mapping)
+
+
+def nested_index(node, keys):
+    """Values of several keys at any depth of a document, in one pass
+
+    Return a dict of the lists of values by key, e.g.
+    `parsed_yaml | nested_index(['register', 'notify'])`.
+    """
+
+    keys = [keys] if isinstance(keys, str) else list(keys)
+    index = {key: [] for key in keys}
+    for mapping in walk(node):
+        for key in keys:
+            if key in mapping:
+                index[key].append(mapping[key])
+
+    return index
 
 
 class FilterModule(object):
     """ Ansible custom filters """
 
     def filters(self):
-        return {"nested": nested}
+        return {"nested": nested, "nested_index": nested_index}
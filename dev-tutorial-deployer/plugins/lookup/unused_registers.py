@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright: (c) 2021, Jimmy Tournemaine
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+from __future__ import absolute_import, division, print_function
+
+import os
+import re
+from collections import Counter
+
+from ansible.errors import AnsibleError
+from ansible.plugins.lookup import LookupBase
+from ansible.utils.display import Display
+
+__metaclass__ = type
+
+
+DOCUMENTATION = dict(
+    lookup="unused_registers",
+    short_description="Find the unused registered variables",
+    description=(
+        "Read every file of the given directories once, index the lines where each "
+        + "identifier appears and return the registered variables (`register:` of "
+        + "YAML files) appearing on less than 2 lines, with their file and line."
+    ),
+    version_added="2.9",
+    author="Jimmy Tournemaine (@JimmyTournemaine)",
+)
+
+display = Display()
+
+REGISTER_PATTERN = re.compile(r"^\s*(?:-\s+)?register:\s*['\"]?(\w+)")
+TOKEN_PATTERN = re.compile(r"[A-Za-z_]\w*")
+YAML_EXTENSIONS = (".yml", ".yaml")
+
+
+def files(directory):
+    """Files of a directory, except hidden ones (e.g. .git, .cache)"""
+
+    for root, directories, names in os.walk(directory):
+        directories[:] = sorted(d for d in directories if not d.startswith("."))
+        for name in sorted(names):
+            if not name.startswith("."):
+                yield os.path.join(root, name)
+
+
+def index(directories):
+    """Count the lines of each identifier and locate the registered variables"""
+
+    lines_by_token = Counter()
+    registers = []
+    for directory in directories:
+        for path in files(directory):
+            try:
+                with open(path, encoding="utf-8") as f:
+                    content = f.read()
+            except (OSError, UnicodeDecodeError):  # Binary files
+                continue
+
+            is_yaml = path.endswith(YAML_EXTENSIONS)
+            for number, line in enumerate(content.splitlines(), start=1):
+                lines_by_token.update(set(TOKEN_PATTERN.findall(line)))
+                match = REGISTER_PATTERN.match(line) if is_yaml else None
+                if match is not None:
+                    registers.append((match.group(1), path, number))
+
+    return lines_by_token, registers
+
+
+class LookupModule(LookupBase):
+    def run(self, terms, variables=None, **kwargs):
+        for directory in terms:
+            if not os.path.isdir(directory):
+                raise AnsibleError(f"{directory} is not a directory")
+
+        lines_by_token, registers = index(terms)
+        display.vvv(f"{len(lines_by_token)} identifiers, {len(registers)} registers")
+
+        return [
+            {"name": name, "uses": lines_by_token[name], "path": path, "line": line}
+            for name, path, line in registers
+            if lines_by_token[name] < 2
+        ]
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright: (c) 2021, Jimmy Tournemaine
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+from __future__ import absolute_import, division, print_function
+
+import os
+import subprocess  # nosec
+
+__metaclass__ = type
+
+
+def build(
+    path,
+    tag,
+    dockerfile="Dockerfile",
+    labels=None,
+    build_args=None,
+    pull=False,
+    nocache=False,
+):
+    """Build an image with BuildKit, return the exit code and the output
+
+    The docker SDK only drives the classic builder, BuildKit features (such as
+    `RUN --mount=type=cache`) need the docker CLI.
+    """
+
+    command = ["docker", "build", "--tag", tag]
+    command += ["--file", os.path.join(path, dockerfile)]
+    for name, value in (labels or {}).items():
+        command += ["--label", f"{name}={value}"]
+    for name, value in (build_args or {}).items():
+        command += ["--build-arg", f"{name}={value}"]
+    if pull:
+        command.append("--pull")
+    if nocache:
+        command.append("--no-cache")
+    command.append(path)
+
+    env = dict(os.environ, DOCKER_BUILDKIT="1", BUILDKIT_PROGRESS="plain")
+    return run(command, env)
+
+
+def push(tag):
+    return run(["docker", "push", tag])
+
+
+def run(command, env=None):
+    process = subprocess.run(  # nosec
+        command,
+        env=env,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        universal_newlines=True,
+    )
+    return process.returncode, process.stdout
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright: (c) 2021, Jimmy Tournemaine
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+from __future__ import absolute_import, division, print_function
+
+import docker
+from ansible.module_utils import buildkit
+
+__metaclass__ = type
+
+
+# Digest of the build inputs an image was built from (see FingerprintIndex.digest)
+FINGERPRINT_LABEL = "dev-tutorial.fingerprint"
+
+
+def build(
+    path,
+    tag,
+    dockerfile="Dockerfile",
+    labels=None,
+    build_args=None,
+    pull=False,
+    nocache=False,
+    use_buildkit=False,
+):
+    """Build a labelled image, return an error message or None
+
+    The core docker_image module cannot label the images it builds, they are built
+    with the docker SDK (or the docker CLI for BuildKit).
+    """
+
+    if use_buildkit:
+        exit_code, output = buildkit.build(
+            path, tag, dockerfile, labels, build_args, pull, nocache
+        )
+        if exit_code == 0:
+            return None
+        lines = output.strip().splitlines()
+        return lines[-1] if len(lines) > 0 else f"Failed to build {tag}"
+
+    # A client per build, requests sessions are not shared between threads
+    client = docker.from_env()
+    try:
+        for chunk in client.api.build(
+            path=path,
+            dockerfile=dockerfile,
+            tag=tag,
+            labels=labels,
+            buildargs=build_args,
+            pull=pull,
+            nocache=nocache,
+            rm=True,
+            decode=True,
+        ):
+            if "error" in chunk:
+                return chunk["error"].strip()
+    except docker.errors.APIError as e:
+        return str(e)
+    finally:
+        client.close()
+
+    return None
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright: (c) 2021, Jimmy Tournemaine
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+from __future__ import absolute_import, division, print_function
+
+import json
+import os
+import re
+import tempfile
+
+import docker
+from dateutil.parser import parse
+
+__metaclass__ = type
+
+
+_client = None
+
+
+def client():
+    """Docker client shared by the plugins of a worker process"""
+
+    global _client
+    if _client is None:
+        _client = docker.from_env()
+    return _client
+
+
+def image_reference(name):
+    """Name of an image with its tag, as listed by the daemon"""
+
+    return name if ":" in name.rsplit("/", 1)[-1] else f"{name}:latest"
+
+
+RUN_FILE = re.compile(r"^deployer-docker-(\d+)-(\d+)\.json$")
+
+
+def process_start(pid):
+    """Start time of a process (tells apart recycled process IDs), or None"""
+
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            return f.read().rsplit(")", 1)[1].split()[19]
+    except (OSError, IndexError):
+        return None
+
+
+class DockerMetadataCache:
+    """Images and containers of the Docker daemon, shared by the tasks of a run
+
+    Action plugins run in a new worker process for every task, so the metadata are
+    kept in a file of the playbook run (the parent process of the workers). Images
+    and containers are listed apart (one API call each) on their first lookup, and
+    the plugins invalidate them once they build, remove or (re)create something.
+    Files of finished runs are removed when a new one is written.
+    """
+
+    IMAGES = "images"
+    CONTAINERS = "containers"
+
+    def __init__(self, path):
+        self.path = path
+        self.content = None
+
+    @classmethod
+    def for_run(cls, directory=None):
+        """Cache of the current playbook run"""
+
+        parent = os.getppid()
+        return cls(
+            os.path.join(
+                directory or tempfile.gettempdir(),
+                f"deployer-docker-{parent}-{process_start(parent) or 0}.json",
+            )
+        )
+
+    def read(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def write(self, content):
+        if not os.path.exists(self.path):
+            self.prune()
+
+        # Write aside then rename, as the index of fingerprints
+        tmp_path = f"{self.path}.{os.getpid()}"
+        with open(tmp_path, "w") as f:
+            json.dump(content, f)
+        os.replace(tmp_path, self.path)
+
+    def prune(self):
+        """Remove the files of the runs which are over"""
+
+        directory = os.path.dirname(self.path)
+        if not os.path.isdir("/proc"):
+            return
+        for name in os.listdir(directory):
+            match = RUN_FILE.match(name)
+            if match is not None and process_start(match[1]) != match[2]:
+                try:
+                    os.remove(os.path.join(directory, name))
+                except OSError:
+                    pass
+
+    def section(self, name, list_daemon):
+        """Metadata of a kind, listed from the daemon on the first lookup of the run"""
+
+        if self.content is None:
+            self.content = self.read()
+        if name not in self.content:
+            self.content[name] = list_daemon()
+
+            # Other tasks may have listed the other kind meanwhile
+            content = self.read()
+            content[name] = self.content[name]
+            self.write(content)
+        return self.content[name]
+
+    def invalidate(self, *names):
+        """Forget metadata (all kinds by default) once the daemon state is changed"""
+
+        names = names or (self.IMAGES, self.CONTAINERS)
+        content = self.read()
+        for name in names:
+            content.pop(name, None)
+        self.content = content
+        if len(content) > 0:
+            self.write(content)
+        else:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+
+    @staticmethod
+    def list_images():
+        images = {}
+        for image in client().api.images():
+            for tag in image.get("RepoTags") or []:
+                images[tag] = {
+                    "Id": image["Id"],
+                    "Created": image["Created"],
+                    "Labels": image.get("Labels") or {},
+                }
+        return images
+
+    @staticmethod
+    def list_containers():
+        containers = {}
+        for container in client().api.containers(all=True):
+            for name in container.get("Names") or []:
+                containers[name.lstrip("/")] = {
+                    "Id": container["Id"],
+                    "ImageID": container["ImageID"],
+                }
+        return containers
+
+    def image(self, name):
+        """ID, creation time (epoch) and labels of an image, or None if missing"""
+
+        image = self.section(self.IMAGES, self.list_images).get(image_reference(name))
+        if image is not None:
+            return image
+
+        # Not a tag (e.g. an ID or a digest), ask the daemon
+        try:
+            attrs = client().api.inspect_image(name)
+        except docker.errors.ImageNotFound:
+            return None
+        return {
+            "Id": attrs["Id"],
+            "Created": parse(attrs["Created"]).timestamp(),
+            "Labels": (attrs.get("Config") or {}).get("Labels") or {},
+        }
+
+    def container(self, name):
+        """ID and image ID of a container, or None if it does not exist"""
+
+        return self.section(self.CONTAINERS, self.list_containers).get(name)
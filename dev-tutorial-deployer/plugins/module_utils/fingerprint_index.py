@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright: (c) 2021, Jimmy Tournemaine
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+from __future__ import absolute_import, division, print_function
+
+import hashlib
+import json
+import os
+import stat
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from docker.utils.build import PatternMatcher
+
+__metaclass__ = type
+
+
+class FingerprintIndex:
+    """Persistent index of the files of a build context
+
+    Directory listings are kept with the directory modification time (which only
+    changes when entries are added, removed or renamed), unchanged directories are
+    not listed again. Their files are still stat'ed, once: for their modification
+    time when looking for a newer file, by `file_digest` when digesting them. Files
+    are kept with their size and modification time, and a content hash when one is
+    computed, hashed again only when their stat changed. The index is only written
+    when it changed.
+
+    Once `use_dockerignore` is called, files excluded from the build context are
+    skipped, as `docker build` does. Directories are scanned by a pool of threads
+    (listing and stat calls release the GIL), `stats` counting the scanned entries.
+    """
+
+    VERSION = 2
+
+    def __init__(self, path, workers=None):
+        self.path = path
+        self.workers = workers
+        self.directories = {}
+        self.files = {}
+        self.context = None
+        self.matcher = None
+        self.lock = threading.Lock()
+        self.dirty = False
+        self.stats = {"directories": 0, "files": 0, "stats": 0, "ignored": 0}
+        self.load()
+
+    @classmethod
+    def for_image(cls, image_name, directory=None):
+        """Index of an image, stored in the workspace (or a temporary directory)"""
+
+        directory = directory or os.path.join(
+            os.getenv("WORKSPACE_LOCAL", "/tmp"), ".deployer", "fingerprints"  # nosec
+        )
+        name = hashlib.sha1(image_name.encode()).hexdigest()  # nosec
+        return cls(os.path.join(directory, f"{name}.json"))
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                content = json.load(f)
+        except (OSError, ValueError):
+            return
+
+        if content.get("version") == self.VERSION:
+            self.directories = content["directories"]
+            self.files = content["files"]
+
+    def save(self):
+        if not self.dirty:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+        # Write aside then rename, parallel builds may share the index
+        tmp_path = f"{self.path}.{os.getpid()}"
+        with open(tmp_path, "w") as f:
+            json.dump(
+                {
+                    "version": self.VERSION,
+                    "directories": self.directories,
+                    "files": self.files,
+                },
+                f,
+            )
+        os.replace(tmp_path, self.path)
+        self.dirty = False
+
+    def use_dockerignore(self, context):
+        """Skip the files excluded by the .dockerignore of a build context"""
+
+        self.context = context
+        self.matcher = None
+        try:
+            with open(os.path.join(context, ".dockerignore")) as f:
+                lines = [line.strip() for line in f.read().splitlines()]
+        except OSError:
+            return
+
+        # Same parsing as the docker SDK build
+        patterns = [line for line in lines if line and not line.startswith("#")]
+        if len(patterns) > 0:
+            self.matcher = PatternMatcher(patterns)
+
+    def is_ignored(self, path, is_directory=False):
+        """Whether a path is excluded from the build context
+
+        A directory is only skipped as a whole if no exception (`!pattern`) may
+        include back one of its files.
+        """
+
+        if self.matcher is None:
+            return False
+
+        relative_path = os.path.relpath(path, self.context)
+        if relative_path.startswith(os.pardir) or not self.matcher.matches(
+            relative_path
+        ):
+            return False
+
+        if is_directory:
+            return not any(
+                pattern.exclusion and pattern.cleaned_pattern.startswith(relative_path)
+                for pattern in self.matcher.patterns
+            )
+        return True
+
+    def count(self, **counts):
+        with self.lock:
+            for name, value in counts.items():
+                self.stats[name] += value
+
+    def listing(self, directory, mtime_ns):
+        """Files and subdirectories of a directory, listed again only if it changed"""
+
+        known = self.directories.get(directory)
+        if known is not None and known["mtime"] == mtime_ns:
+            return known["files"], known["directories"]
+
+        files, directories = [], []
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                # Like os.walk, symbolic links to directories are not followed
+                if entry.is_dir(follow_symlinks=False):
+                    directories.append(entry.name)
+                else:
+                    files.append(entry.name)
+
+        files.sort()
+        directories.sort()
+        with self.lock:
+            self.directories[directory] = {
+                "mtime": mtime_ns,
+                "files": files,
+                "directories": directories,
+            }
+            self.dirty = True
+
+        return files, directories
+
+    def stat_file(self, path):
+        """Index a file and return its stat, or None if it vanished"""
+
+        self.count(stats=1)
+        try:
+            file_stat = os.stat(path)
+        except OSError:  # Broken link or removed since the listing
+            with self.lock:
+                if self.files.pop(path, None) is not None:
+                    self.dirty = True
+            return None
+
+        known = self.files.get(path)
+        if known is None or known[:2] != [file_stat.st_mtime_ns, file_stat.st_size]:
+            with self.lock:
+                self.files[path] = [file_stat.st_mtime_ns, file_stat.st_size, None]
+                self.dirty = True
+
+        return file_stat
+
+    def file_digest(self, path):
+        """SHA-256 of a file content, hashed again only if its stat changed"""
+
+        if self.stat_file(path) is None:
+            return None
+
+        known = self.files.get(path)
+        if known is None:  # Removed meanwhile
+            return None
+        if known[2] is None:
+            digest = hashlib.sha256()
+            try:
+                with open(path, "rb") as f:
+                    for block in iter(lambda: f.read(1 << 20), b""):
+                        digest.update(block)
+            except OSError:  # Removed since the stat
+                return None
+            with self.lock:
+                known[2] = digest.hexdigest()
+                self.dirty = True
+
+        return known[2]
+
+    def scan_directory(self, directory, mtime_ns, timestamp=None):
+        """List and stat a directory, without walking its subdirectories
+
+        Return the files which are not ignored (or only the first one modified after
+        `timestamp` when given) and the subdirectories to scan, with their mtime.
+        Without `timestamp`, files are not stat'ed: their digest does it.
+        """
+
+        try:
+            names, directory_names = self.listing(directory, mtime_ns)
+        except OSError:
+            return [], []
+
+        files, ignored = [], 0
+        for name in names:
+            file_path = os.path.join(directory, name)
+            if self.is_ignored(file_path):
+                ignored += 1
+                continue
+
+            if timestamp is None:
+                files.append(file_path)
+                continue
+
+            file_stat = self.stat_file(file_path)
+            if file_stat is not None and file_stat.st_mtime_ns / 1e9 > timestamp:
+                files.append(file_path)
+                break
+
+        subdirectories = []
+        for name in directory_names:
+            subdirectory = os.path.join(directory, name)
+            if self.is_ignored(subdirectory, is_directory=True):
+                ignored += 1
+                continue
+            try:
+                subdirectories.append((subdirectory, os.stat(subdirectory).st_mtime_ns))
+            except OSError:
+                continue
+
+        self.count(directories=1, files=len(names), ignored=ignored)
+        return files, subdirectories
+
+    def scan(self, path, timestamp=None):
+        """Scan the directories of `path` in parallel (see `scan_directory`)
+
+        With a `timestamp`, stop at the first file modified after it.
+        """
+
+        try:
+            path_stat = os.stat(path)
+        except OSError:  # Removed meanwhile
+            return []
+        if not stat.S_ISDIR(path_stat.st_mode):
+            # Explicit files are part of the context (e.g. the Dockerfile)
+            file_stat = self.stat_file(path)
+            if file_stat is None:  # Removed meanwhile
+                return []
+            newer = timestamp is None or file_stat.st_mtime > timestamp
+            return [path] if newer else []
+
+        files = []
+        with ThreadPoolExecutor(self.workers) as pool:
+            pending = {
+                pool.submit(self.scan_directory, path, path_stat.st_mtime_ns, timestamp)
+            }
+            while len(pending) > 0:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    directory_files, subdirectories = future.result()
+                    files.extend(directory_files)
+                    pending.update(
+                        pool.submit(self.scan_directory, d, m, timestamp)
+                        for d, m in subdirectories
+                    )
+
+                if timestamp is not None and len(files) > 0:
+                    for future in pending:
+                        future.cancel()
+                    break
+
+        return sorted(files)
+
+    def digest(self, base_path, paths):
+        """Combined digest of the paths and contents of files (relative to base)"""
+
+        digest = hashlib.sha256()
+        for path in paths:
+            files = self.scan(os.path.join(base_path, path))
+            with ThreadPoolExecutor(self.workers) as pool:
+                file_digests = pool.map(self.file_digest, files)
+
+            for file_path, file_digest in zip(files, file_digests):
+                if file_digest is not None:
+                    relative_path = os.path.relpath(file_path, base_path)
+                    digest.update(f"{relative_path}\0{file_digest}\n".encode())
+
+        return digest.hexdigest()
+
+    def newer_file(self, path, timestamp):
+        """Return a file of `path` modified after `timestamp`, or None
+
+        `path` is a file or a directory, whose directories are scanned in parallel
+        until one of these files is found.
+        """
+
+        files = self.scan(path, timestamp)
+        return files[0] if len(files) > 0 else None
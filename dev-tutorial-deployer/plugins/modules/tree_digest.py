@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright: (c) 2021, Jimmy Tournemaine
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+from __future__ import absolute_import, division, print_function
+
+__metaclass__ = type
+
+
+ANSIBLE_METADATA = dict(
+    metadata_version="1.1",
+    status=["preview"],
+    supported_by="community",
+)
+
+DOCUMENTATION = r"""
+---
+module: tree_digest
+short_description: Digest the content of files and directories
+description:
+  - Compute a SHA-256 digest of each tree (file or directory) from the paths and
+    contents of its files.
+  - File hashes are kept in a cache file with the file sizes and modification
+    times, so only the files changed since the previous call are read again.
+version_added: "2.9"
+author: Jimmy Tournemaine (@JimmyTournemaine)
+options:
+  path:
+    description: The base directory of the trees.
+    required: true
+    type: path
+  trees:
+    description: The trees to digest, relative to I(path).
+    type: list
+    elements: str
+    default: ["."]
+  exclude:
+    description: Files to leave out, relative to I(path).
+    type: list
+    elements: str
+    default: []
+  cache:
+    description: The cache of the file hashes.
+    type: path
+    default: /tmp/tree_digest.json
+"""
+
+EXAMPLES = r"""
+- name: Digest the sources
+  tree_digest:
+    path: /usr/src/app/api
+    trees: [src, public]
+  register: sources
+"""
+
+RETURN = r"""
+digests:
+  description: The digest of each tree, null when it does not exist.
+  returned: always
+  type: dict
+hashed:
+  description: The number of files read (not found in the cache).
+  returned: always
+  type: int
+"""
+
+import hashlib  # noqa: E402
+import json  # noqa: E402
+import os  # noqa: E402
+
+from ansible.module_utils.basic import AnsibleModule  # noqa: E402
+
+
+def load_cache(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_cache(path, cache):
+    tmp_path = f"{path}.{os.getpid()}"
+    with open(tmp_path, "w") as f:
+        json.dump(cache, f)
+    os.replace(tmp_path, path)
+
+
+def tree_files(path):
+    """Files of a file or a directory, without following directory links"""
+
+    if not os.path.isdir(path):
+        return [path] if os.path.isfile(path) else []
+
+    files, pending = [], [path]
+    while len(pending) > 0:
+        with os.scandir(pending.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    pending.append(entry.path)
+                elif entry.is_file():
+                    files.append(entry.path)
+
+    return sorted(files)
+
+
+class TreeHasher:
+    def __init__(self, cache):
+        self.cache = cache
+        self.seen = set()
+        self.hashed = 0
+
+    def file_digest(self, path):
+        """Hash of a file, read again only if its size or mtime changed"""
+
+        file_stat = os.stat(path)
+        file_key = [file_stat.st_size, file_stat.st_mtime_ns]
+        self.seen.add(path)
+        known = self.cache.get(path)
+        if known is not None and known[:2] == file_key:
+            return known[2]
+
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+        self.hashed += 1
+        self.cache[path] = file_key + [digest.hexdigest()]
+
+        return self.cache[path][2]
+
+    def tree_digest(self, base, tree, exclude):
+        path = os.path.normpath(os.path.join(base, tree))
+        if not os.path.exists(path):
+            return None
+
+        digest = hashlib.sha256()
+        for file_path in tree_files(path):
+            relative_path = os.path.relpath(file_path, base)
+            if relative_path not in exclude:
+                file_digest = self.file_digest(file_path)
+                digest.update(f"{relative_path}\0{file_digest}\n".encode())
+
+        return digest.hexdigest()
+
+
+def main():
+    module = AnsibleModule(
+        argument_spec=dict(
+            path=dict(type="path", required=True),
+            trees=dict(type="list", elements="str", default=["."]),
+            exclude=dict(type="list", elements="str", default=[]),
+            cache=dict(type="path", default="/tmp/tree_digest.json"),  # nosec
+        ),
+        supports_check_mode=True,
+    )
+
+    base = module.params["path"]
+    if not os.path.isdir(base):
+        module.fail_json(msg=f"{base} is not a directory")
+
+    hasher = TreeHasher(load_cache(module.params["cache"]))
+    exclude = {os.path.normpath(path) for path in module.params["exclude"]}
+    digests = {
+        tree: hasher.tree_digest(base, tree, exclude) for tree in module.params["trees"]
+    }
+
+    # Forget the files removed from the digested trees
+    roots = tuple(
+        os.path.normpath(os.path.join(base, tree)) for tree in module.params["trees"]
+    )
+    cache = {
+        path: known
+        for path, known in hasher.cache.items()
+        if path in hasher.seen or not path.startswith(roots)
+    }
+    save_cache(module.params["cache"], cache)
+
+    module.exit_json(changed=False, digests=digests, hashed=hasher.hashed)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Benchmark of the `nested` filters over the task files of the roles
+
+Compare the former recursive `nested`, the iterative one (once per key) and
+`nested_index` (all the keys at once).
+"""
+
+import argparse
+import glob
+import os
+import sys
+import timeit
+
+import yaml
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "../plugins/filter")
+)
+from nested import nested, nested_index  # noqa: E402
+
+
+def recursive_nested(node, kv):
+    if isinstance(node, list):
+        for i in node:
+            for x in recursive_nested(i, kv):
+                yield x
+    elif isinstance(node, dict):
+        if kv in node:
+            yield node[kv]
+        for j in node.values():
+            for x in recursive_nested(j, kv):
+                yield x
+
+
+def load_documents(basedir):
+    documents = []
+    for path in sorted(glob.glob(f"{basedir}/../roles/*/tasks/*.yml")):
+        with open(path) as f:
+            documents.append(yaml.safe_load(f))
+    return documents
+
+
+def benchmark(documents, keys, number):
+    candidates = {
+        "recursive nested": lambda: [
+            list(recursive_nested(d, k)) for d in documents for k in keys
+        ],
+        "nested": lambda: [list(nested(d, k)) for d in documents for k in keys],
+        "nested_index": lambda: [nested_index(d, keys) for d in documents],
+    }
+    for name, candidate in candidates.items():
+        duration = min(timeit.repeat(candidate, number=number, repeat=5))
+        print(f"{name:<20} {duration / number * 1000:.3f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the nested filters")
+    parser.add_argument(
+        "--keys",
+        nargs="+",
+        default=["register", "notify", "when", "loop"],
+        help="the keys to look up",
+    )
+    parser.add_argument("--number", type=int, default=100, help="the runs per measure")
+    args = parser.parse_args()
+
+    basedir = os.path.dirname(os.path.abspath(__file__))
+    documents = load_documents(basedir)
+    print(f"{len(documents)} task files, keys: {', '.join(args.keys)}")
+    benchmark(documents, args.keys, args.number)
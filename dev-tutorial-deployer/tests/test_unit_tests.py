@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Tests of the scenarios closures of unit-tests.py (--changed)
+
+Run from the deployer: python3 -m unittest discover ../tests
+"""
+
+import importlib.util
+import os
+import unittest
+
+BASEDIR = os.path.dirname(os.path.abspath(__file__))
+DEPLOYER_DIR = os.path.dirname(BASEDIR)
+
+spec = importlib.util.spec_from_file_location(
+    "unit_tests", os.path.join(BASEDIR, "unit-tests.py")
+)
+unit_tests = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(unit_tests)
+
+
+class ModuleUtilsReferencesTest(unittest.TestCase):
+    def test_import_forms(self):
+        text = "\n".join(
+            [
+                "import ansible.module_utils",
+                "from ansible.module_utils import buildkit  # noqa: E402",
+                "from ansible.module_utils.docker_cache import client  # noqa: E402",
+                "from ansible.module_utils import a, b as c",
+            ]
+        )
+
+        self.assertEqual(
+            list(unit_tests.module_utils_references(text)),
+            ["buildkit", "docker_cache", "a", "b"],
+        )
+
+
+class ClosureFilesTest(unittest.TestCase):
+    def test_plugins_module_utils(self):
+        files = unit_tests.closure_files(DEPLOYER_DIR, "build-api")
+
+        for module in ["buildkit", "docker_cache", "fingerprint_index"]:
+            with self.subTest(module=module):
+                self.assertIn(f"{DEPLOYER_DIR}/plugins/module_utils/{module}.py", files)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -3,14 +3,43 @@
 
 import abc
 import argparse
+import hashlib
 import logging
+import multiprocessing
+import json
 import os
+import re
+import shutil
 import sys
+from concurrent.futures import ProcessPoolExecutor
 from typing import List
 
+import yaml
 from molecule.command import base
 from molecule.config import DEFAULT_DRIVER
 
+# LibYAML bindings when available
+YamlLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+YamlDumper = getattr(yaml, "CSafeDumper", yaml.SafeDumper)
+
+# Ports of each worker containers are shifted by this step
+WORKER_PORT_STEP = 10
+
+# Files shared by every scenario, relative to the deployer directory
+SHARED_FILES = [
+    "ansible.cfg",
+    "group_vars",
+    "tests/group_vars",
+    "tests/hosts.yml",
+    "tests/molecule.yml",
+]
+PLUGIN_TYPES = ["action", "filter", "lookup", "modules"]
+ROLE_REFERENCE = re.compile(r"(?:\brole:|_role:\s+name:)\s*['\"]?([\w.-]+)")
+# Both `from ansible.module_utils.<module> import` and `import <module>` forms
+MODULE_UTILS_REFERENCE = re.compile(
+    r"^from ansible\.module_utils(?:\.(\w+))? import \(?([\w, ]+)", re.MULTILINE
+)
+
 
 def base_directory():
     return os.path.dirname(os.path.abspath(__file__))
@@ -58,29 +87,42 @@ def symlink(src, dest):
     return dest
 
 
+def combine(base, override):
+    """Same as the Ansible `combine(recursive=True)` filter"""
+
+    if not isinstance(base, dict) or not isinstance(override, dict):
+        return override
+
+    combined = dict(base)
+    for key, value in override.items():
+        combined[key] = combine(combined[key], value) if key in combined else value
+    return combined
+
+
 def combine_molecule(basedir, scenario_path):
     molecule_base = f"{basedir}/molecule.yml"
     molecule_over = f"{scenario_path}/molecule.frag.yml"
     molecule_targ = f"{scenario_path}/molecule.yml"
 
-    content_base = (
-        f"-e molecule_base=\"{{{{ lookup('file', '{molecule_base}') | from_yaml }}}}\""
-    )
-    content_over = (
-        f"-e molecule_over=\"{{{{ lookup('file', '{molecule_over}') | from_yaml }}}}\""
-    )
-    content_combined = (
-        "{{ molecule_base | combine(molecule_over, recursive=True) | to_yaml }}"
-    )
+    with open(molecule_base, "rb") as f:
+        content_base = f.read()
+    with open(molecule_over, "rb") as f:
+        content_over = f.read()
+
+    # Combined configurations are kept by the hash of their sources
+    digest = hashlib.sha256(content_base + b"\0" + content_over).hexdigest()
+    cache_path = f"{basedir}/.cache/molecule/{digest}.yml"
+    if not os.path.exists(cache_path):
+        combined = combine(
+            yaml.load(content_base, Loader=YamlLoader),
+            yaml.load(content_over, Loader=YamlLoader),
+        )
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        with open(f"{cache_path}.{os.getpid()}", "w") as f:
+            yaml.dump(combined, f, Dumper=YamlDumper, default_flow_style=False)
+        os.replace(f"{cache_path}.{os.getpid()}", cache_path)
 
-    cmd = " ".join(
-        [
-            "ansible localhost",
-            "-m copy",
-            f'-a "dest={molecule_targ} content=\\"{content_combined}\\"" {content_base} {content_over}',
-        ]
-    )
-    os.system(cmd)
+    shutil.copyfile(cache_path, molecule_targ)
 
     return molecule_targ
 
@@ -125,12 +167,188 @@ def run_molecule(role_path, subcommand, scenario_name):
     base.execute_cmdline_scenarios(scenario_name, args, command_args)
 
 
+def init_worker(slots):
+    """Give a worker process its own containers, images, networks and host ports
+    (see tests/hosts.yml and tests/group_vars), its scenarios run with the others"""
+
+    slot = slots.get()
+    os.environ["MOLECULE_WORKER_SUFFIX"] = f"-w{slot}"
+    os.environ["MOLECULE_WORKER_PORT_OFFSET"] = str((slot + 1) * WORKER_PORT_STEP)
+
+
+def run_scenario(role_name, scenario, command, log_path=None):
+    """Run a scenario (in a worker process) and return its exit code"""
+
+    # Molecule and Ansible write to the inherited output, kept by scenario
+    if log_path is not None:
+        log = os.open(log_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        os.dup2(log, 1)
+        os.dup2(log, 2)
+
+    try:
+        run_molecule(role_path(base_directory(), role_name), command, scenario)
+        return 0
+    except SystemExit as err:
+        return err.code or 1  # Any exit is a failure
+
+
+def run_scenarios(scenarios, command, jobs, log_dir):
+    """Run (role, scenario) pairs, in a pool of processes if `jobs` > 1
+
+    Return the exit codes in the order of `scenarios`.
+    """
+
+    if jobs <= 1:
+        return [run_scenario(r, s, command) for r, s in scenarios]
+
+    os.makedirs(log_dir, exist_ok=True)
+    # Forked workers keep the parsed arguments and the prepared configuration
+    context = multiprocessing.get_context("fork")
+    slots = context.Queue()
+    for slot in range(jobs):
+        slots.put(slot)
+    with ProcessPoolExecutor(
+        jobs, mp_context=context, initializer=init_worker, initargs=(slots,)
+    ) as pool:
+        futures = [
+            pool.submit(
+                run_scenario,
+                role_name,
+                scenario,
+                command,
+                f"{log_dir}/{role_name}-{scenario}.log",
+            )
+            for role_name, scenario in scenarios
+        ]
+        return [future.result() for future in futures]
+
+
+def list_files(path):
+    """Files of a file or a directory, without generated ones (links, caches)"""
+
+    if os.path.isfile(path):
+        return [path]
+
+    files = []
+    for root, directories, names in os.walk(path):
+        directories[:] = [
+            d for d in directories if not d.startswith(".") and d != "__pycache__"
+        ]
+        files.extend(
+            os.path.join(root, name)
+            for name in names
+            if not os.path.islink(os.path.join(root, name))
+        )
+    return files
+
+
+def read_text(path):
+    with open(path, encoding="utf-8", errors="replace") as f:
+        return f.read()
+
+
+def role_closure(deployer_dir, role_name):
+    """A role and the roles it uses: meta dependencies, roles included by its tasks
+    or by its scenarios playbooks"""
+
+    closure, pending = set(), [role_name]
+    while len(pending) > 0:
+        name = pending.pop()
+        path = f"{deployer_dir}/roles/{name}"
+        if name in closure or not os.path.isdir(path):
+            continue
+        closure.add(name)
+
+        meta_path = f"{path}/meta/main.yml"
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                meta = yaml.load(f, Loader=YamlLoader) or {}
+            for dependency in meta.get("dependencies") or []:
+                if isinstance(dependency, dict):
+                    dependency = dependency.get("role", dependency.get("name"))
+                pending.append(dependency)
+
+        for file in list_files(path):
+            if file.endswith((".yml", ".yaml")):
+                pending.extend(ROLE_REFERENCE.findall(read_text(file)))
+
+    return closure
+
+
+def module_utils_references(text):
+    """Modules of ansible.module_utils imported by a plugin, in both import forms"""
+
+    for module, names in MODULE_UTILS_REFERENCE.findall(text):
+        if module:
+            yield module
+        else:
+            yield from (name.split()[0] for name in names.split(",") if name.strip())
+
+
+def closure_files(deployer_dir, role_name):
+    """Files a role scenarios depend on: roles, shared files and used plugins"""
+
+    files = set()
+    for name in role_closure(deployer_dir, role_name):
+        files.update(list_files(f"{deployer_dir}/roles/{name}"))
+    text = "\n".join(read_text(file) for file in sorted(files))
+
+    for shared in SHARED_FILES:
+        if os.path.exists(f"{deployer_dir}/{shared}"):
+            files.update(list_files(f"{deployer_dir}/{shared}"))
+
+    # Plugins are used by name (e.g. a `docker_image:` task, a `| nested` filter)
+    for plugin_type in PLUGIN_TYPES:
+        plugins_dir = f"{deployer_dir}/plugins/{plugin_type}"
+        if not os.path.isdir(plugins_dir):
+            continue
+        for name in os.listdir(plugins_dir):
+            stem, extension = os.path.splitext(name)
+            if ".py" == extension and re.search(rf"\b{stem}", text):
+                plugin = f"{plugins_dir}/{name}"
+                files.add(plugin)
+                for module in module_utils_references(read_text(plugin)):
+                    files.add(f"{deployer_dir}/plugins/module_utils/{module}.py")
+
+    return sorted(file for file in files if os.path.exists(file))
+
+
+def closure_digest(deployer_dir, role_name):
+    digest = hashlib.sha256()
+    for file in closure_files(deployer_dir, role_name):
+        with open(file, "rb") as f:
+            content_digest = hashlib.sha256(f.read()).hexdigest()
+        relative_path = os.path.relpath(file, deployer_dir)
+        digest.update(f"{relative_path}\0{content_digest}\n".encode())
+
+    return digest.hexdigest()
+
+
+def load_manifests(path):
+    """Digest of the closure of the scenarios, by scenario, at their last success"""
+
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_manifests(path, manifests):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(manifests, f, indent=2, sort_keys=True)
+
+
 class Report:
     results: List[str] = list()
 
     def ok(self, role_name):
         self.results.append(f"ok {len(self.results) + 1} - {role_name}")
 
+    def skip(self, role_name, reason):
+        self.results.append(f"ok {len(self.results) + 1} - {role_name} # SKIP {reason}")
+
     def ko(self, role_name, exit_code):
         self.results.append(
             f"not ok {len(self.results) + 1} - {role_name} exited with Ansible exit code {exit_code}"
@@ -160,63 +378,109 @@ class TapPrinter(ReportPrinter):
             f.write("\n".join(report.results))
 
 
-basedir = base_directory()
-roles = list_roles(basedir)
-report = Report()
-
-parser = argparse.ArgumentParser(description="Run Ansible roles unit tests")
-parser.add_argument(
-    "roles",
-    metavar="N",
-    type=str,
-    nargs="*",
-    help="roles to run (all roles are tested if no argument is provided)",
-)
-parser.add_argument("--command", type=str, default="test", help="the molecule command")
-parser.add_argument(
-    "--scenario",
-    type=str,
-    default=None,
-    help="the scenario to run (run all scenario if not provided)",
-)
+def main():
+    basedir = base_directory()
+    roles = list_roles(basedir)
+    report = Report()
 
-args = parser.parse_args()
+    parser = argparse.ArgumentParser(description="Run Ansible roles unit tests")
+    parser.add_argument(
+        "roles",
+        metavar="N",
+        type=str,
+        nargs="*",
+        help="roles to run (all roles are tested if no argument is provided)",
+    )
+    parser.add_argument(
+        "--command", type=str, default="test", help="the molecule command"
+    )
+    parser.add_argument(
+        "--scenario",
+        type=str,
+        default=None,
+        help="the scenario to run (run all scenario if not provided)",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help="the scenarios to run at once (outputs are then written to report/logs)",
+    )
+    parser.add_argument(
+        "--changed",
+        action="store_true",
+        help="only run the scenarios whose files changed since they last passed",
+    )
 
-# Is a roles list specified ? Test all otherwise
-selected_roles = args.roles
-if len(selected_roles) > 0:
-    if not all(item in roles for item in selected_roles):
-        print("Some given roles are not a valid role name or do not contain tests")
-        print("Testable roles are : " + str(roles))
-        sys.exit(2)
-else:
-    selected_roles = roles
+    args = parser.parse_args()
 
-# Prepare molecule configuration
-to_clear = prepare_molecule(basedir, selected_roles)
+    # Is a roles list specified ? Test all otherwise
+    selected_roles = args.roles
+    if len(selected_roles) > 0:
+        if not all(item in roles for item in selected_roles):
+            print("Some given roles are not a valid role name or do not contain tests")
+            print("Testable roles are : " + str(roles))
+            sys.exit(2)
+    else:
+        selected_roles = roles
+
+    # Digest the scenarios dependencies before preparing them
+    deployer_dir = os.path.dirname(basedir)
+    manifests_path = f"{basedir}/.cache/manifests.json"
+    manifests = load_manifests(manifests_path)
+    digests = {r: closure_digest(deployer_dir, r) for r in selected_roles}
+
+    # Prepare molecule configuration
+    to_clear = prepare_molecule(basedir, selected_roles)
+
+    try:
+        # Run molecule tests
+        scenarios = [
+            (role_name, scenario)
+            for role_name in selected_roles
+            for scenario in (
+                list_scenarios(basedir, role_name)
+                if args.scenario is None
+                else [args.scenario]
+            )
+        ]
+        unchanged = [
+            (role_name, scenario)
+            for role_name, scenario in scenarios
+            if args.changed
+            and manifests.get(f"{role_name} ({scenario})") == digests[role_name]
+        ]
+        to_run = [scenario for scenario in scenarios if scenario not in unchanged]
 
-try:
-    # Run molecule tests
-    for role_name in selected_roles:
-        role = role_path(basedir, role_name)
-        scenarios = (
-            list_scenarios(basedir, role_name)
-            if args.scenario is None
-            else [args.scenario]
+        log_dir = f"{basedir}/../report/logs"
+        exit_codes = dict(
+            zip(to_run, run_scenarios(to_run, args.command, args.jobs, log_dir))
         )
-        for scenario in scenarios:
-            try:
-                run_molecule(role, args.command, scenario)
-                report.ok(f"{role_name} ({scenario})")
-            except SystemExit as err:
-                report.ko(f"{role_name} ({scenario})", err.code)
-
-finally:
-    # Clear prepared configuration
-    for f in to_clear:
-        os.remove(f)
-
-    # Print the report
-    printers = [ConsolePrinter(), TapPrinter(f"{basedir}/../report/results.tap")]
-    for printer in printers:
-        printer.print(report)
+        for role_name, scenario in scenarios:
+            name = f"{role_name} ({scenario})"
+            exit_code = exit_codes.get((role_name, scenario))
+            if exit_code is None:
+                report.skip(name, "unchanged since the last passing run")
+            elif exit_code == 0:
+                report.ok(name)
+                if "test" == args.command:
+                    manifests[name] = digests[role_name]
+            else:
+                report.ko(name, exit_code)
+                manifests.pop(name, None)
+
+        save_manifests(manifests_path, manifests)
+
+    finally:
+        # Clear prepared configuration
+        for f in to_clear:
+            os.remove(f)
+
+        # Print the report
+        printers = [ConsolePrinter(), TapPrinter(f"{basedir}/../report/results.tap")]
+        for printer in printers:
+            printer.print(report)
+
+
+if __name__ == "__main__":
+    main()